@@ -0,0 +1,223 @@
+"""
+PersonalKnowledgeEngine
+
+Reading the files inside archives without extracting them; serves "Backend"
+and "Index"
+
+A file inside an archive is named by the path of the archive, ARCHIVE_SEPARATOR
+and its name in the archive, e.g. 'notes/2019.zip!/meetings/may.md'. Zip
+files, tar files (plain or compressed with gzip, bzip2 or xz) and single
+gzip-compressed files are read as streams, one member at a time, so memory
+use doesn't depend on the size of the archive.
+
+The list of regular files in an archive is cached on disk, keyed by the
+archive's path, size and modification time. With it, an archive none of
+whose members pass the search rules isn't opened at all, and a tar file is
+only decompressed up to its last wanted member.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import gzip
+import json
+import os
+import tarfile
+import zipfile
+import zlib
+
+from Extractors import cache_entry_path, write_atomically
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+ARCHIVE_SEPARATOR = '!/'
+ARCHIVE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'PersonalKnowledgeEngine', 'archives')
+MEMBER_LIST_SUFFIX = '.json'
+# Archive formats by file name ending, longest endings first
+ARCHIVE_FORMATS = (
+    ('.tar.gz', 'tar'),
+    ('.tar.bz2', 'tar'),
+    ('.tar.xz', 'tar'),
+    ('.tgz', 'tar'),
+    ('.tbz2', 'tar'),
+    ('.txz', 'tar'),
+    ('.tar', 'tar'),
+    ('.zip', 'zip'),
+    ('.gz', 'gzip'),
+)
+# Errors of damaged archives, besides OSError
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error)
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+class ArchiveError(Exception):
+    """Raised when an archive can't be read, e.g. because it is damaged
+    """
+
+
+def archive_format(path: str):
+    """Returns 'zip', 'tar' or 'gzip' for an archive, or None for any other
+    file, judging by its name
+    """
+    name = path.lower()
+    for ending, kind in ARCHIVE_FORMATS:
+        if name.endswith(ending):
+            return kind
+    return None
+
+
+def member_path(archive: str, name: str) -> str:
+    """Returns the path of a file inside an archive
+    """
+    return archive + ARCHIVE_SEPARATOR + name
+
+
+def split_member_path(path: str) -> tuple:
+    """Splits the path of a file inside an archive
+
+    :return: (path of the archive, name in the archive), or (path, None) if
+             the path isn't inside an archive
+    """
+    # Absolute paths use the platform's separator after the "!" as well
+    for separator in {ARCHIVE_SEPARATOR, '!' + os.sep}:
+        start = 0
+        while True:
+            start = path.find(separator, start)
+            if start == -1:
+                break
+            if archive_format(path[:start]) is not None:
+                name = path[start + len(separator):]
+                return path[:start], name.replace(os.sep, '/')
+            start += len(separator)
+    return path, None
+
+
+def member_skip_reason(path: str, include_exts: set, excluded: set):
+    """Returns why a file inside an archive isn't searched, or None
+
+    :param path: path of the file inside the archive, see `member_path`
+    :param include_exts: set of file extensions to include, or None for all
+    :param excluded: set of excluded paths, made absolute and passed through
+                     os.path.normcase. Paths inside archives exclude the
+                     files in them like directories do
+    :return: 'extension', 'excluded' or None
+    """
+    archive, name = split_member_path(path)
+    if (include_exts is not None
+            and os.path.splitext(name)[1] not in include_exts):
+        return 'extension'
+    parts = name.split('/')
+    for depth in range(1, len(parts) + 1):
+        prefix = member_path(archive, '/'.join(parts[:depth]))
+        if os.path.normcase(os.path.normpath(prefix)) in excluded:
+            return 'excluded'
+    return None
+
+
+def gzip_member_name(path: str) -> str:
+    """Returns the name of the file a gzip-compressed file holds
+    """
+    return os.path.basename(path)[:-len('.gz')]
+
+
+def read_member_list(path: str, stat: os.stat_result):
+    """Returns the cached [[name, size], ...] of the regular files in an
+    archive, or None if it isn't cached
+    """
+    entry = cache_entry_path(path, stat, ARCHIVE_CACHE_DIR)
+    try:
+        with open(entry + MEMBER_LIST_SUFFIX, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_member_list(path: str, stat: os.stat_result, members: list) -> None:
+    """Caches the [[name, size], ...] of the regular files in an archive
+    """
+    entry = cache_entry_path(path, stat, ARCHIVE_CACHE_DIR)
+    write_atomically(entry + MEMBER_LIST_SUFFIX,
+                     json.dumps(members).encode('utf-8'))
+
+
+def archive_members(path: str, wanted, terminate_early: list = None):
+    """Yields the files in an archive that `wanted` accepts, as streams
+
+    :param path: path of the archive
+    :param wanted: function that takes the name of a file in the archive and
+                   returns whether to read it. Called once for every regular
+                   file in the archive, in archive order
+    :param terminate_early: optional single-element list containing a bool
+                            that says whether to stop early. Checked before
+                            every file
+    :return: generator of (name, size, stream). `size` is None if it isn't
+             known before the file is read, and `stream` is a binary file
+             object that is only valid until the next item is taken, or
+             None if the file can't be read, e.g. because it is encrypted
+    :raises ArchiveError: if the archive can't be read
+    """
+    kind = archive_format(path)
+    if kind == 'gzip':
+        name = gzip_member_name(path)
+        if wanted(name):
+            try:
+                with gzip.open(path, 'rb') as stream:
+                    yield name, None, stream
+            except ARCHIVE_ERRORS as e:
+                raise ArchiveError('%s: %s: %s' % (path, type(e).__name__, e))
+        return
+
+    stat = os.stat(path)
+    members = read_member_list(path, stat)
+    if members is not None:
+        wanted_names = {name for name, _ in members if wanted(name)}
+        if not wanted_names:
+            return
+        accept = wanted_names.__contains__
+        last_wanted = max(index for index, (name, _) in enumerate(members)
+                          if name in wanted_names)
+    else:
+        accept = wanted
+        last_wanted = None
+    listed = []
+
+    try:
+        if kind == 'zip':
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    listed.append([info.filename, info.file_size])
+                    if terminate_early is not None and terminate_early[0]:
+                        return
+                    if not accept(info.filename):
+                        continue
+                    try:
+                        stream = archive.open(info)
+                    except (RuntimeError, NotImplementedError,
+                            zipfile.BadZipFile):
+                        # Encrypted, or compressed with an unknown method
+                        yield info.filename, info.file_size, None
+                        continue
+                    with stream:
+                        yield info.filename, info.file_size, stream
+        else:
+            # Stream mode reads the archive front to back, once
+            with tarfile.open(path, 'r|*') as archive:
+                for info in archive:
+                    if not info.isreg():
+                        continue
+                    listed.append([info.name, info.size])
+                    if terminate_early is not None and terminate_early[0]:
+                        return
+                    if accept(info.name):
+                        stream = archive.extractfile(info)
+                        yield info.name, info.size, stream
+                    if (last_wanted is not None
+                            and len(listed) > last_wanted):
+                        break
+    except ARCHIVE_ERRORS as e:
+        raise ArchiveError('%s: %s: %s' % (path, type(e).__name__, e))
+    if members is None:
+        write_member_list(path, stat, listed)
@@ -6,145 +6,1768 @@ GUI Events call functions housed in this file; serves "GUI"
 
 
 # IMPORTS (remember to list installed packages in "requirements.txt")
-from pathlib import Path
+import codecs
+from collections import deque, namedtuple
+import io
+import locale
+import mmap
+import multiprocessing
+import os
+import re
 import sys
+import time
+
+from Archives import ARCHIVE_ERRORS, ArchiveError, archive_format, \
+    archive_members, member_path, member_skip_reason, split_member_path
+from Dedup import Deduplicator, HashStore
+from Extractors import EXTRACT_CACHE_DIR, ExtractionError, extracted_text, \
+    extractor_for
+from Matchers import make_matcher
+from Query import Query, QueryMatch, QueryMatcher
+from Ranking import RANKED_SNIPPETS_PER_FILE, HitSample, SampleComplete, \
+    TopFiles
+from Stats import STATS_REPORT_INTERVAL, SearchStats
 
 
 # GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
 SEARCH_CONTEXT_WORDS = 11
+SNIPPET_WINDOW_CHARS = 256  # characters on each side of a match a snippet uses
+# Enough bytes to hold SNIPPET_WINDOW_CHARS characters in any encoding
+SNIPPET_WINDOW_BYTES = 4 * (SNIPPET_WINDOW_CHARS + 1)
+# Bytes of a file handled in one step, and so the most scanned between two
+# checks for cancellation (a few milliseconds' worth)
+SCAN_WINDOW_BYTES = 1 << 23
+# A carriage return that isn't part of a CRLF pair, i.e. an old Mac line
+# ending. Reading text breaks lines there too, searching bytes doesn't
+BARE_CARRIAGE_RETURN = re.compile(rb'\r(?!\n)')
+# Encoding files are read with, the same default `open` uses
+DEFAULT_ENCODING = locale.getpreferredencoding(False)
+SNIFF_BYTES = 8192  # bytes read from the start of a file to classify it
+# Walked files put in order of how likely they are to have hits at a time,
+# when a search visits likely files first
+HISTORY_BATCH_FILES = 256
+# How the encoding of a file is picked, in order: 'bom' uses the byte order
+# mark if the file starts with one, any other entry is a codec that is used
+# if the first SNIFF_BYTES bytes decode with it. The last codec is used if
+# none of them fit
+ENCODING_RULES = ('bom', 'utf-8', DEFAULT_ENCODING)
+# Longer marks first, since the UTF-32 LE mark starts with the UTF-16 LE one
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# (offset, magic number) of binary formats whose first block may not
+# contain a NUL byte: archives, compressed streams, media, disk images
+BINARY_SIGNATURES = (
+    (0, b'%PDF-'),
+    (0, b'PK\x03\x04'),
+    (0, b'\x1f\x8b'),
+    (0, b'BZh'),
+    (0, b'\xfd7zXZ'),
+    (0, b'7z\xbc\xaf\x27\x1c'),
+    (0, b'Rar!\x1a\x07'),
+    (0, b'\x89PNG'),
+    (0, b'\xff\xd8\xff'),
+    (0, b'GIF8'),
+    (0, b'\x7fELF'),
+    (0, b'OggS'),
+    (0, b'ID3'),
+    (0, b'fLaC'),
+    (0, b'\x1a\x45\xdf\xa3'),
+    (0, b'RIFF'),
+    (4, b'ftyp'),
+    (0, b'SQLite format 3\x00'),
+    (0, b'QFI\xfb'),
+    (0, b'KDMV'),
+    (0, b'conectix'),
+)
+SCAN_BATCH_SIZE = 32  # files handed to a worker process at a time
+SCAN_BATCHES_PER_WORKER = 4  # batches queued per worker before the walk waits
+SCAN_POLL_INTERVAL = 0.02  # seconds between cancellation checks while waiting
 
 
 # DEFINITIONS (define all backend functions)
 
-def search_file_for_string(path: str, key: str) -> list:
+# A single search hit. `column` is only set when every match in a line is
+# reported, `key` is the key that matched, `location` says where in a
+# document (see "Extractors") the line is, e.g. 'page 3', and `distance` is
+# the number of edits the match needed in a fuzzy search. `snippet` is None
+# for hits found without snippets, and `offset` and `length` are then the
+# byte offset of the match in the file and its length, see `load_snippet`
+SearchHit = namedtuple('SearchHit',
+                       ['snippet', 'line', 'column', 'key', 'location',
+                        'distance', 'offset', 'length'])
+SearchHit.__new__.__defaults__ = (None, None, None, None, None, None)
+
+
+class SearchCancelled(Exception):
+    """Raised inside the search of a file once the search is terminated
+    """
+
+
+# The matcher a worker process last searched with, see `worker_matcher`
+WORKER_MATCHER = [None]
+
+
+def make_snippet(line: str, key: str, offset: int = None,
+                 bold_regex=None) -> str:
+    """Shortens a line containing `key` to a few words around one use of it
+
+    Only a fixed window of characters around the match is looked at, so
+    the cost per hit doesn't grow with the length of the line.
+
+    :param line: a line of text containing `key`
+    :param key: the string that was searched for, or the text it matched
+    :param offset: index in `line` of the occurrence to center the snippet
+                   on. Defaults to the first occurrence
+    :param bold_regex: optional compiled regular expression whose matches
+                       are bolded instead of the instances of `key`, for
+                       keys that match more than one string
+    :return: the trimmed line with every instance of `key` in bold
+    """
+    if offset is None:
+        offset = max(line.find(key), 0)
+
+    # Cut the line down to a window around the match, dropping any word
+    # that the window boundaries split
+    window_start = max(0, offset - SNIPPET_WINDOW_CHARS)
+    window_end = offset + len(key) + SNIPPET_WINDOW_CHARS
+    text = line[window_start:window_end]
+    text_start = window_start  # index of `text` in `line`
+    offset -= window_start
+    if window_end < len(line):
+        cut = text.rfind(' ', offset + len(key))
+        if cut != -1:
+            text = text[:cut]
+    if window_start > 0:
+        cut = text.find(' ', 0, offset)
+        if cut != -1:
+            text = text[cut + 1:]
+            text_start += cut + 1
+            offset -= cut + 1
+    if bold_regex is None:
+        occurrence = text.count(key, 0, offset) if key else 0
+        line = text.strip(" \n\r\t")
+        bolded_key = "<b>"+key+"</b>"
+        # Bold any instances of the key inside the line
+        bolded_line = line.replace(key, bolded_key)
+    else:
+        # Bold the actual matches, found in the line itself so anchors and
+        # lookarounds see what is around the window
+        occurrence = 0
+        pieces = []
+        last = 0
+        for match in bold_regex.finditer(line, text_start,
+                                         text_start + len(text)):
+            start = match.start() - text_start
+            end = match.end() - text_start
+            if end == start or start < last:
+                continue
+            occurrence += start < offset
+            pieces.append(text[last:start] + "<b>" + text[start:end]
+                          + "</b>")
+            last = end
+        pieces.append(text[last:])
+        bolded_key = "<b>"
+        bolded_line = "".join(pieces).strip(" \n\r\t")
+    key_value = 0
+    key_counter = 0
+    seen_keys = 0
+    trimmed_array = []
+    split_line = bolded_line.split(" ")
+
+    # Shorten the line to only contain the chosen instance of the key term
+    # and the first few words around it
+    for words in split_line:
+        seen_keys += words.count(bolded_key)
+        if seen_keys > occurrence:
+            key_value = key_counter
+            break
+        key_counter += 1
+    split_key = []
+    start = key_value - SEARCH_CONTEXT_WORDS // 2
+    end = start + SEARCH_CONTEXT_WORDS
+    split_key = split_line[max(0, start):end]
+    for word in split_key:
+        trimmed_array.append(word)
+    return "..."+" ".join(trimmed_array)+"..."
+
+
+def matches_to_report(matches: tuple, offset: int, all_matches: bool,
+                      next_offsets: dict) -> list:
+    """Returns which of the matches at `offset` in a line to report
+
+    Each key is reported the way a search for it alone would: only its first
+    occurrence in a line, or with `all_matches` every occurrence that
+    doesn't overlap the previous one.
+
+    :param matches: ((key, matched text), ...) found at `offset`
+    :param offset: character offset of the matches in their line
+    :param all_matches: whether every occurrence in a line is reported
+    :param next_offsets: dict of key -> first offset at which it may be
+                         reported again, for the current line. Updated
+    :return: list of the (key, matched text) pairs to report
+    """
+    reported = []
+    for key, matched in matches:
+        if offset >= next_offsets.get(key, 0):
+            next_offsets[key] = (offset + max(len(matched), 1) if all_matches
+                                 else float('inf'))
+            reported.append((key, matched))
+    return reported
+
+
+def search_line_for_string(line: str, line_num: int, matcher,
+                           all_matches: bool = False,
+                           sample: HitSample = None,
+                           line_offset: int = None,
+                           snippets: bool = True,
+                           encoding: str = None) -> list:
+    """Search a single line of text for the key(s) of a matcher
+
+    :param line: the line of text
+    :param line_num: number of the line, for the hits
+    :param matcher: the matcher for the key(s), see "Matchers"
+    :param all_matches: whether to report every occurrence of the key in
+                        the line instead of only the first
+    :param sample: optional Ranking.HitSample to count the hits in and
+                   keep a few of, instead of returning them
+    :param line_offset: byte offset of the line in its file, if known, for
+                        `sample` and for hits without snippets
+    :param snippets: whether to build the snippets of the hits. Without,
+                     and given `line_offset` and `encoding`, hits have the
+                     byte offset and length of the match in the file
+                     instead, see `load_snippet`
+    :param encoding: the encoding the line was decoded from
+    :return: list of SearchHit, see `search_lines_for_string`
+    """
+    key_instances = []
+    # Bytes that failed to decode no longer say where the match is
+    lazy = (not snippets and line_offset is not None and encoding is not None
+            and '\ufffd' not in line)
+    encoded_to = [0, line_offset]  # character index -> byte offset
+    offset, matches = matcher.search_text(line)
+    next_offsets = {}
+    while offset != -1:  # while this line contains another match
+        for key, matched in matches_to_report(matches, offset, all_matches,
+                                              next_offsets):
+            if (sample is not None
+                    and not sample.offer(key, line_num, line_offset)):
+                continue
+            distance = None if matcher.max_distance is None \
+                else matcher.distance(key, matched)
+            if lazy:
+                # Matches come in order, so only the text since the last
+                # one is encoded
+                encoded_to[1] += len(
+                    line[encoded_to[0]:offset].encode(encoding))
+                encoded_to[0] = offset
+                hit = SearchHit(None, line_num,
+                                offset+1 if all_matches else None, key,
+                                distance=distance, offset=encoded_to[1],
+                                length=len(matched.encode(encoding)))
+            else:
+                hit = SearchHit(
+                    make_snippet(line, matched, offset, matcher.bold_regex),
+                    line_num, offset+1 if all_matches else None, key,
+                    distance=distance)
+            if sample is not None:
+                sample.add(hit)
+            else:
+                key_instances.append(hit)
+        if not all_matches and len(next_offsets) == len(matcher.keys):
+            break
+        offset, matches = matcher.search_text(
+            line, matcher.next_start(offset, matches))
+    return key_instances
+
+
+def search_lines_for_string(lines, key,
+                            all_matches: bool = False,
+                            terminate_early: list = None,
+                            sample: HitSample = None,
+                            first_line: int = 1) -> list:
+    """
+    Search each line of an iterable of text lines for a string key
+    :param lines: iterable of lines, e.g. a file opened in text mode
+    :param key: The string to search through the lines for, a list of
+                strings to search for all at once, or a matcher (see
+                "Matchers")
+    :param all_matches: whether to report every occurrence of the key in a
+                        line instead of only the first
+    :param terminate_early: optional single-element list containing a bool
+                            that says whether to stop early. Checked before
+                            every line; raises SearchCancelled once set
+    :param sample: optional Ranking.HitSample to count the hits in and
+                   keep a few of, instead of returning them
+    :param first_line: line number of the first line in `lines`
+    :return: [SearchHit(snippet, line#, None, key), ...] with the first
+             occurrence of each key in each line, or, with `all_matches`,
+             [SearchHit(snippet, line#, column#, key), ...] with every one
+    """
+    matcher = make_matcher(key)
+    key_instances = []
+    for i, line in enumerate(lines, first_line):
+        if terminate_early is not None and terminate_early[0]:
+            raise SearchCancelled()
+        key_instances.extend(
+            search_line_for_string(line, i, matcher, all_matches, sample))
+    return key_instances
+
+
+def check_terminated(terminate_early: list) -> None:
+    """Raises SearchCancelled if the search has been terminated
+
+    :param terminate_early: single-element list containing a bool that says
+                            whether to stop early, or None
+    """
+    if terminate_early is not None and terminate_early[0]:
+        raise SearchCancelled()
+
+
+def find_bytes(buffer, sub: bytes, start: int, end: int,
+               terminate_early: list = None) -> int:
+    """Like `buffer.find(sub, start, end)`, but looks at SCAN_WINDOW_BYTES
+    at a time and checks for cancellation in between
+
+    :return: offset of the first occurrence, or -1 if there is none
+    """
+    while start < end:
+        window_end = min(end, start + SCAN_WINDOW_BYTES + len(sub) - 1)
+        pos = buffer.find(sub, start, window_end)
+        if pos != -1:
+            return pos
+        start += SCAN_WINDOW_BYTES
+        check_terminated(terminate_early)
+    return -1
+
+
+def find_pattern(buffer, pattern, start: int, end: int,
+                 terminate_early: list = None) -> tuple:
+    """Like `pattern.find(buffer, start, end)`, but looks at
+    SCAN_WINDOW_BYTES at a time and checks for cancellation in between
+
+    :param pattern: byte pattern of a matcher, see "Matchers"
+    :return: (offset, length) of the first match, or (-1, 0)
+    """
+    while start < end:
+        window_end = min(end, start + SCAN_WINDOW_BYTES
+                         + pattern.max_length - 1)
+        pos, length = pattern.find(buffer, start, window_end)
+        if pos != -1:
+            return pos, length
+        start += SCAN_WINDOW_BYTES
+        check_terminated(terminate_early)
+    return -1, 0
+
+
+def has_bare_carriage_return(buffer) -> bool:
+    """Returns whether a buffer has line breaks that only reading it as
+    text sees, see BARE_CARRIAGE_RETURN
+
+    :param buffer: bytes-like object, e.g. an mmap
+    """
+    # Most files have no carriage return at all, which find rules out fast
+    pos = buffer.find(b'\r')
+    return pos != -1 and BARE_CARRIAGE_RETURN.search(buffer, pos) is not None
+
+
+def rfind_bytes(buffer, sub: bytes, start: int, end: int,
+                terminate_early: list = None) -> int:
+    """Like `buffer.rfind(sub, start, end)`, but looks at SCAN_WINDOW_BYTES
+    at a time and checks for cancellation in between
+
+    :return: offset of the last occurrence, or -1 if there is none
+    """
+    while start < end:
+        window_start = max(start, end - SCAN_WINDOW_BYTES - len(sub) + 1)
+        pos = buffer.rfind(sub, window_start, end)
+        if pos != -1:
+            return pos
+        end -= SCAN_WINDOW_BYTES
+        check_terminated(terminate_early)
+    return -1
+
+
+def count_newlines(buffer, start: int, end: int,
+                   terminate_early: list = None) -> int:
+    """Counts the line breaks in buffer[start:end] without copying it whole
+    """
+    count = 0
+    for block_start in range(start, end, SCAN_WINDOW_BYTES):
+        check_terminated(terminate_early)
+        block_end = min(end, block_start + SCAN_WINDOW_BYTES)
+        count += buffer[block_start:block_end].count(b'\n')
+    return count
+
+
+def decode_window(buffer, line_start: int, line_end: int, pos: int,
+                  match_len: int, encoding: str) -> tuple:
+    """Decodes the part of a line around a match that a snippet can use
+
+    :param buffer: bytes-like object with the file contents
+    :param line_start: offset of the first byte of the line
+    :param line_end: offset just past the last byte of the line
+    :param pos: offset of the match
+    :param match_len: length of the match in bytes
+    :param encoding: the encoding of `buffer`
+    :return: (decoded text, index of the match in the text)
+    """
+    start = max(line_start, pos - SNIPPET_WINDOW_BYTES)
+    end = min(line_end, pos + match_len + SNIPPET_WINDOW_BYTES)
+    before = buffer[start:pos].decode(encoding, errors='replace')
+    after = buffer[pos:end].decode(encoding, errors='replace')
+    return before + after, len(before)
+
+
+def search_buffer_for_string(buffer, key, encoding: str,
+                             all_matches: bool = False,
+                             stats: SearchStats = None,
+                             terminate_early: list = None,
+                             sample: HitSample = None,
+                             first_line: int = 1,
+                             snippets: bool = True,
+                             start: int = 0) -> list:
+    """
+    Search the encoded bytes of a file for a string key
+    :param buffer: bytes-like object with the file contents, e.g. an mmap
+    :param key: The string to search through the file for, a list of
+                strings to search for all at once, or a matcher (see
+                "Matchers")
+    :param encoding: the encoding of `buffer`
+    :param all_matches: whether to report every occurrence of the key in a
+                        line instead of only the first
+    :param stats: optional SearchStats to add the decode, match and snippet
+                  times to
+    :param terminate_early: optional single-element list containing a bool
+                            that says whether to stop early. Checked at
+                            least every SCAN_WINDOW_BYTES; raises
+                            SearchCancelled once set
+    :param sample: optional Ranking.HitSample to count the hits in and
+                   keep a few of, instead of returning them
+    :param first_line: line number of the first line in `buffer`, for
+                       buffers holding part of a file, or of the line at
+                       `start`
+    :param snippets: whether to build the snippets of the hits. Without,
+                     hits have the offset and length of the match in
+                     `buffer` instead, see `load_snippet`
+    :param start: offset of the start of the line to begin the search at,
+                  to carry on with a search that stopped there
+    :return: [SearchHit(snippet, line#, None, key), ...] with the first
+             occurrence of each key in each line, or, with `all_matches`,
+             [SearchHit(snippet, line#, column#, key), ...] with every one
+
+    Only the bytes around each match are decoded, never whole lines. For
+    matchers whose byte pattern only finds lines that may match, such as
+    regular expressions, those lines are decoded whole and matched as text.
+    """
+    matcher = make_matcher(key)
+    pattern = matcher.byte_pattern(encoding)
+    if pattern is None:
+        # Text in this encoding can't contain the key
+        return []
+
+    started = time.perf_counter()
+    decode_time = snippet_time = 0.0
+    key_instances = []
+    line_num = first_line
+    counted_to = start  # line_num is the line number at this offset
+    size = len(buffer)
+    pos, length = find_pattern(buffer, pattern, start, size, terminate_early)
+    while pos != -1:
+        check_terminated(terminate_early)
+        # counted_to is the start of a line, possibly of this one
+        line_start = max(rfind_bytes(buffer, b'\n', counted_to, pos,
+                                     terminate_early) + 1, counted_to)
+        line_end = find_bytes(buffer, b'\n', pos, size, terminate_early)
+        if line_end == -1:
+            line_end = size
+        if line_start - counted_to <= SCAN_WINDOW_BYTES:
+            line_num += buffer[counted_to:line_start].count(b'\n')
+        else:
+            line_num += count_newlines(buffer, counted_to, line_start,
+                                       terminate_early)
+        counted_to = line_start
+
+        if not matcher.matches_in_bytes:
+            clock = time.perf_counter()
+            line = buffer[line_start:line_end].decode(encoding,
+                                                      errors='replace')
+            # As reading the file as text would see it
+            if line.endswith('\r'):
+                line = line[:-1]
+            if line_end < size:
+                line += '\n'
+            decode_time += time.perf_counter() - clock
+            key_instances.extend(search_line_for_string(
+                line, line_num, matcher, all_matches, sample, line_start,
+                snippets, encoding))
+            pos, length = find_pattern(buffer, pattern, line_end, size,
+                                       terminate_early)
+            continue
+
+        column = 1
+        column_pos = line_start  # column is the column number at this offset
+        next_offsets = {}
+        while pos != -1:
+            clock = time.perf_counter()
+            text, offset = decode_window(buffer, line_start, line_end, pos,
+                                         length, encoding)
+            if all_matches:
+                column += len(buffer[column_pos:pos].decode(
+                    encoding, errors='replace'))
+                column_pos = pos
+            decode_time += time.perf_counter() - clock
+            # Multi-byte encodings can match the key's bytes mid-character
+            matches = matcher.match_at(text, offset)
+            # Without all_matches, where in the line doesn't matter
+            for key, matched in matches_to_report(matches, column - 1,
+                                                  all_matches, next_offsets):
+                if (sample is not None
+                        and not sample.offer(key, line_num, line_start)):
+                    continue
+                if not snippets:
+                    hit = SearchHit(None, line_num,
+                                    column if all_matches else None, key,
+                                    offset=pos,
+                                    length=len(matched.encode(encoding)))
+                else:
+                    clock = time.perf_counter()
+                    snippet = make_snippet(text, matched, offset,
+                                           matcher.bold_regex)
+                    snippet_time += time.perf_counter() - clock
+                    hit = SearchHit(snippet, line_num,
+                                    column if all_matches else None, key)
+                if sample is not None:
+                    sample.add(hit)
+                else:
+                    key_instances.append(hit)
+            if not all_matches and len(next_offsets) == len(matcher.keys):
+                break
+            pos, length = find_pattern(buffer, pattern,
+                                       pattern.next_start(pos, length),
+                                       line_end, terminate_early)
+        pos, length = find_pattern(buffer, pattern, line_end, size,
+                                   terminate_early)
+
+    if stats is not None:
+        stats.add_time('decode', decode_time)
+        stats.add_time('snippet', snippet_time)
+        stats.add_time('match', time.perf_counter() - started
+                       - decode_time - snippet_time)
+    return key_instances
+
+
+def sniff_encoding(block: bytes, encodings: tuple = ENCODING_RULES):
+    """Guesses how a file is encoded from its first few bytes
+
+    :param block: the first SNIFF_BYTES bytes of the file, or all of it if
+                  it is shorter
+    :param encodings: rules to pick the encoding with, see ENCODING_RULES
+    :return: name of the codec to read the file with, or None if the file
+             looks binary
+    """
+    if 'bom' in encodings:
+        for bom, encoding in BYTE_ORDER_MARKS:
+            if block.startswith(bom):
+                return encoding
+    if b'\0' in block:
+        return None
+    for offset, signature in BINARY_SIGNATURES:
+        if block.startswith(signature, offset):
+            return None
+
+    candidates = [rule for rule in encodings if rule != 'bom']
+    for encoding in candidates:
+        try:
+            # Incremental, so a character cut off at the end of the block
+            # doesn't count against the codec
+            codecs.getincrementaldecoder(encoding)().decode(block)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return candidates[-1] if candidates else DEFAULT_ENCODING
+
+
+def skipped_without_reading(path: str, encodings: tuple = ENCODING_RULES,
+                            max_file_size: int = None,
+                            extract_cache_dir: str = None
+                            ) -> bool:
+    """Returns whether `search_file_for_string` skips a file as too large or
+    binary, reading no more than its first SNIFF_BYTES bytes
+
+    See `search_file_for_string` for the parameters.
+
+    :raises OSError: if the file can't be read
+    """
+    if max_file_size is not None and os.path.getsize(path) > max_file_size:
+        return True
+    if extract_cache_dir is not None and extractor_for(path) is not None:
+        # Searched through its extracted text
+        return False
+    with open(path, 'rb') as f:
+        return sniff_encoding(f.read(SNIFF_BYTES), encodings) is None
+
+
+def new_sample(matcher, snippets_per_file: int = None, window=None):
+    """Returns the Ranking.HitSample to collect the hits of a file in, or
+    None to collect them in a list
+
+    Boolean queries always collect their hits in a Query.QueryMatch, which
+    stops the search of a file once the query is decided for it.
+
+    :param window: optional Paging.HitWindow, returned as it is
+    """
+    if window is not None:
+        return window
+    if isinstance(matcher, QueryMatcher):
+        return QueryMatch(matcher, snippets_per_file,
+                          stop_when_matched=snippets_per_file is None)
+    if snippets_per_file is not None:
+        return HitSample(snippets_per_file)
+    return None
+
+
+def sampled_hits(key_instances: list, sample: HitSample,
+                 snippets_per_file: int = None):
+    """Returns the hits of a searched file, see `search_file_for_string`
+
+    :param key_instances: the hits collected in a list
+    :param sample: the sample from `new_sample`
+    """
+    hits = key_instances if sample is None else sample.hits
+    if hits and hits[0].distance is not None:
+        # Fuzzy hits are closest first, and in line order after that
+        hits.sort(key=lambda hit: hit.distance)
+    if sample is None:
+        return key_instances
+    if snippets_per_file is None:
+        # A query's hits, only if the file matches it
+        return sample.hits if sample else []
+    return sample
+
+
+def search_file_for_string(path: str, key,
+                           all_matches: bool = False,
+                           stats: SearchStats = None,
+                           encodings: tuple = ENCODING_RULES,
+                           max_file_size: int = None,
+                           terminate_early: list = None,
+                           snippets_per_file: int = None,
+                           extract_cache_dir: str = None,
+                           snippets: bool = True,
+                           window=None):
     """
     Search each line of a single file for a string key
     :param path: the relative or absolute path of the file to be searched
-    :param key: The string to search through the file for
-    :return: [(line# of key occurrence #1, full line of key occurrence #1), ...]
+    :param key: The string to search through the file for, a list of
+                strings to search for all at once, or a matcher (see
+                "Matchers")
+    :param all_matches: whether to report every occurrence of the key in a
+                        line instead of only the first
+    :param stats: optional SearchStats to record the file and the time
+                  spent on each phase in
+    :param encodings: rules to pick the file's encoding with, see
+                      ENCODING_RULES
+    :param max_file_size: size in bytes above which the file is skipped.
+                          None for no limit
+    :param terminate_early: optional single-element list containing a bool
+                            that says whether to stop early. Checked while
+                            the file is scanned; raises SearchCancelled once
+                            set
+    :param snippets_per_file: if set, the hits are only counted and this
+                              many of them kept, see Ranking.HitSample
+    :param extract_cache_dir: directory the text of documents is cached in,
+                              see `search_document_for_string`. None, the
+                              default, to read documents as they are, i.e.
+                              skip them as binary files
+    :param snippets: whether to build every hit's snippet straight away.
+                     Without, hits in memory-mapped files, including the
+                     extracted text of documents, get theirs from
+                     `load_snippet` when it is needed, which saves time and
+                     memory when most of them are never looked at
+    :param window: optional Paging.HitWindow to return only one page of the
+                   hits with. A memory-mapped file is only searched from
+                   where the window starts, and only until the page is full.
+                   Not for boolean queries or fuzzy matches
+    :return: [SearchHit(snippet, line#, None, key), ...] with the first
+             occurrence of each key in each line, or, with `all_matches`,
+             [SearchHit(snippet, line#, column#, key), ...] with every one.
+             With `snippets_per_file`, a Ranking.HitSample of them, or an
+             empty list if the file wasn't searched. Fuzzy hits are sorted
+             closest first
+
+    Only the first SNIFF_BYTES bytes are read to decide whether the file is
+    binary and how it is encoded; binary and oversized files are skipped
+    without reading the rest. Text files are memory-mapped and searched as
+    bytes, so files without a hit are never decoded. Keys that span lines,
+    encodings that don't encode line breaks as a single newline byte, and
+    files with line breaks other than LF and CRLF fall back to reading the
+    file as text, as do regular expressions that contain no literal
+    fragment to look for in the bytes. Bytes that can't
+    be decoded are replaced rather than ending the search of the file.
+    """
+    if extract_cache_dir is not None and extractor_for(path) is not None:
+        return search_document_for_string(
+            path, key, all_matches, stats, max_file_size, terminate_early,
+            snippets_per_file, extract_cache_dir, snippets, window)
+    started = time.perf_counter()
+    matcher = make_matcher(key)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if max_file_size is not None and size > max_file_size:
+            if stats is not None:
+                stats.skip('too_large')
+            return []
+        encoding = sniff_encoding(f.read(SNIFF_BYTES), encodings)
+        if encoding is None:
+            if stats is not None:
+                stats.skip('binary')
+            return []
+        # None when text in this encoding can't contain any key
+        pattern = matcher.byte_pattern(encoding)
+        sample = new_sample(matcher, snippets_per_file, window)
+        if sample is not None:
+            sample.size = size
+
+        buffer = None
+        if (pattern is not None and size > 0 and pattern.max_length
+                and not matcher.spans_lines
+                and '\n'.encode(encoding) == b'\n'):
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError, OverflowError):
+                # e.g. special files, or too large for the address space
+                buffer = None
+            if buffer is not None and has_bare_carriage_return(buffer):
+                buffer.close()
+                buffer = None
+        if stats is not None:
+            stats.add_time('open', time.perf_counter() - started)
+
+        if buffer is not None:
+            with buffer:
+                try:
+                    if window is not None and window.offset is not None:
+                        key_instances = search_buffer_for_string(
+                            buffer, matcher, encoding, all_matches, stats,
+                            terminate_early, sample, window.line, snippets,
+                            min(window.offset, size))
+                    else:
+                        key_instances = search_buffer_for_string(
+                            buffer, matcher, encoding, all_matches, stats,
+                            terminate_early, sample, snippets=snippets)
+                except SampleComplete:
+                    key_instances = []
+            if stats is not None:
+                stats.file_searched(path, size, time.perf_counter() - started)
+            return sampled_hits(key_instances, sample, snippets_per_file)
+        if pattern is None or size == 0:
+            if stats is not None:
+                stats.file_searched(path, size, time.perf_counter() - started)
+            return sampled_hits([], sample, snippets_per_file)
+
+    clock = time.perf_counter()
+    with open(path, encoding=encoding, errors='replace') as f:
+        if stats is not None:
+            stats.add_time('open', time.perf_counter() - clock)
+        clock = time.perf_counter()
+        try:
+            key_instances = search_lines_for_string(f, matcher, all_matches,
+                                                    terminate_early, sample)
+        except SampleComplete:
+            key_instances = []
+    if stats is not None:
+        # Reading text decodes and matches in one pass; counted as decoding
+        stats.add_time('decode', time.perf_counter() - clock)
+        stats.file_searched(path, size, time.perf_counter() - started)
+    return sampled_hits(key_instances, sample, snippets_per_file)
+
+
+def search_document_for_string(path: str, key,
+                               all_matches: bool = False,
+                               stats: SearchStats = None,
+                               max_file_size: int = None,
+                               terminate_early: list = None,
+                               snippets_per_file: int = None,
+                               extract_cache_dir: str = EXTRACT_CACHE_DIR,
+                               snippets: bool = True,
+                               window=None):
     """
+    Search the text of a document, such as a Word or PDF file, for a string
+    key. See `search_file_for_string` for the parameters
+
+    The text is extracted the first time the document is searched and kept
+    in `extract_cache_dir` (see "Extractors"); after that the cached text is
+    searched like any other UTF-8 file. Line numbers are those of the
+    extracted text, and each hit's `location` says where in the document
+    the line is. `max_file_size` applies to the document itself.
+
+    :raises Extractors.ExtractionError: if the text can't be extracted
+    """
+    started = time.perf_counter()
+    size = os.stat(path).st_size
+    if max_file_size is not None and size > max_file_size:
+        if stats is not None:
+            stats.skip('too_large')
+        return []
+    document = extracted_text(path, extract_cache_dir)
+    text_stats = SearchStats()
+    text_stats.add_time('extract', time.perf_counter() - started)
+    found = search_file_for_string(document.text_path, key, all_matches,
+                                   text_stats, ('utf-8',), None,
+                                   terminate_early, snippets_per_file, None,
+                                   snippets, window)
+    if isinstance(found, HitSample):
+        found.hits = document.located(found.hits)
+    else:
+        found = document.located(found)
+    if stats is not None:
+        # Recorded under the document's path, not that of its text
+        for phase, seconds in text_stats.times.items():
+            stats.add_time(phase, seconds)
+        stats.file_searched(path, text_stats.counters['bytes_searched'],
+                            time.perf_counter() - started)
+    return found
+
+
+def load_snippet(path: str, hit: SearchHit,
+                 encodings: tuple = ENCODING_RULES,
+                 extract_cache_dir: str = None,
+                 bold_regex=None) -> str:
+    """Returns the snippet of a hit, building it if it was found without one
+
+    The file is read again around the match, so the snippet is the one the
+    search would have built, unless the file has changed since.
+
+    :param path: path of the file the hit is in
+    :param hit: a SearchHit
+    :param encodings: the rules the file's encoding was picked with
+    :param extract_cache_dir: the directory the search cached the text of
+                              documents in, see `search_file_for_string`.
+                              The snippet of a hit in a document is built
+                              from that text
+    :param bold_regex: the `bold_regex` of the search's matcher (see
+                       "Matchers"), to bold what the search would have
+    :return: the snippet, or '' if the file can't be read any more
+    """
+    if hit.snippet is not None or hit.offset is None:
+        return hit.snippet
+    try:
+        if extract_cache_dir is not None and extractor_for(path) is not None:
+            path = extracted_text(path, extract_cache_dir).text_path
+            encodings = ('utf-8',)
+        with open(path, 'rb') as f:
+            encoding = sniff_encoding(f.read(SNIFF_BYTES), encodings) \
+                or DEFAULT_ENCODING
+            length = len(hit.key.encode(encoding)) if hit.length is None \
+                else hit.length
+            start = max(0, hit.offset - SNIPPET_WINDOW_BYTES)
+            f.seek(start)
+            window = f.read(hit.offset - start + length
+                            + SNIPPET_WINDOW_BYTES)
+    except (OSError, UnicodeError, ExtractionError):
+        return ''
+    pos = hit.offset - start
+    line_start = window.rfind(b'\n', 0, pos) + 1
+    line_end = window.find(b'\n', pos)
+    if line_end == -1:
+        line_end = len(window)
+    text, offset = decode_window(window, line_start, line_end, pos, length,
+                                 encoding)
+    matched = window[pos:min(pos + length, line_end)].decode(
+        encoding, errors='replace')
+    return make_snippet(text, matched, offset, bold_regex)
+
+
+class PrefixedStream(io.RawIOBase):
+
+    def __init__(self, prefix: bytes, stream):
+        """A binary stream that reads `prefix` and then the rest of `stream`,
+        e.g. to put back the bytes read to sniff the stream's encoding
+
+        :param prefix: bytes to read first
+        :param stream: binary file object to read the rest from. Not closed
+                       with this stream
+        """
+        super(PrefixedStream, self).__init__()
+        self.prefix = prefix
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.prefix:
+            data = self.prefix[:len(buffer)]
+            self.prefix = self.prefix[len(data):]
+        else:
+            data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+def search_stream_for_string(path: str, stream, key,
+                             all_matches: bool = False,
+                             stats: SearchStats = None,
+                             encodings: tuple = ENCODING_RULES,
+                             terminate_early: list = None,
+                             snippets_per_file: int = None,
+                             size: int = None):
+    """
+    Search each line of a binary stream, such as a file inside an archive,
+    for a string key. See `search_file_for_string` for the other parameters
+    and the return value
+    :param path: path the stream is recorded under in `stats`
+    :param stream: binary file object, read from its current position to
+                   the end
+    :param size: size of the stream in bytes, if known before it is read
+
+    The stream is read SCAN_WINDOW_BYTES at a time. Each block is cut after
+    its last line break and searched as bytes like a memory-mapped file, so
+    memory use depends only on the longest line, not on the size of the
+    stream. Streams that `search_file_for_string` would read as text are
+    read as text here too, from the first block with a line break only text
+    sees on.
+    """
+    started = time.perf_counter()
+    matcher = make_matcher(key)
+    block = stream.read(SNIFF_BYTES)
+    encoding = sniff_encoding(block, encodings)
+    if encoding is None:
+        if stats is not None:
+            stats.skip('binary')
+        return []
+    # None when text in this encoding can't contain any key
+    pattern = matcher.byte_pattern(encoding)
+    sample = new_sample(matcher, snippets_per_file)
+    stream = PrefixedStream(block, stream)
+    if stats is not None:
+        stats.add_time('open', time.perf_counter() - started)
+
     key_instances = []
-    bolded_key = "<b>"+key+"</b>"
-    with open(path) as f:
-        for i, line in enumerate(f):
-            if key in line:  # if this line contains the key at least once
-                line = line.strip(" \n\r\t")
-                # Bold any instances of the key inside the line
-                key_value = 0
-                key_counter = 0
-                trimmed_array = []
-                bolded_line = line.replace(key, bolded_key)
-                split_line = bolded_line.split(" ")
-
-                # Shorten the line to only contain the first instance of the key term 
-                # and the first few words afterwards
-                for words in split_line:
-                    if bolded_key in words:
-                        key_value = key_counter
-                        break
-                    key_counter += 1
-                split_key = []
-                start = key_value - SEARCH_CONTEXT_WORDS // 2
-                end = start + SEARCH_CONTEXT_WORDS
-                split_key = split_line[max(0, start):end]
-                for word in split_key:
-                    trimmed_array.append(word)
-                trimmed_line =  "..."+" ".join(trimmed_array)+"..."
-                key_instances.append((trimmed_line, i+1))
+    line_num = 1
+    try:
+        if pattern is None:
+            stream.bytes_read = len(block) if size is None else size
+            text = None
+        elif (pattern.max_length and not matcher.spans_lines
+                and '\n'.encode(encoding) == b'\n'):
+            text = None
+            pending = b''  # start of a line whose end hasn't been read yet
+            while True:
+                check_terminated(terminate_early)
+                chunk = stream.read(SCAN_WINDOW_BYTES)
+                data = pending + chunk
+                cut = data.rfind(b'\n') + 1 if chunk else len(data)
+                pending = data[cut:]
+                if has_bare_carriage_return(data[:cut]):
+                    # Read as text from the start of this block on
+                    text = PrefixedStream(data, stream)
+                    break
+                if cut:
+                    key_instances.extend(search_buffer_for_string(
+                        data[:cut], matcher, encoding, all_matches, stats,
+                        terminate_early, sample, line_num))
+                    line_num += data.count(b'\n', 0, cut)
+                if not chunk:
+                    break
+        else:
+            text = stream
+        if text is not None:
+            clock = time.perf_counter()
+            lines = io.TextIOWrapper(io.BufferedReader(text),
+                                     encoding=encoding, errors='replace')
+            key_instances.extend(search_lines_for_string(
+                lines, matcher, all_matches, terminate_early, sample,
+                line_num))
+            if stats is not None:
+                # Reading text decodes and matches in one pass; counted as
+                # decoding
+                stats.add_time('decode', time.perf_counter() - clock)
+    except SampleComplete:
+        key_instances = []
 
-    return key_instances
+    if sample is not None:
+        sample.size = stream.bytes_read
+    if stats is not None:
+        stats.file_searched(path, stream.bytes_read,
+                            time.perf_counter() - started)
+    return sampled_hits(key_instances, sample, snippets_per_file)
+
+
+def search_archive_for_string(path: str, key, archive_rules: tuple,
+                              all_matches: bool = False,
+                              stats: SearchStats = None,
+                              encodings: tuple = ENCODING_RULES,
+                              max_file_size: int = None,
+                              terminate_early: list = None,
+                              snippets_per_file: int = None):
+    """
+    Search each file inside an archive for a string key, without extracting
+    anything to disk. See `search_file_for_string` for the other parameters
+    :param path: path of a zip, tar or gzip file, see "Archives"
+    :param archive_rules: (include_exts, exclude_paths) the files inside the
+                          archive must pass, with the exclude paths made
+                          absolute. Exclude paths inside the archive, e.g.
+                          'notes.zip!/old', exclude the files in it
+    :return: generator of (path, search hits) for each file inside the
+             archive with hits, in archive order. The paths are those of
+             `Archives.member_path`, e.g. 'notes.zip!/2019/may.md'
+
+    Documents inside archives, like archives inside archives, are searched
+    as they are, i.e. usually skipped as binary files.
+    :raises Archives.ArchiveError: if the archive can't be read. Files
+                                   before the damage have been reported
+    """
+    include_exts, exclude_paths = archive_rules
+    if include_exts is not None:
+        include_exts = set(include_exts)
+    excluded = {os.path.normcase(excluded_path)
+                for excluded_path in exclude_paths}
+    matcher = make_matcher(key)
+
+    def wanted(name: str) -> bool:
+        """Returns whether a file inside the archive is searched
+        """
+        reason = member_skip_reason(member_path(path, name), include_exts,
+                                    excluded)
+        if reason is not None and stats is not None:
+            stats.skip(reason)
+        return reason is None
+
+    for name, size, stream in archive_members(path, wanted, terminate_early):
+        virtual_path = member_path(path, name)
+        if stream is None:
+            if stats is not None:
+                stats.skip('archive_error')
+            continue
+        if max_file_size is not None and size is not None \
+                and size > max_file_size:
+            if stats is not None:
+                stats.skip('too_large')
+            continue
+        try:
+            found = search_stream_for_string(
+                virtual_path, stream, matcher, all_matches, stats, encodings,
+                terminate_early, snippets_per_file, size)
+        except ARCHIVE_ERRORS as e:
+            raise ArchiveError('%s: %s: %s'
+                               % (virtual_path, type(e).__name__, e))
+        if found:
+            yield virtual_path, found
+    check_terminated(terminate_early)
+
+
+def search_path_for_string(path: str, key, archive_rules: tuple = None,
+                           **file_options):
+    """
+    Search a file, or each file inside an archive, for a string key
+    :param path: path of the file
+    :param key: The string to search through the file for, a list of
+                strings to search for all at once, or a matcher (see
+                "Matchers")
+    :param archive_rules: see `search_archive_for_string`. None to search
+                          archives as single files
+    :param file_options: keyword arguments for `search_file_for_string`
+    :return: generator of (path, search hits) for the file, or for each file
+             inside the archive, that has hits
+    """
+    if archive_rules is not None and archive_format(path) is not None:
+        file_options.pop('extract_cache_dir', None)
+        file_options.pop('snippets', None)
+        yield from search_archive_for_string(path, key, archive_rules,
+                                             **file_options)
+        return
+    output_instances = search_file_for_string(path, key, **file_options)
+    if output_instances:
+        yield path, output_instances
+
+
+def call_on_file(func, path: str, stats: SearchStats = None) -> None:
+    """Calls `func` on a single file path, reporting errors instead of raising
+
+    :param func: function to call. Receives only the file path as argument
+    :param path: path of the file
+    :param stats: optional SearchStats to count files that failed in
+    """
+    try:
+        func(path)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        if stats is not None:
+            stats.skip('os_error')
+    except UnicodeDecodeError:
+        if stats is not None:
+            stats.skip('decode_error')
+    except ExtractionError as e:
+        print(e, file=sys.stderr)
+        if stats is not None:
+            stats.skip('extract_error')
+    except ArchiveError as e:
+        print(e, file=sys.stderr)
+        if stats is not None:
+            stats.skip('archive_error')
+    except SearchCancelled:
+        pass
+    except Exception as e:
+        print(type(e), e, file=sys.stderr)
+
+
+def normalize_search_rules(include_paths: list,
+                           include_exts: list = None,
+                           exclude_paths: list = None,
+                           follow_symlinks: bool = False,
+                           archives: bool = False) -> tuple:
+    """Returns a canonical, comparable form of a set of search rules
+
+    :param include_paths: list of directories/files to include
+    :param include_exts: list of file extensions to include
+    :param exclude_paths: list of directories/files to exclude
+    :param follow_symlinks: whether symlinked directories are walked
+    :param archives: whether the files inside archives are searched
+    :return: (sorted include paths, sorted extensions or None,
+              sorted exclude paths, follow_symlinks, archives), with all
+             paths made absolute. The order matches the arguments of
+             `foreach_file`
+    """
+    return (
+        sorted(set(os.path.abspath(path) for path in include_paths)),
+        None if include_exts is None else sorted(set(include_exts)),
+        sorted(set(os.path.abspath(path) for path in exclude_paths or [])),
+        bool(follow_symlinks),
+        bool(archives),
+    )
+
+
+def list_directory(path: str) -> list:
+    """Returns the entries of a directory, or [] if it can't be read
+
+    :param path: path of the directory
+    :return: list of os.DirEntry
+    """
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return []
+
+
+def checked_search_paths(include_paths: list, exclude_paths: list = None,
+                         archives: bool = False) -> tuple:
+    """Returns the include and exclude paths made absolute, raising
+    FileNotFoundError if one doesn't exist
+
+    :param archives: whether exclude paths may point inside archives
+    :return: (include paths, exclude paths)
+    """
+    include_paths = [os.path.abspath(path) for path in include_paths]
+    exclude_paths = [os.path.abspath(path) for path in exclude_paths or []]
+
+    for path in include_paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+    for path in exclude_paths:
+        if archives:
+            path = split_member_path(path)[0]
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+    return include_paths, exclude_paths
+
+
+def walk_files(terminate_early: list,
+               include_paths: list,
+               include_exts: list = None,
+               exclude_paths: list = None,
+               follow_symlinks: bool = False,
+               archives: bool = False,
+               stats: SearchStats = None,
+               sort: bool = False,
+               start_at: str = None):
+    """Yields the path of every file that matches the given criteria.
+
+    Directories are walked depth-first with an explicit stack, in the order
+    `os.scandir` lists them, or by name. Each entry is checked against the
+    exclude paths
+    and extensions with a single set lookup, and the file type cached by
+    `os.scandir` is used instead of a separate stat call where possible.
+
+    :param terminate_early: single-element list containing a bool that says
+                            whether to stop the walk early
+    :param include_paths: list of directories/files to include
+    :param include_exts: list of file extensions to include
+    :param exclude_paths: list of directories/files to exclude
+    :param follow_symlinks: whether to descend into symlinked directories.
+                            Each directory is visited at most once, so
+                            symlink loops are not followed
+    :param archives: whether archives are yielded whatever their extension,
+                     for the files inside them to be searched. Exclude
+                     paths may then point inside archives, see
+                     `search_archive_for_string`
+    :param stats: optional SearchStats to count excluded paths and files
+                  with other extensions in
+    :param sort: whether to walk each directory in order of name, so every
+                 walk of the same files yields them in the same order
+    :param start_at: optional path of a file in the first include path. A
+                     sorted walk starts there, skipping the files before it
+                     without listing the directories they are in
+    :return: generator of file path strings
+
+    Paths in include_paths will all be included regardless of exclude_paths
+    and include_exts.
+    """
+    include_paths, exclude_paths = checked_search_paths(include_paths,
+                                                        exclude_paths,
+                                                        archives)
+    excluded = {os.path.normcase(path) for path in exclude_paths}
+    if include_exts is not None:
+        include_exts = set(include_exts)
+    visited_dirs = set()
+
+    def first_visit(path: str) -> bool:
+        """Returns whether a directory hasn't been walked before
+        """
+        stat = os.stat(path)
+        dir_id = (stat.st_dev, stat.st_ino)
+        if dir_id in visited_dirs:
+            return False
+        visited_dirs.add(dir_id)
+        return True
+
+    def listed(path: str) -> list:
+        """Returns the entries of a directory to walk, see `sort` and
+        `start_at`
+        """
+        entries = list_directory(path)
+        if sort:
+            entries.sort(key=lambda entry: entry.name)
+        prefix = os.path.join(path, '')
+        if start_at is not None and start_at.startswith(prefix):
+            # Only the entries from the one start_at is in, or is, on
+            first = start_at[len(prefix):].split(os.sep)[0]
+            entries = [entry for entry in entries if entry.name >= first]
+        return entries
+
+    for root_index, root in enumerate(include_paths):
+        if terminate_early[0]:
+            return
+        if root_index:
+            # Include paths inside the first are walked whole
+            start_at = None
+        if not os.path.isdir(root):
+            yield root
+            continue
+        if follow_symlinks and not first_visit(root):
+            continue
+
+        # One iterator over the listed entries per directory being walked
+        stack = [iter(listed(root))]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+            if terminate_early[0]:
+                return
+            if os.path.normcase(entry.path) in excluded:
+                if stats is not None:
+                    stats.skip('excluded')
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+                if is_dir and follow_symlinks and not first_visit(entry.path):
+                    continue
+            except OSError as e:
+                print(e, file=sys.stderr)
+                continue
+            if is_dir:
+                stack.append(iter(listed(entry.path)))
+            elif entry.is_dir():
+                # Symlinked directory that isn't being followed
+                continue
+            elif (include_exts is None
+                  or os.path.splitext(entry.name)[1] in include_exts
+                  or archives and archive_format(entry.name) is not None):
+                yield entry.path
+            elif stats is not None:
+                stats.skip('extension')
+
+
+def walked_without_walking(paths: list,
+                           include_paths: list,
+                           include_exts: list = None,
+                           exclude_paths: list = None,
+                           archives: bool = False):
+    """Yields those of the given paths that `walk_files` would yield
+    without following symlinks, checking only the directories they are in
+
+    A path is kept if it is an include path that isn't a directory, or a
+    regular file, that passes `include_exts`, in an include path, with only
+    real, readable directories that aren't excluded in between. A kept path
+    is yielded by the walk, unless the files change in the meantime.
+
+    :param paths: absolute file paths, e.g. as walk_files yielded them
+    :return: generator of the paths that would be yielded, in the same
+             order, so the first can be used before the rest are checked
+    """
+    include_paths, exclude_paths = checked_search_paths(include_paths,
+                                                        exclude_paths,
+                                                        archives)
+    excluded = {os.path.normcase(path) for path in exclude_paths}
+    if include_exts is not None:
+        include_exts = set(include_exts)
+    roots = [root for root in include_paths
+             if os.path.isdir(root) and os.access(root, os.R_OK)]
+
+    def reached_from(root: str, path: str) -> bool:
+        """Returns whether the walk of `root` yields `path`
+        """
+        if not path.startswith(os.path.join(root, '')):
+            return False
+        directory = root
+        for part in path[len(os.path.join(root, '')):].split(os.sep)[:-1]:
+            directory = os.path.join(directory, part)
+            if (os.path.normcase(directory) in excluded
+                    or os.path.islink(directory)
+                    or not os.path.isdir(directory)
+                    or not os.access(directory, os.R_OK)):
+                return False
+        name = os.path.basename(path)
+        return (os.path.normcase(path) not in excluded
+                and os.path.isfile(path)
+                and (include_exts is None
+                     or os.path.splitext(name)[1] in include_exts
+                     or archives and archive_format(name) is not None))
+
+    for path in paths:
+        if (path in include_paths and not os.path.isdir(path)
+                or any(reached_from(root, path) for root in roots)):
+            yield path
 
 
 def foreach_file(func,
                  terminate_early: list,
                  include_paths: list,
                  include_exts: list = None,
-                 exclude_paths: list = None) -> None:
+                 exclude_paths: list = None,
+                 follow_symlinks: bool = False,
+                 archives: bool = False,
+                 stats: SearchStats = None,
+                 history=None) -> None:
     """
     Calls the given function on every file that matches the given criteria.
     :param func: function to call. Receives only the file path as argument
     :param include_paths: list of directories/files to include
     :param include_exts: list of file extensions to include
     :param exclude_paths: list of directories/files to exclude
+    :param follow_symlinks: whether to descend into symlinked directories
+    :param archives: whether archives are visited whatever their extension,
+                     see `walk_files`
+    :param stats: optional SearchStats to add the time spent walking and
+                  the skipped files to
+    :param history: optional History.ScanHistory. Files that had hits in
+                    earlier searches are visited first, before the walk if
+                    symlinks aren't followed. The rest are visited while
+                    the walk goes on, HISTORY_BATCH_FILES at a time with
+                    the likeliest to have hits first in each batch, so
+                    neither memory nor the time to the first hit grows
+                    with the tree. Every file is still visited as often as
+                    it would be without
 
     Paths in include_paths will all be included regardless of exclude_paths
-    and include_exts.
+    and include_exts. See `walk_files` for the order files are visited in
+    otherwise.
     """
-    if exclude_paths is None:
-        exclude_paths = []
+    visited_early = set()  # files the walk will find again
+    if history is not None and not follow_symlinks:
+        clock = time.perf_counter()
+        for path in walked_without_walking(
+                history.order(history.known_paths()), include_paths,
+                include_exts, exclude_paths, archives):
+            if stats is not None:
+                stats.add_time('walk', time.perf_counter() - clock)
+            if terminate_early[0]:
+                return
+            visited_early.add(path)
+            call_on_file(func, path, stats)
+            clock = time.perf_counter()
+        if stats is not None:
+            stats.add_time('walk', time.perf_counter() - clock)
 
-    include_paths = [Path(path).absolute() for path in include_paths]
-    exclude_paths = [Path(path).absolute() for path in exclude_paths]
+    batch = []  # walked files not visited yet
 
-    for path in include_paths:
-        if not path.exists():
-            raise FileNotFoundError(str(path))
-    for path in exclude_paths:
-        if not path.exists():
-            raise FileNotFoundError(str(path))
+    def visit_batch():
+        """Visits the files in `batch`, the likeliest to have hits first
+        """
+        for path in history.order(batch):
+            if terminate_early[0]:
+                break
+            call_on_file(func, path, stats)
+        del batch[:]
+
+    clock = time.perf_counter()
+    for path in walk_files(terminate_early,
+                           include_paths,
+                           include_exts,
+                           exclude_paths,
+                           follow_symlinks,
+                           archives,
+                           stats):
+        if stats is not None:
+            stats.add_time('walk', time.perf_counter() - clock)
+        if path in visited_early:
+            # Only once, as include paths inside others yield files twice
+            visited_early.discard(path)
+        elif history is None:
+            call_on_file(func, path, stats)
+        else:
+            batch.append(path)
+            if len(batch) >= HISTORY_BATCH_FILES:
+                visit_batch()
+        clock = time.perf_counter()
+    if stats is not None:
+        stats.add_time('walk', time.perf_counter() - clock)
+    if batch:
+        visit_batch()
+
+
+def foreach_search_file(func,
+                        terminate_early: list,
+                        key: str,
+                        include_paths: list,
+                        include_exts: list = None,
+                        exclude_paths: list = None,
+                        index_path: str = None,
+                        follow_symlinks: bool = False,
+                        encodings: tuple = ENCODING_RULES,
+                        archives: bool = False,
+                        stats: SearchStats = None,
+                        history=None,
+                        extract_cache_dir: str = None,
+                        max_file_size: int = None) -> None:
+    """Calls the given function on every file that may contain `key`
+
+    Without an index this is every file `foreach_file` visits. With one,
+    the index is brought up to date and only the files holding every
+    trigram of the key are visited.
+
+    :param func: function to call. Receives only the file path as argument
+    :param terminate_early: single-element list containing a bool that says
+                            whether to stop early
+    :param key: the string being searched for, a list of strings searched
+                for at once, or a matcher (see "Matchers")
+    :param include_paths: list of directories/files to include
+    :param include_exts: list of file extensions to include
+    :param exclude_paths: list of directories/files to exclude
+    :param index_path: optional path of a trigram index (see "Index")
+    :param follow_symlinks: whether to descend into symlinked directories
+    :param encodings: rules files are decoded by, see ENCODING_RULES. The
+                      index looks for the key as encoded by each of them
+    :param archives: whether archives are visited whatever their extension,
+                     see `walk_files`. The index then holds the trigrams of
+                     the files inside them
+    :param stats: optional SearchStats to record the walk or index time,
+                  and how many files the index added, changed and so on, in
+    :param history: optional History.ScanHistory to visit the files likely
+                    to have hits first with, see `foreach_file`
+    :param extract_cache_dir: directory the text of documents is cached in,
+                              or None if documents are searched as they
+                              are. The index holds the trigrams of what is
+                              searched, see `Index.file_trigrams`
+    :param max_file_size: size in bytes above which files are skipped. The
+                          index doesn't read them either
+    """
+    if index_path is None:
+        foreach_file(func,
+                     terminate_early,
+                     include_paths,
+                     include_exts,
+                     exclude_paths,
+                     follow_symlinks,
+                     archives,
+                     stats,
+                     history)
+        return
+
+    # Imported here since "Index" builds on the functions in this file
+    import Index
+    clock = time.perf_counter()
+    if Index.index_matches_rules(index_path,
+                                 include_paths,
+                                 include_exts,
+                                 exclude_paths,
+                                 follow_symlinks,
+                                 archives,
+                                 extract_cache_dir):
+        counts = Index.refresh_index(index_path, terminate_early,
+                                     extract_cache_dir, max_file_size)
+    else:
+        num_files = Index.build_index(index_path,
+                                      terminate_early,
+                                      include_paths,
+                                      include_exts,
+                                      exclude_paths,
+                                      follow_symlinks,
+                                      archives,
+                                      extract_cache_dir,
+                                      max_file_size)
+        counts = dict(added=num_files)
+    if stats is not None:
+        for change, num_files in counts.items():
+            stats.count('index_' + change, num_files)
+    paths = Index.candidate_paths(index_path, key, encodings)
+    if history is not None:
+        paths = history.order(paths)
+    if stats is not None:
+        stats.add_time('index', time.perf_counter() - clock)
+    for path in paths:
+        if terminate_early[0]:
+            break
+        call_on_file(func, path, stats)
+
+
+def worker_matcher(matcher):
+    """Returns the matcher a worker process already has for the same keys
+
+    Matchers arrive with every batch but compile their patterns on first
+    use, so the last one is kept to reuse its patterns for the next batch.
+    """
+    kept = WORKER_MATCHER[0]
+    if kept is not None and kept.cache_key == matcher.cache_key:
+        return kept
+    WORKER_MATCHER[0] = matcher
+    return matcher
+
+
+def search_file_batch(matcher, paths: list, file_options: dict) -> tuple:
+    """Searches a batch of files for a string key; run in worker processes
 
-    def is_excluded(path: Path, exclude_paths: list):
-        """Returns whether a file is excluded by `exclude_paths`
+    :param matcher: the matcher for the key(s) to search the files for, see
+                    "Matchers"
+    :param paths: list of file paths to search
+    :param file_options: keyword arguments for `search_path_for_string`
+    :return: ([(path, search hits), ...], SearchStats of the batch). Only
+             files with at least one hit are listed, in the same order as
+             `paths`, with the files inside an archive in place of it
+    """
+    results = []
+    stats = SearchStats()
+    matcher = worker_matcher(matcher)
+
+    def search_file_func(path: str):
+        """This is called with every path in the batch.
         """
-        for exclude_path in exclude_paths:
-            if exclude_path in path.parents or exclude_path == path:
-                return True
-        return False
+        for hit_path, output_instances in search_path_for_string(
+                path, matcher, stats=stats, **file_options):
+            results.append((hit_path, output_instances))
+
+    for path in paths:
+        call_on_file(search_file_func, path, stats)
+    return results, stats
 
-    def is_extension_included(path: Path):
-        """Returns whether a file is included by `include_paths`
+
+class FinishedBatch:
+
+    def __init__(self, results: list):
+        """Stands in for the pending result of a batch whose hits are known
+        already, so they can wait in line with the batches of a PoolScanner
+
+        :param results: [(path, search hits), ...]
         """
-        if include_exts is not None:
-            if path.suffix in include_exts:
-                return True
-        else:
-            return True
-        return False
+        self.results = results
+
+    def ready(self) -> bool:
+        return True
+
+    def wait(self, timeout: float = None) -> None:
+        pass
+
+    def get(self) -> tuple:
+        return self.results, SearchStats()
 
-    def rec_helper(path: Path, exclude_paths: list):
-        """Recursively calls `func` on all matching descendant file paths.
+
+class CopiedBatch:
+
+    def __init__(self, path: str, original: str, hits_of: dict):
+        """Stands in for the pending result of a file with the same contents
+        as an earlier one, so it gets the hits of the earlier file once they
+        have been passed on
+
+        :param path: path of the file
+        :param original: path of the earlier file
+        :param hits_of: dict of path -> search hits of the files whose hits
+                        were passed on
         """
-        try:
-            nonlocal terminate_early
-            if terminate_early[0]:
+        self.path = path
+        self.original = original
+        self.hits_of = hits_of
+
+    def ready(self) -> bool:
+        return True
+
+    def wait(self, timeout: float = None) -> None:
+        pass
+
+    def get(self) -> tuple:
+        hits = self.hits_of.get(self.original)
+        return [(self.path, hits)] if hits else [], SearchStats()
+
+
+class PoolScanner:
+
+    def __init__(self, result_callback, terminate_search, matcher,
+                 workers: int, file_options: dict,
+                 stats: SearchStats = None):
+        """Searches files for a key across a pool of worker processes.
+
+        Paths passed to `submit` are grouped into batches and searched in
+        parallel, but results are handed to `result_callback` in the order
+        the paths were submitted. Only a few batches per worker are queued
+        at once, so `submit` blocks while the pool is busy.
+
+        :param result_callback: function to call with a search hit
+        :param terminate_search: single-element list containing a bool that
+                                 says whether to terminate the search early
+        :param matcher: the matcher for the key(s) to search the files for,
+                        see "Matchers"
+        :param workers: number of worker processes
+        :param file_options: keyword arguments for `search_path_for_string`
+        :param stats: optional SearchStats to add the stats of the workers
+                      and the time spent waiting for them to
+        """
+        self.result_callback = result_callback
+        self.terminate_search = terminate_search
+        self.matcher = matcher
+        self.file_options = file_options
+        self.stats = stats
+        self.workers = workers
+        self.max_pending = workers * SCAN_BATCHES_PER_WORKER
+        # Started with the first batch, so a search answered entirely from
+        # the cache doesn't pay for starting processes
+        self.pool = None
+        self.batch = []
+        self.pending = deque()
+
+    def submit(self, path: str) -> None:
+        """Queues a file to be searched
+        """
+        self.batch.append(path)
+        if len(self.batch) >= SCAN_BATCH_SIZE:
+            self.flush_batch()
+            while len(self.pending) > self.max_pending:
+                if not self.deliver_oldest():
+                    return
+
+    def submit_hits(self, path: str, output_instances: list) -> None:
+        """Queues the hits of a file that doesn't need to be searched, e.g.
+        ones from a cache, to be passed on in order with the others
+        """
+        self.flush_batch()
+        self.pending.append(FinishedBatch([(path, output_instances)]))
+        while len(self.pending) > self.max_pending:
+            if not self.deliver_oldest():
                 return
-            if is_excluded(path, exclude_paths):
+
+    def submit_copy(self, path: str, original: str, hits_of: dict) -> None:
+        """Queues a file with the same contents as an earlier one, to be
+        passed on with the hits of the earlier file, see CopiedBatch
+        """
+        self.flush_batch()
+        self.pending.append(CopiedBatch(path, original, hits_of))
+        while len(self.pending) > self.max_pending:
+            if not self.deliver_oldest():
                 return
-            if path.is_dir():
-                for subpath in path.glob('*'):
-                    sub_exclude_paths = [
-                        p for p in exclude_paths if path in p.parents
-                    ]
-                    rec_helper(subpath, sub_exclude_paths)
-            else:
-                if is_extension_included(path):
-                    func(str(path))
-        except OSError as e:
-            print(e, file=sys.stderr)
-        except UnicodeDecodeError:
+
+    def flush_batch(self) -> None:
+        """Sends the current batch of paths to the pool
+        """
+        if self.batch:
+            if self.pool is None:
+                # "spawn" avoids forking a process that has GUI threads
+                # running
+                self.pool = multiprocessing.get_context('spawn').Pool(
+                    self.workers)
+            self.pending.append(self.pool.apply_async(
+                search_file_batch,
+                (self.matcher, self.batch, self.file_options)))
+            self.batch = []
+
+    def deliver_oldest(self) -> bool:
+        """Waits for the oldest batch and passes its hits on
+
+        :return: False if the search was terminated while waiting
+        """
+        result = self.pending[0]
+        clock = time.perf_counter()
+        while not result.ready():
+            if self.terminate_search[0]:
+                return False
+            result.wait(SCAN_POLL_INTERVAL)
+        self.pending.popleft()
+        results, batch_stats = result.get()
+        if self.stats is not None:
+            self.stats.add_time('wait', time.perf_counter() - clock)
+            self.stats.merge(batch_stats)
+        for path, output_instances in results:
+            if self.terminate_search[0]:
+                return False
+            self.result_callback(path, output_instances)
+        return True
+
+    def finish(self) -> None:
+        """Waits for all queued files to be searched and passes on their hits
+        """
+        self.flush_batch()
+        while self.pending and self.deliver_oldest():
             pass
-        except Exception as e:
-            print(type(e), e, file=sys.stderr)
 
-    for path in include_paths:
-        if path.is_dir():
-            # Narrow the list of excluded paths to only those that are inside
-            # the current directory path
-            sub_exclude_paths = [
-                p for p in exclude_paths if path in p.parents
-            ]
-            rec_helper(path, sub_exclude_paths)
+    def close(self) -> None:
+        """Stops the worker processes
+
+        Outstanding work is abandoned and the workers are killed if the
+        search was terminated or `finish` didn't run to completion.
+        """
+        if self.pool is None:
+            return
+        if self.pending or self.batch or self.terminate_search[0]:
+            self.pool.terminate()
         else:
-            func(str(path))
+            self.pool.close()
+        self.pool.join()
 
 
 def search_for_string(result_callback,
                       finished_callback,
                       terminate_search,
-                      key: str,
+                      key,
                       include_paths: list,
                       include_exts: list = None,
-                      exclude_paths: list = None) -> None:
+                      exclude_paths: list = None,
+                      index_path: str = None,
+                      workers: int = 1,
+                      follow_symlinks: bool = False,
+                      all_matches: bool = False,
+                      encodings: tuple = ENCODING_RULES,
+                      max_file_size: int = None,
+                      ignore_case: bool = False,
+                      regex: bool = False,
+                      top_k: int = None,
+                      extract_cache_dir: str = None,
+                      archives: bool = False,
+                      dedup: bool = False,
+                      query: bool = False,
+                      max_distance: int = None,
+                      snippets: bool = True,
+                      progress_callback=None,
+                      stats: SearchStats = None,
+                      cache=None,
+                      history=None) -> SearchStats:
     """Search each line of every matching file for a string key
 
     :param result_callback: function to call with a search hit
@@ -152,29 +1775,318 @@ def search_for_string(result_callback,
                               called even if the search is terminated early
     :param terminate_search: single-element list containing a bool that says
                              whether to terminate the search early
-    :param key: the string to search through the files for
+    :param key: the string to search through the files for, or a list of
+                strings to search for all at once. Each file is still read
+                only once, and each hit says which key it is for
     :param include_paths: a list of paths of directories/files to be included
     :param include_exts: a list of file extensions to include
     :param exclude_paths: a list of path of directories/files to be excluded
+    :param index_path: optional path of a trigram index (see "Index"). The
+                       index is built first if it is missing or was built
+                       from different rules, and refreshed otherwise, then
+                       used to skip files that cannot contain the key
+    :param workers: number of processes to search files with. With more
+                    than one, files are searched in a process pool while
+                    the main thread walks the tree; hits still arrive in
+                    the order the files were found
+    :param follow_symlinks: whether to descend into symlinked directories
+    :param all_matches: whether to report every occurrence of the key in a
+                        line, with the column in each SearchHit, instead of
+                        only the first occurrence of each key
+    :param encodings: rules to pick the encoding of each file with, see
+                      ENCODING_RULES. Files that look binary are skipped
+    :param max_file_size: size in bytes above which files are skipped
+                          without being read. None for no limit
+    :param ignore_case: whether to match the key regardless of case
+    :param regex: whether the key is a regular expression (see `re`),
+                  matched against each line. The literal fragments every
+                  match must contain are looked for first, so only the
+                  lines containing them are matched against it. Raises
+                  re.error if it isn't a valid expression
+    :param top_k: if set, only the `top_k` most relevant files are reported
+                  once the search is over, best first, each with a few of
+                  its hits (see "Ranking"), instead of every hit as it is
+                  found. The cache isn't used
+    :param extract_cache_dir: directory the text of documents (Word,
+                              PowerPoint and, with pypdf installed, PDF
+                              files; see "Extractors") is cached in. Their
+                              text is searched instead of their bytes, and
+                              their hits say where in the document they are.
+                              None, the default, to skip documents as binary
+                              files and write nothing to disk. The GUI and
+                              `cli.py` pass Extractors.EXTRACT_CACHE_DIR
+    :param archives: whether to search the files inside zip, tar and gzip
+                     files (see "Archives") instead of the archives
+                     themselves. The files are read as streams, without
+                     extracting them, and are reported with paths like
+                     'notes.zip!/2019/may.md'. They must pass
+                     `include_exts`, and `exclude_paths` may point inside
+                     archives. Archives are searched again every time,
+                     since the cache doesn't cover them
+    :param dedup: whether to read only one of the files with the same
+                  contents, and report its hits for all of them (see
+                  "Dedup"). Files are told apart by size, then by a hash of
+                  their contents that is kept on disk between searches
+    :param query: whether the key is a boolean query, such as
+                  'report AND "first draft" NOT old' (see "Query"). Its
+                  terms are found in one pass over each file, and a file is
+                  only read until the query is decided for it, so a file
+                  matching it is reported with the hits seen up to then.
+                  Raises Query.QueryError if it can't be parsed
+    :param max_distance: if set, the key also matches where it is
+                         misspelled with up to this many edits (characters
+                         inserted, deleted, replaced or swapped; see
+                         `Matchers.FuzzyMatcher`). Each hit has the edits
+                         it needed as its `distance`, and the hits of each
+                         file are reported closest first. Raises ValueError
+                         with `regex`, or if a key isn't longer than this
+    :param snippets: whether every hit comes with its snippet. Without, the
+                     snippets of hits in files that can be read again,
+                     i.e. most text files and the extracted text of
+                     documents, are left to `load_snippet`, to be built
+                     once they are shown, e.g. by Results.ResultStore. Hits
+                     inside archives and in files read as text keep theirs
+    :param progress_callback: optional function to call with the search's
+                              SearchStats every STATS_REPORT_INTERVAL
+                              seconds, and once more when the search is over
+    :param stats: optional SearchStats to collect the search's counters and
+                  timings in, e.g. to read them from another thread while
+                  the search runs
+    :param cache: optional Cache.ResultCache. Files that haven't changed
+                  since a cached search with the same key and rules aren't
+                  read again, and a single key containing a cached key only
+                  reads the files that had hits for it. Finished searches are
+                  added to the cache
+    :param history: optional History.ScanHistory. Files that had hits in
+                    earlier searches are searched first, then the others in
+                    order of how likely they are to have hits (see
+                    "History"), so the first hits arrive sooner; the hits
+                    found are the same. Finished searches are added to the
+                    history. Files are visited in the order of the walk in
+                    ranked mode, whose results only arrive at the end
+    :return: the SearchStats of the search
     """
-    print('search_for_string(')
-    print('\tkey = \'%s\'' % key)
-    print('\tinclude_paths =', include_paths)
-    print('\tinclude_exts =', include_exts)
-    print('\texclude_paths =', exclude_paths)
-    print(')')
+    if query:
+        matcher = QueryMatcher(Query(key), ignore_case, regex, max_distance)
+    else:
+        matcher = make_matcher(key, ignore_case, regex, max_distance)
+    # On stderr, so it never mixes with output callers write to stdout
+    print('search_for_string(', file=sys.stderr)
+    if query:
+        print('\tquery = \'%s\'' % key, file=sys.stderr)
+    elif len(matcher.keys) == 1:
+        print('\tkey = \'%s\'' % matcher.keys[0], file=sys.stderr)
+    else:
+        print('\tkeys =', list(matcher.keys), file=sys.stderr)
+    print('\tinclude_paths =', include_paths, file=sys.stderr)
+    print('\tinclude_exts =', include_exts, file=sys.stderr)
+    print('\texclude_paths =', exclude_paths, file=sys.stderr)
+    print(')', file=sys.stderr)
+
+    if stats is None:
+        stats = SearchStats()
+    file_options = dict(all_matches=all_matches,
+                        encodings=encodings,
+                        max_file_size=max_file_size,
+                        extract_cache_dir=extract_cache_dir,
+                        snippets=snippets)
+    if archives:
+        file_options['archive_rules'] = normalize_search_rules(
+            include_paths, include_exts, exclude_paths)[1:3]
+    next_report = [time.perf_counter() + STATS_REPORT_INTERVAL]
+
+    ranker = None
+    visit_order = history
+    if top_k is not None:
+        ranker = TopFiles(top_k, stats)
+        file_options['snippets_per_file'] = RANKED_SNIPPETS_PER_FILE
+        cache = None
+        visit_order = None
+    # Files with hits, as the history keeps them: archives, not the files
+    # inside them
+    history_paths = {} if history is not None else None
+
+    deduplicator = hits_of = None
+    if dedup:
+        # Files skipped as binary or too large mustn't be read in full
+        deduplicator = Deduplicator(
+            HashStore(),
+            lambda path: skipped_without_reading(path, encodings,
+                                                 max_file_size,
+                                                 extract_cache_dir))
+        hits_of = {}  # path -> hits of every file whose hits were passed on
+
+    cache_rules = cached = narrowed = recorded = None
+    if cache is not None:
+        rules = normalize_search_rules(include_paths,
+                                       include_exts,
+                                       exclude_paths,
+                                       follow_symlinks,
+                                       archives)
+        # Hashable, and including the options that decide what is skipped
+        cache_rules = tuple(tuple(rule) if isinstance(rule, list) else rule
+                            for rule in rules) \
+            + (tuple(encodings), max_file_size, extract_cache_dir is None,
+               snippets)
+        cached = cache.get(matcher.cache_key, all_matches, cache_rules)
+        if cached is None:
+            narrowed = cache.get_refinable(matcher.cache_key, cache_rules)
+        # path -> ((mtime_ns, size), hits or None) of every file visited
+        recorded = {}
+
+    def emit_hits(path: str, output_instances: list):
+        """Passes the hits of a file on to `result_callback`, or to the
+        ranking in ranked mode
+        """
+        if hits_of is not None:
+            hits_of[path] = output_instances
+        if history_paths is not None:
+            history_paths[split_member_path(path)[0]] = None
+        if ranker is not None:
+            stats.count('files_with_hits')
+            stats.count('hits', len(output_instances))
+            ranker.add(path, output_instances)
+            return
+        if recorded is not None and path in recorded:
+            recorded[path] = (recorded[path][0], output_instances)
+        stats.count('files_with_hits')
+        stats.count('hits', len(output_instances))
+        clock = time.perf_counter()
+        result_callback(path, output_instances)
+        stats.add_time('emit', time.perf_counter() - clock)
 
     def search_file_func(path: str):
         """This is called in foreach_file with every matching file path.
         """
-        output_instances = search_file_for_string(path, key)
-        if output_instances:
-            result_callback(path, output_instances)
+        for hit_path, output_instances in search_path_for_string(
+                path, matcher, stats=stats, terminate_early=terminate_search,
+                **file_options):
+            emit_hits(hit_path, output_instances)
+
+    def report_copy(path: str, original: str):
+        """Passes on the hits of an earlier file with the same contents
+        """
+        if hits_of.get(original):
+            emit_hits(path, hits_of[original])
+
+    scanner = None
+    report_hits = emit_hits
+    if workers > 1:
+        scanner = PoolScanner(emit_hits, terminate_search, matcher, workers,
+                              file_options, stats)
+        search_file_func = scanner.submit
+        report_hits = scanner.submit_hits
+
+        def report_copy(path: str, original: str):
+            """Queues a file to get the hits of an earlier file with the
+            same contents, once they have been passed on
+            """
+            scanner.submit_copy(path, original, hits_of)
+
+    def visit_copy(path: str) -> bool:
+        """Reports a file with the same contents as an earlier one
+
+        :return: whether the file still needs to be searched
+        """
+        if archives and archive_format(path) is not None:
+            # Its hits are under the paths of the files inside it
+            return True
+        clock = time.perf_counter()
+        hashed = deduplicator.store.bytes_hashed
+        try:
+            original = deduplicator.original_of(path, terminate_search)
+        except OSError:
+            # Reported when the file is searched
+            original = None
+        stats.add_time('hash', time.perf_counter() - clock)
+        stats.count('bytes_hashed', deduplicator.store.bytes_hashed - hashed)
+        if original is None:
+            return True
+        stats.count('files_deduplicated')
+        stats.count('bytes_deduplicated', os.path.getsize(path))
+        report_copy(path, original)
+        return False
+
+    def visit_cached_file(path: str) -> bool:
+        """Looks a file up in the cache and reports its cached hits
+
+        :return: whether the file still needs to be searched
+        """
+        if archives and archive_format(path) is not None:
+            # Its hits are those of the files inside, which aren't recorded
+            return True
+        try:
+            st = os.stat(path)
+        except OSError:
+            return True
+        signature = (st.st_mtime_ns, st.st_size)
+        recorded[path] = (signature, None)
+        if cached is not None:
+            entry = cached.get(path)
+            if entry is not None and entry[0] == signature:
+                stats.count('files_cached')
+                if entry[1]:
+                    report_hits(path, entry[1])
+                return False
+        elif narrowed is not None:
+            entry = narrowed.get(path)
+            if entry is not None and entry[0] == signature and not entry[1]:
+                # Can't contain `key` if it doesn't contain the shorter key
+                stats.count('files_cached')
+                return False
+        return True
+
+    def visit_file(path: str):
+        """Searches a file and reports progress when it is due
+        """
+        if (ranker is not None and index_path is not None
+                and ranker.corpus is None):
+            # The index is up to date once files are visited
+            import Index
+            ranker.set_corpus(*Index.corpus_stats(index_path))
+        stats.count('files_found')
+        if ((recorded is None or visit_cached_file(path))
+                and (deduplicator is None or visit_copy(path))):
+            search_file_func(path)
+        if (progress_callback is not None
+                and time.perf_counter() >= next_report[0]):
+            progress_callback(stats)
+            next_report[0] = time.perf_counter() + STATS_REPORT_INTERVAL
 
-    foreach_file(search_file_func,
-                 terminate_search,
-                 include_paths,
-                 include_exts,
-                 exclude_paths)
+    try:
+        foreach_search_file(visit_file,
+                            terminate_search,
+                            matcher,
+                            include_paths,
+                            include_exts,
+                            exclude_paths,
+                            index_path,
+                            follow_symlinks,
+                            encodings,
+                            archives,
+                            stats,
+                            visit_order,
+                            extract_cache_dir,
+                            max_file_size)
+        if scanner is not None:
+            scanner.finish()
+    finally:
+        if scanner is not None:
+            scanner.close()
+        if deduplicator is not None:
+            deduplicator.store.close()
+        stats.finish()
 
+    if ranker is not None and not terminate_search[0]:
+        clock = time.perf_counter()
+        for _, path, hits in ranker.ranked():
+            result_callback(path, hits)
+        stats.add_time('emit', time.perf_counter() - clock)
+    if cache is not None and not terminate_search[0]:
+        cache.put(matcher.cache_key, all_matches, cache_rules, recorded)
+    if history is not None and not terminate_search[0]:
+        history.record(list(history_paths))
+    if progress_callback is not None:
+        progress_callback(stats)
     finished_callback()
+    return stats
@@ -0,0 +1,124 @@
+"""
+PersonalKnowledgeEngine
+
+In-memory cache of search results; serves "Backend"
+
+Each entry holds, for every file a finished search visited, the file's
+modification time and size and the hits found in it. A later search with
+the same key and rules reuses the hits of every file that hasn't changed
+since, and a search for a longer key that contains a cached key only has to
+read the files that had hits for the cached key, plus any that changed.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+from collections import OrderedDict
+import sys
+import threading
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+RESULT_CACHE_BYTES = 64 << 20  # rough memory the cache may use in total
+CACHE_FILE_OVERHEAD = 120  # estimated bytes per cached file besides its path
+CACHE_HIT_OVERHEAD = 80  # estimated bytes per cached hit besides its snippet
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+def entry_size(files: dict) -> int:
+    """Estimates the memory used by the files of a cache entry, in bytes
+
+    :param files: dict of path -> ((mtime_ns, size), hits or None)
+    """
+    size = sys.getsizeof(files)
+    for path, (_, hits) in files.items():
+        size += len(path) + CACHE_FILE_OVERHEAD
+        for hit in hits or ():
+            # Hits found without snippets have none yet
+            size += len(hit[0] or '') + CACHE_HIT_OVERHEAD
+    return size
+
+
+class ResultCache:
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_BYTES):
+        """Least recently used cache of finished searches.
+
+        Entries are keyed on the search key (a matcher's `cache_key`, see
+        "Matchers"), whether all matches were reported, and `rules`: the
+        normalized include/exclude rules and any other options that decide
+        which files are searched and how. The least recently used entries
+        are dropped once the estimated size of all entries exceeds
+        `max_bytes`. Safe to use from several threads.
+
+        :param max_bytes: rough memory the cache may use in total
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (key, all_matches, rules) -> files
+        self.sizes = {}  # same keys -> estimated size in bytes
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str, all_matches: bool, rules: tuple):
+        """Returns the files of the entry for exactly this search, if any
+
+        :return: dict of path -> ((mtime_ns, size), hits or None), or None
+        """
+        with self.lock:
+            files = self.entries.get((key, all_matches, rules))
+            if files is not None:
+                self.entries.move_to_end((key, all_matches, rules))
+            return files
+
+    def get_refinable(self, key: str, rules: tuple):
+        """Returns the entry of a cached key contained in `key`, if any
+
+        Every file containing `key` also contains such a cached key, so
+        unchanged files without hits for it can be skipped. Of all such
+        entries, the one with the fewest files with hits is returned. Only
+        searches for a single key are refined this way.
+
+        :return: dict of path -> ((mtime_ns, size), hits or None), or None
+        """
+        best = None
+        best_count = None
+        with self.lock:
+            for (cached_key, _, cached_rules), files in self.entries.items():
+                if (cached_rules != rules or not isinstance(key, str)
+                        or not isinstance(cached_key, str)
+                        or cached_key not in key):
+                    continue
+                count = sum(1 for _, hits in files.values() if hits)
+                if best is None or count < best_count:
+                    best = files
+                    best_count = count
+            return best
+
+    def put(self, key: str, all_matches: bool, rules: tuple,
+            files: dict) -> None:
+        """Stores the files of a finished search, evicting old entries
+
+        :param files: dict of path -> ((mtime_ns, size), hits or None)
+        """
+        size = entry_size(files)
+        entry_key = (key, all_matches, rules)
+        with self.lock:
+            if entry_key in self.entries:
+                del self.entries[entry_key]
+                self.total_bytes -= self.sizes.pop(entry_key)
+            if size > self.max_bytes:
+                return
+            self.entries[entry_key] = files
+            self.sizes[entry_key] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                old_key, _ = self.entries.popitem(last=False)
+                self.total_bytes -= self.sizes.pop(old_key)
+
+    def clear(self) -> None:
+        """Drops every entry
+        """
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
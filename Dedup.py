@@ -0,0 +1,189 @@
+"""
+PersonalKnowledgeEngine
+
+Finds files with the same contents, so a search only reads one of them;
+serves "Backend"
+
+Files are grouped by size first: a file is only hashed once a second file
+of the same size turns up, and then so is the first one. Files of the same
+size are then told apart by a BLAKE2 hash of their contents. Hashes are
+kept in a small SQLite database next to each file's size and modification
+time, so a file is only hashed again after it changes. Files the search
+skips without reading them, such as binary files, are never hashed.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import hashlib
+import os
+import sqlite3
+import sys
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+HASH_STORE_PATH = os.path.join(os.path.expanduser('~'), '.cache',
+                               'PersonalKnowledgeEngine', 'hashes.db')
+HASH_DIGEST_BYTES = 16
+HASH_READ_BYTES = 1 << 20  # bytes hashed at a time
+HASH_COMMIT_INTERVAL = 1000  # new hashes written before they are committed
+HASH_STORE_TIMEOUT = 10  # seconds to wait for another search's writes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest BLOB NOT NULL
+);
+"""
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+def hash_file(path: str, terminate_early: list = None):
+    """Returns the BLAKE2 hash of a file's contents
+
+    :param terminate_early: optional single-element list containing a bool
+                            that says whether to stop early. Checked between
+                            reads
+    :return: (digest, bytes hashed), or (None, bytes hashed) if stopped early
+    """
+    hasher = hashlib.blake2b(digest_size=HASH_DIGEST_BYTES)
+    hashed = 0
+    with open(path, 'rb') as f:
+        while True:
+            if terminate_early is not None and terminate_early[0]:
+                return None, hashed
+            chunk = f.read(HASH_READ_BYTES)
+            if not chunk:
+                return hasher.digest(), hashed
+            hasher.update(chunk)
+            hashed += len(chunk)
+
+
+class HashStore:
+
+    def __init__(self, store_path: str = HASH_STORE_PATH):
+        """Content hashes of files, kept on disk between searches.
+
+        If the database can't be opened, e.g. because the disk is read-only,
+        hashes are only kept in memory for as long as this instance lives.
+
+        :param store_path: path of the SQLite database
+        """
+        try:
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            self.conn = sqlite3.connect(store_path,
+                                        timeout=HASH_STORE_TIMEOUT)
+            self.conn.executescript(SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            print(e, file=sys.stderr)
+            self.conn = sqlite3.connect(':memory:')
+            self.conn.executescript(SCHEMA)
+        self.uncommitted = 0
+        self.bytes_hashed = 0
+
+    def digest(self, path: str, terminate_early: list = None):
+        """Returns the hash of a file's contents, hashing it only if it
+        changed since it was last hashed
+
+        :param terminate_early: see `hash_file`
+        :return: the digest, or None if the search was terminated first
+        :raises OSError: if the file can't be read
+        """
+        stat = os.stat(path)
+        row = self.conn.execute(
+            'SELECT size, mtime_ns, digest FROM hashes WHERE path = ?',
+            (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        digest, hashed = hash_file(path, terminate_early)
+        self.bytes_hashed += hashed
+        if digest is None:
+            return None
+        self.conn.execute(
+            'INSERT OR REPLACE INTO hashes (path, size, mtime_ns, digest) '
+            'VALUES (?, ?, ?, ?)',
+            (path, stat.st_size, stat.st_mtime_ns, digest))
+        self.uncommitted += 1
+        if self.uncommitted >= HASH_COMMIT_INTERVAL:
+            self.commit()
+        return digest
+
+    def commit(self) -> None:
+        """Writes the new hashes to disk
+        """
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            # e.g. another search holding the database for too long; the
+            # hashes are simply computed again next time
+            print(e, file=sys.stderr)
+            self.conn.rollback()
+        self.uncommitted = 0
+
+    def close(self) -> None:
+        """Writes the new hashes to disk and closes the database
+        """
+        self.commit()
+        self.conn.close()
+
+
+class Deduplicator:
+
+    def __init__(self, store: HashStore, skipped=None):
+        """Tells which files of a search have the same contents as a file
+        visited before them, see the module docstring
+
+        :param store: where the hashes of files are kept
+        :param skipped: optional function telling from a file's path whether
+                        the search skips it without reading it all. Such
+                        files are never hashed; asked only of files that
+                        would be
+        """
+        self.store = store
+        self.skipped = skipped
+        # size -> path of the only file seen with that size, until a second
+        # one turns up and both are hashed; then None
+        self.first_of_size = {}
+        self.content_paths = {}  # digest -> first path with those contents
+
+    def hashable(self, path: str) -> bool:
+        """Returns whether the search reads a file, so it may be hashed
+        """
+        return self.skipped is None or not self.skipped(path)
+
+    def original_of(self, path: str, terminate_early: list = None):
+        """Returns the path of an earlier file with the same contents as
+        `path`, or None if `path` is the first with its contents
+
+        Files must be passed in the order they are visited. A file for which
+        None is returned must be searched, so its hits can be given for the
+        later files with the same contents.
+
+        :param terminate_early: see `hash_file`. None is returned if the
+                                search was terminated while hashing
+        :raises OSError: if the file can't be read
+        """
+        size = os.stat(path).st_size
+        if size not in self.first_of_size:
+            self.first_of_size[size] = path
+            return None
+        first = self.first_of_size[size]
+        if first is not None:
+            self.first_of_size[size] = None
+            try:
+                first_digest = self.store.digest(
+                    first, terminate_early) if self.hashable(first) else None
+            except OSError:
+                # Gone since it was searched; it can't be the original
+                first_digest = None
+            if first_digest is not None:
+                self.content_paths.setdefault(first_digest, first)
+        if not self.hashable(path):
+            return None
+        digest = self.store.digest(path, terminate_early)
+        if digest is None:
+            return None
+        original = self.content_paths.setdefault(digest, path)
+        return original if original != path else None
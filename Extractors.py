@@ -0,0 +1,317 @@
+"""
+PersonalKnowledgeEngine
+
+Plain text extraction from document formats; serves "Backend" and "Index"
+
+Word (.docx) and PowerPoint (.pptx) files are zip archives of XML and are
+read with the standard library. PDF files are read with the optional pypdf
+package; without it they are skipped as binary files, like before.
+
+An extractor turns a document into (location, text) units, e.g. one per
+paragraph, slide or page. The text of a document is written to an on-disk
+cache as a UTF-8 file with one line per line of text, next to a small JSON
+file that maps its line numbers back to the locations. Cache entries are
+keyed by the document's absolute path, size and modification time, so each
+version of a document is parsed once and later searches memory-map the cached
+text like any other text file. Entries for old versions are left behind;
+deleting the cache directory is always safe.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+from bisect import bisect_right
+import hashlib
+import importlib.util
+import json
+import os
+import posixpath
+import re
+import tempfile
+import zipfile
+
+try:
+    # Guards against entity expansion attacks in untrusted documents
+    from defusedxml import ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+EXTRACT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'PersonalKnowledgeEngine', 'extracted')
+# Part of every cache key; raise it when extractors change their output
+EXTRACT_CACHE_VERSION = 1
+TEXT_SUFFIX = '.txt'
+LOCATIONS_SUFFIX = '.json'
+# Largest XML part of a document that is parsed, uncompressed
+MAX_PART_BYTES = 256 << 20
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DRAWING_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+PRESENTATION_NS = \
+    '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+RELATIONSHIPS_NS = \
+    '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_RELATIONSHIPS_NS = \
+    '{http://schemas.openxmlformats.org/package/2006/relationships}'
+SLIDE_NAME_REGEX = re.compile(r'ppt/slides/slide(\d+)\.xml$')
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+class ExtractionError(Exception):
+    """Raised when the text of a document can't be extracted, e.g. because
+    the file is damaged
+    """
+
+
+def read_part(archive: zipfile.ZipFile, name: str):
+    """Parses an XML part of an Office document
+
+    :param archive: the document, opened as a zip archive
+    :param name: name of the part inside the archive
+    :return: the root Element of the part
+    """
+    if archive.getinfo(name).file_size > MAX_PART_BYTES:
+        raise ExtractionError('%s is larger than %d bytes'
+                              % (name, MAX_PART_BYTES))
+    return ElementTree.fromstring(archive.read(name))
+
+
+def xml_paragraphs(root, namespace: str) -> list:
+    """Returns the text of every paragraph of an Office XML part
+
+    Paragraphs inside other paragraphs, such as those of text boxes, are
+    listed before the paragraph that holds them, and their text is left out
+    of it.
+
+    :param root: root Element of the part
+    :param namespace: '{uri}' of the paragraph, text, tab and break elements,
+                      i.e. WORD_NS or DRAWING_NS
+    :return: list of paragraph texts, with line breaks as '\n'
+    """
+    paragraph_tag = namespace + 'p'
+    text_tag = namespace + 't'
+    tab_tag = namespace + 'tab'
+    break_tags = (namespace + 'br', namespace + 'cr')
+    paragraphs = []
+
+    def walk(element, parts: list):
+        """Adds the text under `element` to `parts`
+        """
+        for child in element:
+            if child.tag == paragraph_tag:
+                child_parts = []
+                walk(child, child_parts)
+                paragraphs.append(''.join(child_parts))
+                continue
+            if child.tag == text_tag:
+                parts.append(child.text or '')
+            elif child.tag == tab_tag:
+                parts.append('\t')
+            elif child.tag in break_tags:
+                parts.append('\n')
+            walk(child, parts)
+
+    walk(root, [])
+    return paragraphs
+
+
+def extract_docx(path: str):
+    """Yields ('paragraph N', text) for every paragraph of a Word document
+    """
+    with zipfile.ZipFile(path) as archive:
+        root = read_part(archive, 'word/document.xml')
+    for number, text in enumerate(xml_paragraphs(root, WORD_NS), 1):
+        yield 'paragraph %d' % number, text
+
+
+def slide_parts(archive: zipfile.ZipFile) -> list:
+    """Returns the names of the slides of a presentation, in slide order
+
+    The order is the one the presentation lists them in, or that of their
+    file names if it doesn't list them.
+    """
+    names = set(archive.namelist())
+    ordered = []
+    if ('ppt/presentation.xml' in names
+            and 'ppt/_rels/presentation.xml.rels' in names):
+        targets = {
+            relationship.get('Id'): relationship.get('Target', '')
+            for relationship in read_part(
+                archive, 'ppt/_rels/presentation.xml.rels').iter(
+                    PACKAGE_RELATIONSHIPS_NS + 'Relationship')
+        }
+        presentation = read_part(archive, 'ppt/presentation.xml')
+        for slide_id in presentation.iter(PRESENTATION_NS + 'sldId'):
+            target = targets.get(slide_id.get(RELATIONSHIPS_NS + 'id'), '')
+            # Targets are relative to "ppt/", or absolute in the archive
+            name = posixpath.normpath(posixpath.join('ppt', target)) \
+                if not target.startswith('/') else target[1:]
+            if name in names:
+                ordered.append(name)
+    if not ordered:
+        numbered = [(int(match.group(1)), match.group(0))
+                    for match in map(SLIDE_NAME_REGEX.match, names) if match]
+        ordered = [name for _, name in sorted(numbered)]
+    return ordered
+
+
+def extract_pptx(path: str):
+    """Yields ('slide N', text) for every paragraph of a PowerPoint
+    presentation
+    """
+    with zipfile.ZipFile(path) as archive:
+        slides = [read_part(archive, name) for name in slide_parts(archive)]
+    for number, root in enumerate(slides, 1):
+        for text in xml_paragraphs(root, DRAWING_NS):
+            yield 'slide %d' % number, text
+
+
+def extract_pdf(path: str):
+    """Yields ('page N', text) for every page of a PDF file
+    """
+    # Imported here since it is slow to import and most searches read no
+    # PDF files
+    import pypdf
+    reader = pypdf.PdfReader(path)
+    for number, page in enumerate(reader.pages, 1):
+        yield 'page %d' % number, page.extract_text() or ''
+
+
+# File extension -> function that takes the path of a file and yields
+# (location, text) pairs, see `register_extractor`
+EXTRACTORS = {
+    '.docx': extract_docx,
+    '.pptx': extract_pptx,
+}
+# Optional; PDF files are skipped as binary files without it
+if importlib.util.find_spec('pypdf') is not None:
+    EXTRACTORS['.pdf'] = extract_pdf
+
+
+def register_extractor(extension: str, extractor) -> None:
+    """Makes searches read files with the given extension through
+    `extractor`
+
+    Worker processes start from a fresh import of this module, so
+    extractors registered at run time are only used by searches with a
+    single worker; permanent ones belong in EXTRACTORS. Raise
+    EXTRACT_CACHE_VERSION when changing an extractor.
+
+    :param extension: file extension including the dot, e.g. '.odt'. Case
+                      doesn't matter
+    :param extractor: function that takes the path of a file and yields
+                      (location, text) pairs in document order, with the
+                      location a short string such as 'page 3'
+    """
+    EXTRACTORS[extension.lower()] = extractor
+
+
+def extractor_for(path: str):
+    """Returns the extractor for a file, or None if it is read as it is
+    """
+    return EXTRACTORS.get(os.path.splitext(path)[1].lower())
+
+
+class ExtractedText:
+
+    def __init__(self, text_path: str, locations: list):
+        """The cached text of a document
+
+        :param text_path: path of the UTF-8 text file
+        :param locations: [[first line number, location], ...] sorted by
+                          line number, so each line belongs to the location
+                          of the last entry at or before it
+        """
+        self.text_path = text_path
+        self.first_lines = [first_line for first_line, _ in locations]
+        self.locations = [location for _, location in locations]
+
+    def location(self, line_num: int):
+        """Returns the location of a line of the text, or None
+        """
+        index = bisect_right(self.first_lines, line_num) - 1
+        return self.locations[index] if index >= 0 else None
+
+    def located(self, hits: list) -> list:
+        """Returns Backend.SearchHits in the text with their locations set
+        """
+        return [hit._replace(location=self.location(hit.line))
+                for hit in hits]
+
+
+def cache_entry_path(path: str, stat: os.stat_result, cache_dir: str) -> str:
+    """Returns the path of a document's cache entry, without the suffix
+    """
+    signature = repr((EXTRACT_CACHE_VERSION, os.path.abspath(path),
+                      stat.st_size, stat.st_mtime_ns))
+    digest = hashlib.sha1(signature.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest)
+
+
+def write_atomically(path: str, data: bytes) -> None:
+    """Writes a file so other processes either see all of it or none of it
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def extract_document(path: str, extractor) -> tuple:
+    """Runs an extractor over a document
+
+    :return: (text with one line per line of text, [[first line number,
+             location], ...]), see ExtractedText. Blank lines are left out
+    """
+    lines = []
+    locations = []
+    for location, text in extractor(path):
+        for line in text.splitlines():
+            if line.strip():
+                if not locations or locations[-1][1] != location:
+                    locations.append([len(lines) + 1, location])
+                lines.append(line)
+    return ''.join(line + '\n' for line in lines), locations
+
+
+def extracted_text(path: str, cache_dir: str = EXTRACT_CACHE_DIR):
+    """Returns the text of a document, extracting it on first use
+
+    :param path: path of a document that has an extractor, see
+                 `extractor_for`
+    :param cache_dir: directory the extracted text is cached in
+    :return: ExtractedText
+    :raises ExtractionError: if the document can't be read. The failure is
+                             cached as well, so a damaged document isn't
+                             parsed again until it changes
+    """
+    entry = cache_entry_path(path, os.stat(path), cache_dir)
+    try:
+        with open(entry + LOCATIONS_SUFFIX, encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+    if cached is None:
+        try:
+            text, locations = extract_document(path, extractor_for(path))
+            cached = dict(locations=locations, error=None)
+        except OSError:
+            raise
+        except Exception as e:
+            # Parsers of damaged or hostile files raise all sorts of errors
+            text = ''
+            cached = dict(locations=[], error='%s: %s' % (type(e).__name__, e))
+        # The text is in place before the locations say the entry is done
+        write_atomically(entry + TEXT_SUFFIX, text.encode('utf-8'))
+        write_atomically(entry + LOCATIONS_SUFFIX,
+                         json.dumps(cached).encode('utf-8'))
+    if cached['error'] is not None:
+        raise ExtractionError('%s: %s' % (path, cached['error']))
+    return ExtractedText(entry + TEXT_SUFFIX, cached['locations'])
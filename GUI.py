@@ -11,29 +11,69 @@ https://www.pythonguis.com/tutorials/multithreading-pyqt-applications-qthreadpoo
 import sys
 import subprocess
 import os
+import re
+import threading
+import time
 import traceback
+from functools import partial
 from PyQt5 import QtCore
 from PyQt5.QtCore import (
+    QAbstractItemModel,
+    QModelIndex,
     QSize,
     QObject,
     pyqtSignal,
     pyqtSlot,
     QRunnable,
     QThreadPool,
+    QTimer,
 )
+from PyQt5.QtGui import QTextDocument
 from PyQt5.QtWidgets import (
+    QAbstractItemView,
     QMainWindow,
+    QCheckBox,
     QLabel,
     QGridLayout,
     QWidget,
     QPushButton,
     QLineEdit,
-    QScrollArea,
-    QFormLayout,
     QGroupBox,
     QVBoxLayout,
+    QStyle,
+    QStyledItemDelegate,
+    QTreeView,
 )
+from Archives import split_member_path
 from Backend import search_for_string
+from Cache import ResultCache
+from Extractors import EXTRACT_CACHE_DIR
+from History import ScanHistory
+from Matchers import make_matcher
+from Paging import search_page
+from Query import Query, QueryError
+from Results import ResultStore
+from Stats import SearchStats
+
+
+# Number of processes each search spreads its file reads across. Every
+# search with more than one starts a pool whose processes import the GUI
+# again, which costs more than most interactive searches take; use
+# `cli.py --workers` for large trees
+SEARCH_WORKERS = 1
+HIT_BATCH_SIZE = 500  # hits sent to the GUI thread in one signal at most
+HIT_BATCH_INTERVAL = 0.05  # seconds a hit may wait before its batch is sent
+# Batches that may wait in the GUI event queue before the backend pauses
+MAX_PENDING_HIT_BATCHES = 4
+BYTES_PER_MB = 1 << 20
+# Milliseconds without typing before a search-as-you-type search starts
+SEARCH_AS_YOU_TYPE_DELAY_MS = 250
+RANKED_RESULTS = 20  # files shown when only the best matches are wanted
+FUZZY_MAX_DISTANCE = 1  # typos a key may have when typos are allowed
+PAGE_HITS_SHOWN = 500  # hits loaded at a time when loading as you scroll
+# Rows from the end of the results the view may be scrolled to before the
+# next page is loaded
+PAGE_LOAD_MARGIN = 100
 
 
 class BackendWorkerSignals(QObject):
@@ -42,8 +82,17 @@ class BackendWorkerSignals(QObject):
 
     Supported signals:
 
-    search_hit: file_path : str, (line_num : int, line: str)
-        emitted when the search function finds a search hit
+    search_hits: [(file_path : str, (line: str, line_num : int)), ...]
+        emitted with a batch of search hits. At most MAX_PENDING_HIT_BATCHES
+        batches are in flight at once; `batchConsumed` frees up a slot
+
+    progress: dict
+        emitted every few moments while the search runs, and when it ends,
+        with the search's stats (see `Stats.SearchStats.to_dict`)
+
+    next_page: PageWorker or None
+        emitted by a PageWorker when its page is over, with a worker for
+        the page after it, or None if there is none
 
     finished: None
         emitted when the search function completes
@@ -51,15 +100,35 @@ class BackendWorkerSignals(QObject):
     error: tuple (exctype, value, traceback.format_exc() )
         emitted when an exception is raised in the backend
     """
-    search_hit = pyqtSignal(str, tuple)
+    search_hits = pyqtSignal(list)
+    progress = pyqtSignal(dict)
+    next_page = pyqtSignal(object)
     finished = pyqtSignal()
     error = pyqtSignal(tuple)
 
+    def __init__(self):
+        """Creates the signals and the count of hit batches in flight
+        """
+        super(BackendWorkerSignals, self).__init__()
+        self.pending_batches = threading.Semaphore(MAX_PENDING_HIT_BATCHES)
+        self.search_hits.connect(self.batchConsumed)
+
+    @pyqtSlot(list)
+    def batchConsumed(self, batch):
+        """Frees a slot for another hit batch once the GUI thread has one
+
+        :param batch: the batch that was delivered
+        """
+        self.pending_batches.release()
+
 
 class BackendWorker(QRunnable):
 
     def __init__(self, terminate_search, key,
-                 include_paths, include_exts, exclude_paths):
+                 include_paths, include_exts, exclude_paths,
+                 workers=1, cache=None, ignore_case=False, regex=False,
+                 top_k=None, archives=False, query=False,
+                 max_distance=None, history=None):
         """Runs and communicates with the backend in a new thread.
 
         :param terminate_search: single-element list containing a bool that
@@ -70,6 +139,17 @@ class BackendWorker(QRunnable):
         :param include_exts: list of file extensions in the form e.g. '.txt'
                              may instead be `None` to search all files
         :param exclude_paths: list of paths to exclude from the search
+        :param workers: number of processes the backend searches files with
+        :param cache: optional Cache.ResultCache shared between searches
+        :param ignore_case: whether to match regardless of case
+        :param regex: whether `key` is a regular expression
+        :param top_k: if set, only this many files are shown, the most
+                      relevant first, once the search is over
+        :param archives: whether to search the files inside archives
+        :param query: whether `key` is a boolean query
+        :param max_distance: if set, the most typos a match may have
+        :param history: optional History.ScanHistory shared between
+                        searches, to search likely files first with
         """
         super(BackendWorker, self).__init__()
         self.terminate_search = terminate_search
@@ -77,30 +157,95 @@ class BackendWorker(QRunnable):
         self.include_paths = include_paths
         self.include_exts = include_exts
         self.exclude_paths = exclude_paths
+        self.workers = workers
+        self.cache = cache
+        self.ignore_case = ignore_case
+        self.regex = regex
+        self.top_k = top_k
+        self.archives = archives
+        self.query = query
+        self.max_distance = max_distance
+        self.history = history
         self.signals = BackendWorkerSignals()
+        self.hit_batch = []
+        self.last_flush = time.monotonic()
+        # Guards the batch against the backend and `flushPeriodically`
+        # flushing it at the same time
+        self.batch_lock = threading.RLock()
+        self.search_over = threading.Event()
 
     def resultCallback(self, path, search_hits):
-        """Emits a `search_hit` signal containing the file path and context.
+        """Queues search hits to be sent to the GUI in batches.
 
-        Called by the backend whenever a search hit is found.
+        Called by the backend whenever a file has search hits. The batch is
+        sent once it is full or has been waiting for HIT_BATCH_INTERVAL.
 
         :param path: path of file containing the search hit
         :param search_hits: info about the file's context of the search hit
         """
-        for hit in search_hits:
-            self.signals.search_hit.emit(path, hit)
+        with self.batch_lock:
+            for hit in search_hits:
+                self.hit_batch.append((path, hit))
+            if (len(self.hit_batch) >= HIT_BATCH_SIZE
+                    or time.monotonic() - self.last_flush
+                    >= HIT_BATCH_INTERVAL):
+                self.flushHits()
+
+    def flushPeriodically(self):
+        """Sends the queued hits once they have waited for
+        HIT_BATCH_INTERVAL, even while the backend finds no more hits, e.g.
+        during a long walk or a large file without any.
+
+        Runs in its own thread until `search_over` is set.
+        """
+        while not self.search_over.wait(HIT_BATCH_INTERVAL):
+            with self.batch_lock:
+                if (self.hit_batch and time.monotonic() - self.last_flush
+                        >= HIT_BATCH_INTERVAL):
+                    self.flushHits()
+
+    def flushHits(self):
+        """Emits the queued hits as `search_hits` signals.
+
+        Blocks while MAX_PENDING_HIT_BATCHES batches are still waiting for
+        the GUI thread, so a slow GUI slows down the backend instead of
+        filling the event queue. Queued hits are dropped if the search is
+        cancelled while waiting.
+        """
+        with self.batch_lock:
+            while self.hit_batch:
+                while not self.signals.pending_batches.acquire(
+                        timeout=HIT_BATCH_INTERVAL):
+                    if self.terminate_search[0]:
+                        self.hit_batch = []
+                        return
+                self.signals.search_hits.emit(
+                    self.hit_batch[:HIT_BATCH_SIZE])
+                self.hit_batch = self.hit_batch[HIT_BATCH_SIZE:]
+            self.last_flush = time.monotonic()
+
+    def progressCallback(self, stats):
+        """Sends a snapshot of the search's stats to the GUI.
+
+        Called by the backend periodically while the search runs.
+
+        :param stats: the search's Stats.SearchStats
+        """
+        self.signals.progress.emit(stats.to_dict())
 
     def finishedCallback(self):
-        """Emits a `finished` signal.
+        """Sends any queued hits, then emits a `finished` signal.
 
         Called by the backend when the search completes.
         """
+        self.flushHits()
         self.signals.finished.emit()
 
     @pyqtSlot()
     def run(self):
         """Calls the backend search function in a separate thread
         """
+        threading.Thread(target=self.flushPeriodically, daemon=True).start()
         try:
             search_for_string(
                 self.resultCallback,
@@ -110,7 +255,80 @@ class BackendWorker(QRunnable):
                 self.include_paths,
                 self.include_exts,
                 self.exclude_paths,
+                workers=self.workers,
+                ignore_case=self.ignore_case,
+                regex=self.regex,
+                top_k=self.top_k,
+                archives=self.archives,
+                query=self.query,
+                max_distance=self.max_distance,
+                extract_cache_dir=EXTRACT_CACHE_DIR,
+                snippets=False,
+                progress_callback=self.progressCallback,
+                cache=self.cache,
+                history=self.history,
+            )
+        except Exception:
+            traceback.print_exc()
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+        finally:
+            self.search_over.set()
+            self.signals.finished.emit()
+
+
+class PageWorker(BackendWorker):
+
+    def __init__(self, cursor, *args, **kwargs):
+        """Runs one page of a search in a new thread, see "Paging".
+
+        Takes the arguments of BackendWorker, of which `workers`, `cache`,
+        `top_k` and `history` are ignored.
+
+        :param cursor: cursor of the page, or None for the first one
+        """
+        super(PageWorker, self).__init__(*args, **kwargs)
+        self.cursor = cursor
+
+    def nextPage(self, cursor):
+        """Returns a worker for the page starting at `cursor`, sharing this
+        one's `terminate_search`
+        """
+        return PageWorker(cursor, self.terminate_search, self.key,
+                          self.include_paths, self.include_exts,
+                          self.exclude_paths, ignore_case=self.ignore_case,
+                          regex=self.regex, archives=self.archives,
+                          query=self.query, max_distance=self.max_distance)
+
+    @pyqtSlot()
+    def run(self):
+        """Searches for the page's hits and sends them to the GUI
+        """
+        try:
+            stats = SearchStats()
+            self.hit_batch, cursor = search_page(
+                self.key,
+                self.include_paths,
+                self.include_exts,
+                self.exclude_paths,
+                cursor=self.cursor,
+                max_hits=PAGE_HITS_SHOWN,
+                terminate_search=self.terminate_search,
+                ignore_case=self.ignore_case,
+                regex=self.regex,
+                archives=self.archives,
+                query=self.query,
+                max_distance=self.max_distance,
+                extract_cache_dir=EXTRACT_CACHE_DIR,
+                snippets=False,
+                stats=stats,
             )
+            self.flushHits()
+            self.progressCallback(stats)
+            # A search that was told to stop has no more pages
+            self.signals.next_page.emit(
+                None if cursor is None or self.terminate_search[0]
+                else self.nextPage(cursor))
         except Exception:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
@@ -127,6 +345,17 @@ class PkeAppWindow(QMainWindow):
         QMainWindow.__init__(self)
 
         self.threadpool = QThreadPool()
+        # Lets repeated and refined searches skip files they already read
+        self.resultCache = ResultCache()
+        # Where earlier searches found hits, for searches that look at the
+        # files likely to have hits first
+        self.scanHistory = ScanHistory()
+        # Only the newest search may show hits; older ones are superseded
+        self.currentWorker = None
+        # For a search shown a page at a time: the worker loading a page
+        # after the first, and the one to start when more hits are wanted
+        self.pageWorker = None
+        self.nextPage = None
 
         self.setMinimumSize(QSize(640, 480))
         self.setWindowTitle('Personal Knowledge Engine')
@@ -139,11 +368,17 @@ class PkeAppWindow(QMainWindow):
 
         self.searchResults = SearchResultsWidget()
         gridLayout.addWidget(self.searchResults, 1, 0)
+        scrollBar = self.searchResults.view.verticalScrollBar()
+        scrollBar.valueChanged.connect(self.loadMore)
+        scrollBar.rangeChanged.connect(self.loadMore)
 
         self.searchBar = SearchBarWidget(self)
         gridLayout.addWidget(self.searchBar, 0, 0)
 
-    def runSearch(self, key, include_paths, include_exts, exclude_paths):
+    def runSearch(self, key, include_paths, include_exts, exclude_paths,
+                  terminate_search, ignore_case=False, regex=False,
+                  top_k=None, archives=False, query=False,
+                  max_distance=None, paged=False, likely_first=False):
         """Spawns a worker thread in the threadpool for the backend
 
         :param key: string to search for
@@ -151,22 +386,151 @@ class PkeAppWindow(QMainWindow):
         :param include_exts: list of file extensions in the form e.g. '.txt'
                              may instead be `None` to search all files
         :param exclude_paths: list of paths to exclude from the search
+        :param terminate_search: single-element list containing a bool that
+                                 tells this search to stop. Each search has
+                                 its own, so a search that was told to stop
+                                 can't be started again by mistake
+        :param ignore_case: whether to match regardless of case
+        :param regex: whether `key` is a regular expression
+        :param top_k: if set, only this many files are shown, the most
+                      relevant first, once the search is over
+        :param archives: whether to search the files inside archives
+        :param query: whether `key` is a boolean query
+        :param max_distance: if set, the most typos a match may have
+        :param paged: whether to show the hits a page at a time, loading
+                      the next page when the results are scrolled near
+                      their end. Ignored if `top_k` is set
+        :param likely_first: whether to search the files that had hits in
+                             earlier searches first, see "History"
         """
-        worker = BackendWorker(
-            self.searchBar.terminate_search,
+        self.dropPages()
+        worker_class = BackendWorker
+        if paged and top_k is None:
+            worker_class = partial(PageWorker, None)
+        worker = worker_class(
+            terminate_search,
             key,
             include_paths,
             include_exts,
             exclude_paths,
+            workers=SEARCH_WORKERS,
+            cache=self.resultCache,
+            ignore_case=ignore_case,
+            regex=regex,
+            top_k=top_k,
+            archives=archives,
+            query=query,
+            max_distance=max_distance,
+            history=self.scanHistory if likely_first else None,
         )
-        worker.signals.search_hit.connect(self.searchResults.addOneResult)
-        worker.signals.finished.connect(self.searchBar.searchCompletedCallback)
+        self.connectWorker(worker)
+        self.currentWorker = worker
+
+        # The hits come without snippets; these are built when a hit is
+        # shown, bolded the way the search would have
+        terms = list(Query(key).terms) if query else key
+        results = ResultStore(
+            extract_cache_dir=EXTRACT_CACHE_DIR,
+            bold_regex=make_matcher(terms, ignore_case, regex,
+                                    max_distance).bold_regex)
 
         # self.searchResults.clearResults()
-        self.searchResults.addHeader(key, include_paths, include_exts, exclude_paths)
+        self.searchResults.addHeader(key, include_paths, include_exts,
+                                     exclude_paths, results)
 
         self.threadpool.start(worker)
 
+    def connectWorker(self, worker):
+        """Connects the signals of a worker about to be started
+        """
+        # Tagged with the worker, so signals a superseded search sends
+        # after the newer one started are dropped
+        worker.signals.search_hits.connect(partial(self.workerHits, worker))
+        worker.signals.progress.connect(partial(self.workerProgress, worker))
+        worker.signals.next_page.connect(partial(self.workerNextPage, worker))
+        worker.signals.finished.connect(partial(self.workerFinished, worker))
+
+    def loadMore(self, *args):
+        """Starts loading the next page of the search shown a page at a
+        time, if the results are scrolled near their end and no other
+        search is running
+        """
+        if (self.nextPage is None or self.pageWorker is not None
+                or self.currentWorker is not None
+                or not self.searchResults.scrolledNearEnd()):
+            return
+        self.pageWorker, self.nextPage = self.nextPage, None
+        self.connectWorker(self.pageWorker)
+        self.threadpool.start(self.pageWorker)
+
+    def dropPages(self):
+        """Stops loading pages of the last search, e.g. because its results
+        are going away
+        """
+        if self.pageWorker is not None:
+            self.pageWorker.terminate_search[0] = True
+        self.pageWorker = None
+        self.nextPage = None
+
+    def supersedeSearch(self):
+        """Stops the running search and removes its results, so a new one
+        can take its place
+        """
+        worker = self.currentWorker
+        if worker is None:
+            return
+        self.currentWorker = None
+        worker.terminate_search[0] = True
+        self.dropPages()
+        self.searchResults.removeLastSearch()
+
+    def workerHits(self, worker, batch):
+        """Shows a batch of hits if it comes from the current search
+        """
+        if worker is self.currentWorker or worker is self.pageWorker:
+            self.searchResults.addResultBatch(batch)
+
+    def workerProgress(self, worker, stats):
+        """Shows the progress of the current search
+        """
+        if worker is self.currentWorker or worker is self.pageWorker:
+            self.showProgress(stats)
+
+    def workerNextPage(self, worker, next_page):
+        """Keeps the worker for the next page of the current search
+        """
+        if worker is self.currentWorker or worker is self.pageWorker:
+            self.nextPage = next_page
+
+    def workerFinished(self, worker):
+        """Updates the search bar when the current search is over, and
+        loads the next page if the results are still near their end
+        """
+        if worker is self.currentWorker:
+            self.currentWorker = None
+            self.searchBar.searchCompletedCallback()
+        elif worker is self.pageWorker:
+            self.pageWorker = None
+        else:
+            return
+        # After the view has laid out the new rows
+        QTimer.singleShot(0, self.loadMore)
+
+    def showProgress(self, stats):
+        """Shows how fast the search is going in the status bar
+
+        :param stats: dict of the search's stats, see `Stats.SearchStats`
+        """
+        self.statusBar().showMessage(
+            '%s %d files (%.0f files/s, %.1f MB/s), %d hits in %.1fs' % (
+                'Searched' if stats['finished'] else 'Searching:',
+                stats['counters']['files_searched'],
+                stats['files_per_sec'],
+                stats['bytes_per_sec'] / BYTES_PER_MB,
+                stats['counters']['hits'],
+                stats['elapsed'],
+            ))
+
 
 class SearchBarWidget(QWidget):
 
@@ -191,7 +555,7 @@ class SearchBarWidget(QWidget):
         gridLayout.addWidget(title, 0, 0)
 
         # The basic GUI elements
-        self.setMinimumSize(QSize(300, 270))
+        self.setMinimumSize(QSize(300, 300))
         self.setWindowTitle('PKE Search Engine')
 
         # Text box to put in what to search for
@@ -203,6 +567,7 @@ class SearchBarWidget(QWidget):
         self.search_line.move(90, 20)
         self.search_line.resize(200, 32)
         self.search_line.returnPressed.connect(self.searchButtonClicked)
+        self.search_line.textChanged.connect(self.searchTextChanged)
 
         # Text box to put in which paths to include
         includePathsLabel = QLabel(self)
@@ -250,6 +615,8 @@ class SearchBarWidget(QWidget):
 
         self.search_is_running = False
         self.terminate_search = [False]
+        # Whether the last search was started by typing, not by a button
+        self.last_search_typed = False
 
         #BUTTONS
         #to start the search:
@@ -269,7 +636,63 @@ class SearchBarWidget(QWidget):
         self.clearbutton = QPushButton('Clear Search', self)
         self.clearbutton.resize(180, 32)
         self.clearbutton.move(195, 245)
-        self.clearbutton.clicked.connect(self.app_widget.searchResults.clearResults)
+        self.clearbutton.clicked.connect(self.clearButtonClicked)
+
+        #to search while typing; starting a search then cancels the
+        #running one instead of waiting for it
+        self.supersedeBox = QCheckBox('Search as you type', self)
+        self.supersedeBox.move(400, 225)
+        self.supersedeBox.resize(200, 32)
+
+        #to match regardless of case, and to search for a regular
+        #expression instead of a plain string
+        self.ignoreCaseBox = QCheckBox('Ignore case', self)
+        self.ignoreCaseBox.move(10, 220)
+        self.ignoreCaseBox.resize(180, 32)
+        self.regexBox = QCheckBox('Regular expression', self)
+        self.regexBox.move(10, 245)
+        self.regexBox.resize(180, 32)
+
+        #to show only the most relevant files once the search is over,
+        #instead of every hit as it is found
+        self.rankedBox = QCheckBox('Best matches only', self)
+        self.rankedBox.move(400, 250)
+        self.rankedBox.resize(200, 32)
+
+        #to search for a boolean query with AND, OR, NOT, NEAR/n and
+        #"quoted phrases" instead of a plain string
+        self.queryBox = QCheckBox('Boolean query', self)
+        self.queryBox.move(10, 195)
+        self.queryBox.resize(180, 32)
+
+        #to also find misspelled instances of the key
+        self.fuzzyBox = QCheckBox('Allow typos', self)
+        self.fuzzyBox.move(195, 195)
+        self.fuzzyBox.resize(180, 32)
+
+        #to search the files inside zip, tar and gzip files as well
+        self.archivesBox = QCheckBox('Search inside archives', self)
+        self.archivesBox.move(400, 195)
+        self.archivesBox.resize(200, 32)
+
+        #to load the hits a page at a time as the results are scrolled,
+        #instead of all of them at once
+        self.pagedBox = QCheckBox('Load hits as you scroll', self)
+        self.pagedBox.move(400, 275)
+        self.pagedBox.resize(200, 32)
+
+        #to search the files earlier searches found hits in first, so the
+        #first hits show sooner; off by default, since every other file
+        #then waits for the walk to finish
+        self.likelyFirstBox = QCheckBox('Likely files first', self)
+        self.likelyFirstBox.move(10, 275)
+        self.likelyFirstBox.resize(180, 32)
+
+        #waits for a pause in typing before searching
+        self.typingTimer = QTimer(self)
+        self.typingTimer.setSingleShot(True)
+        self.typingTimer.setInterval(SEARCH_AS_YOU_TYPE_DELAY_MS)
+        self.typingTimer.timeout.connect(self.typingPaused)
 
     def searchCompletedCallback(self):
         """Updates the GUI to reflect the completion of a search
@@ -282,9 +705,51 @@ class SearchBarWidget(QWidget):
             self.startbutton.show()
             print('search finished')
 
+    def searchTextChanged(self, text):
+        """Restarts the typing timer when searching as you type
+
+        :param text: new contents of the search bar
+        """
+        if self.supersedeBox.isChecked():
+            self.typingTimer.start()
+
+    def typingPaused(self):
+        """Searches for what has been typed so far
+        """
+        self.startSearch(typed=True)
+
     def searchButtonClicked(self):
         """Function that's called when the search button is pressed.
         """
+        self.startSearch()
+
+    def startSearch(self, typed=False):
+        """Starts a search with the criteria in the search bar
+
+        A search that is still running is cancelled first if searching as
+        you type; otherwise nothing happens until it is over.
+
+        :param typed: whether the search was started by typing. Its results
+                      replace those of the last typed search, and it isn't
+                      added to the saved searches
+        """
+        if self.search_is_running:
+            if not self.supersedeBox.isChecked():
+                return
+            # The running search's results go away along with it
+            self.app_widget.supersedeSearch()
+            self.search_is_running = False
+            self.last_search_typed = False
+        # The last search's next pages would go under the new one's header
+        self.app_widget.dropPages()
+        if typed and self.last_search_typed:
+            self.app_widget.searchResults.removeLastSearch()
+        self.last_search_typed = False
+        if typed and self.search_line.text() == '':
+            # Typing cleared the search bar; there is nothing to look for
+            self.cancelbutton.hide()
+            self.startbutton.show()
+            return
         if not self.search_is_running:
             (
                 key,
@@ -294,37 +759,72 @@ class SearchBarWidget(QWidget):
             ) = self.getSearchInfo()
 
             #adds search info to list of previous searches
-            self.saved_searches.append(
-                (key,
-                include_paths,
-                include_exts,
-                exclude_paths,)
-                )
+            if not typed:
+                self.saved_searches.append(
+                    (key,
+                    include_paths,
+                    include_exts,
+                    exclude_paths,)
+                    )
 
             # sets the editor program
-            if self.app_widget.searchResults.setEditor(self.editor_line.text()):
-                self.currentEditor.setText("Current Editor: " + os.path.basename(self.editor_line.text()))
+            editor = self.editor_line.text()
+            if self.app_widget.searchResults.setEditor(editor):
+                self.currentEditor.setText(
+                    "Current Editor: " + os.path.basename(editor))
 
             # format file extensions properly
             include_exts = ['.' + ext for ext in include_exts]
+            self.last_search_typed = typed
+
+            def showSearchError(message):
+                """Shows the search's header with `message` as its only
+                result, for a search that can't be started
+                """
+                self.app_widget.searchResults.addHeader(
+                    key, include_paths, include_exts, exclude_paths)
+                self.app_widget.searchResults.addOneResult('!', message)
 
             if key == '':
-                self.app_widget.searchResults.addHeader(key, include_paths, include_exts, exclude_paths)
-                self.app_widget.searchResults.addOneResult(
-                    '!', 'search bar is empty')
+                showSearchError('search bar is empty')
                 return
             elif len(include_paths) == 0:
-                self.app_widget.searchResults.addHeader(key, include_paths, include_exts, exclude_paths)
-                self.app_widget.searchResults.addOneResult(
-                    '!', 'no file paths included in search')
+                showSearchError('no file paths included in search')
                 return
             elif len(include_exts) == 0:
                 include_exts = None
 
+            terms = [key]
+            if self.queryBox.isChecked():
+                try:
+                    terms = Query(key).terms
+                except QueryError as e:
+                    showSearchError('invalid query: %s' % e)
+                    return
+
+            if self.regexBox.isChecked():
+                try:
+                    for term in terms:
+                        re.compile(term)
+                except re.error as e:
+                    showSearchError('invalid regular expression: %s' % e)
+                    return
+
+            max_distance = None
+            if self.fuzzyBox.isChecked():
+                max_distance = FUZZY_MAX_DISTANCE
+                if self.regexBox.isChecked() or any(
+                        len(term) <= max_distance for term in terms):
+                    showSearchError('typos can only be allowed in plain keys '
+                                    'longer than %d characters'
+                                    % max_distance)
+                    return
+
             self.startbutton.hide()
             self.cancelbutton.show()
             print('starting search')
-            self.terminate_search[0] = False
+            # A new list, since a superseded search may still hold the old
+            self.terminate_search = [False]
             self.search_is_running = True
 
             self.app_widget.runSearch(
@@ -332,8 +832,24 @@ class SearchBarWidget(QWidget):
                 include_paths,
                 include_exts,
                 exclude_paths,
+                self.terminate_search,
+                ignore_case=self.ignoreCaseBox.isChecked(),
+                regex=self.regexBox.isChecked(),
+                top_k=RANKED_RESULTS if self.rankedBox.isChecked() else None,
+                archives=self.archivesBox.isChecked(),
+                query=self.queryBox.isChecked(),
+                max_distance=max_distance,
+                paged=self.pagedBox.isChecked(),
+                likely_first=self.likelyFirstBox.isChecked(),
             )
 
+    def clearButtonClicked(self):
+        """Function that's called when the clear button is pressed.
+        """
+        self.app_widget.dropPages()
+        self.app_widget.searchResults.clearResults()
+        self.last_search_typed = False
+
     def cancelButtonClicked(self):
         """Function that's called when the cancel button is pressed.
         """
@@ -358,34 +874,202 @@ class SearchBarWidget(QWidget):
         return key, include_paths, include_exts, exclude_paths
 
 
+class SearchResultsModel(QAbstractItemModel):
+
+    COLUMNS = ('File', 'Line', 'Preview')
+    FILE_COLUMN, LINE_COLUMN, PREVIEW_COLUMN = range(len(COLUMNS))
+
+    def __init__(self):
+        """Qt item model holding every search and its hits
+
+        The model is a two level tree: one top level row per search, whose
+        children are that search's hits. Hits are kept in a
+        Results.ResultStore per search; the view only asks for the rows it
+        is drawing, so only their snippets are ever built.
+        """
+        super(SearchResultsModel, self).__init__()
+        self.headers = []
+        self.hits = []  # one Results.ResultStore per search
+
+    def index(self, row, column, parent=QModelIndex()):
+        """Returns the index of an item; hits point back to their search
+        """
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, 0)
+        # Internal id of a hit is the row of its search plus one
+        return self.createIndex(row, column, parent.row() + 1)
+
+    def parent(self, index):
+        """Returns the search a hit belongs to, or nothing for a search
+        """
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(index.internalId() - 1, 0, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        """Returns the number of searches, or of hits in a search
+        """
+        if not parent.isValid():
+            return len(self.headers)
+        if parent.internalId() == 0 and parent.column() == 0:
+            return len(self.hits[parent.row()])
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        """Returns the number of columns
+        """
+        return len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        """Returns the column titles
+        """
+        if (orientation == QtCore.Qt.Horizontal
+                and role == QtCore.Qt.DisplayRole):
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        """Returns the text, or the tooltip, shown for an item
+        """
+        if not index.isValid():
+            return None
+        if index.internalId() == 0:
+            if role == QtCore.Qt.DisplayRole and index.column() == 0:
+                return self.headers[index.row()]
+            return None
+
+        hits = self.hits[index.internalId() - 1]
+        path = hits.path(index.row())
+        if role == QtCore.Qt.ToolTipRole:
+            return path
+        if role != QtCore.Qt.DisplayRole:
+            return None
+        if index.column() == self.FILE_COLUMN:
+            return os.path.basename(path)
+        hit = hits.hit(index.row())
+        # Hits are SearchHits; messages are plain strings. Hits in
+        # documents show where in the document they are instead of a line
+        if index.column() == self.LINE_COLUMN:
+            if not isinstance(hit, tuple):
+                return ''
+            return hit.location or str(hit.line)
+        return hit[0] if isinstance(hit, tuple) else str(hit)
+
+    def hitPath(self, index):
+        """Returns the file path of a hit, or None for a search header
+        """
+        if not index.isValid() or index.internalId() == 0:
+            return None
+        return self.hits[index.internalId() - 1].path(index.row())
+
+    def addSearch(self, header, results=None):
+        """Appends a search with no hits yet
+
+        :param header: text describing the search
+        :param results: optional empty ResultStore to keep the search's
+                        hits in, set up to build their snippets
+        :return: index of the new search
+        """
+        row = len(self.headers)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.headers.append(header)
+        self.hits.append(ResultStore() if results is None else results)
+        self.endInsertRows()
+        return self.index(row, 0)
+
+    def addHits(self, batch):
+        """Appends hits to the most recent search
+
+        :param batch: list of (path, search hit) pairs
+        """
+        if not batch:
+            return
+        if not self.headers:
+            self.addSearch('')
+        search_row = len(self.headers) - 1
+        hits = self.hits[search_row]
+        self.beginInsertRows(self.index(search_row, 0),
+                             len(hits), len(hits) + len(batch) - 1)
+        hits.extend(batch)
+        self.endInsertRows()
+
+    def removeLastSearch(self):
+        """Removes the most recent search and its hits
+        """
+        if not self.headers:
+            return
+        row = len(self.headers) - 1
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.headers[row]
+        del self.hits[row]
+        self.endRemoveRows()
+
+    def clear(self):
+        """Removes every search and hit
+        """
+        self.beginResetModel()
+        self.headers = []
+        self.hits = []
+        self.endResetModel()
+
+
+class HtmlItemDelegate(QStyledItemDelegate):
+
+    def paint(self, painter, option, index):
+        """Draws an item's text as rich text, so snippets show bold keys
+        """
+        self.initStyleOption(option, index)
+        document = QTextDocument()
+        document.setHtml(option.text)
+        option.text = ''
+        style = option.widget.style() if option.widget else None
+        if style is not None:
+            style.drawControl(QStyle.CE_ItemViewItem, option, painter,
+                              option.widget)
+        painter.save()
+        painter.translate(option.rect.topLeft())
+        painter.setClipRect(option.rect.translated(-option.rect.topLeft()))
+        document.drawContents(painter)
+        painter.restore()
+
+
 class SearchResultsWidget(QWidget):
 
     def __init__(self):
         """PyQt widget containing the list of search results
 
-        The box is scrollable and size adjustable.
+        The box is scrollable and size adjustable. Results live in a
+        `SearchResultsModel` and only the visible rows are drawn.
         """
         QWidget.__init__(self)
 
-        self.fileList = []
-        self.filePreview = []
         self.editorSet = False
         self.editor = ""
 
-        self.rowLayout = QFormLayout()
-        groupBox = QGroupBox('Search Results')
+        self.model = SearchResultsModel()
+        self.view = QTreeView()
+        self.view.setModel(self.model)
+        self.view.setUniformRowHeights(True)
+        # So the scroll bar counts rows, see `scrolledNearEnd`
+        self.view.setVerticalScrollMode(QAbstractItemView.ScrollPerItem)
+        self.view.setItemDelegateForColumn(
+            SearchResultsModel.PREVIEW_COLUMN, HtmlItemDelegate(self.view))
+        self.view.clicked.connect(self.resultClicked)
 
-        groupBox.setLayout(self.rowLayout)
-        scrollBox = QScrollArea()
-        scrollBox.setWidgetResizable(True)
-        scrollBox.setWidget(groupBox)
+        groupBox = QGroupBox('Search Results')
+        groupLayout = QVBoxLayout()
+        groupLayout.addWidget(self.view)
+        groupBox.setLayout(groupLayout)
 
         verticalLayout = QVBoxLayout()
-        verticalLayout.addWidget(scrollBox)
+        verticalLayout.addWidget(groupBox)
 
         self.setLayout(verticalLayout)
 
-    def addHeader(self, key, include_paths, include_exts, exclude_paths):
+    def addHeader(self, key, include_paths, include_exts, exclude_paths,
+                  results=None):
         """Writes a header to the search results box that contains the inputs for that search
 
         :param key: string to search for
@@ -393,45 +1077,67 @@ class SearchResultsWidget(QWidget):
         :param include_exts: list of file extensions in the form e.g. '.txt'
                              may instead be `None` to search all files
         :param exclude_paths: list of paths to exclude from the search
+        :param results: optional ResultStore for the search's hits, see
+                        `SearchResultsModel.addSearch`
         """
-        # button = QPushButton(search_string)
-        label = QLabel("Search term: " + str(key) + 
-                        ", Path: " + str(include_paths) + 
-                        ", Included Extensions: " + str(include_exts)  + 
-                        ", Excluded Paths: " + str(exclude_paths) )
-        self.rowLayout.addRow(label)
+        index = self.model.addSearch(
+            "Search term: " + str(key) +
+            ", Path: " + str(include_paths) +
+            ", Included Extensions: " + str(include_exts) +
+            ", Excluded Paths: " + str(exclude_paths), results)
+        self.view.setFirstColumnSpanned(index.row(), QModelIndex(), True)
+        self.view.expand(index)
+
+    def scrolledNearEnd(self):
+        """Returns whether the view shows, or is scrolled to within
+        PAGE_LOAD_MARGIN rows of, the end of the results
+        """
+        scrollBar = self.view.verticalScrollBar()
+        return scrollBar.value() >= scrollBar.maximum() - PAGE_LOAD_MARGIN
 
     def clearResults(self):
         """Clears all results
         """
-        self.fileList = []
-        self.filePreview = []
-        for _ in range(self.rowLayout.rowCount()):
-            self.rowLayout.removeRow(0)
+        self.model.clear()
+
+    def removeLastSearch(self):
+        """Removes the most recent search and its results
+        """
+        self.model.removeLastSearch()
 
     def addOneResult(self, file_name, preview):
         """Takes as input two strings and adds them to results box
 
-        The first string is added as a button and the second string
-        is added as a label
+        The file name is shown with its full path as a tooltip, next to
+        the preview. Clicking the row opens the file in the editor.
 
         :param file_name: path to file
         :param preview: string of search hit context
         """
-        fileBase = os.path.basename(file_name) 
-        self.fileList.append(QPushButton(fileBase))
-        self.fileList[-1].setToolTip(file_name)
-        self.filePreview.append(QLabel(str(preview)))
-        self.rowLayout.addRow(self.fileList[-1], self.filePreview[-1])
-        self.connectOneButton(self.fileList[-1], file_name)
+        self.model.addHits([(file_name, preview)])
+
+    def addResultBatch(self, batch):
+        """Adds a batch of search hits sent by the backend to the results box
+
+        :param batch: list of (path, search hit) pairs
+        """
+        self.model.addHits(batch)
+
+    def resultClicked(self, index):
+        """Opens the file of a clicked search hit with the editor
+        :param index: model index of the clicked item
+        """
+        path = self.model.hitPath(index)
+        if path is not None:
+            # A file inside an archive opens the archive
+            self.openWithEditor(split_member_path(path)[0])
 
     def addResults(self, results):
         """Adds a list of (path, results) pairs to the results box.
 
         :param results: list of 2-tuples containing (path, search hits)
         """
-        for file_name, preview in results:
-            self.addOneResult(file_name, preview)
+        self.model.addHits(list(results))
 
     def pathValid(self, filePath):
         """Returns True if file path exists
@@ -468,11 +1174,3 @@ class SearchResultsWidget(QWidget):
         """
         if self.editorSet == True and self.pathValid(file):
             subprocess.Popen([self.editor, file])
-
-    def connectOneButton(self, fileButton, filePath):
-        """Connects the button to the openWithEditor function
-        :param fileButton: the button widget to be connected
-        :param filePath: the file path of the to connect the button with
-        """
-        if self.editorValid(self.editor):
-            fileButton.clicked.connect(lambda: self.openWithEditor(filePath))
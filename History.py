@@ -0,0 +1,193 @@
+"""
+PersonalKnowledgeEngine
+
+Orders the files of a search so the ones likely to have hits come first;
+serves "Backend"
+
+The files that had hits in earlier searches, and the extensions of those
+files, are kept in a small SQLite database. A search given a ScanHistory
+first visits the files that had hits before, those with hits in the most
+searches first, without waiting for the walk to find them. The other files
+are visited once the walk is over, in order of
+
+    priority = EXTENSION_WEIGHT * share of earlier hits in files with the
+                                  same extension
+             + RECENCY_WEIGHT / (1 + age of the file / RECENCY_SCALE)
+
+so files of the extensions searched most, and recently modified files, are
+read first. Every file is still searched exactly once: only the order in
+which hits arrive changes.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+HISTORY_STORE_PATH = os.path.join(os.path.expanduser('~'), '.cache',
+                                  'PersonalKnowledgeEngine', 'history.db')
+HISTORY_MAX_PATHS = 10000  # files with hits remembered, most recent kept
+HISTORY_STORE_TIMEOUT = 10  # seconds to wait for another search's writes
+EXTENSION_WEIGHT = 1.0
+RECENCY_WEIGHT = 1.0
+RECENCY_SCALE = 7 * 24 * 60 * 60  # age in seconds at which recency halves
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS paths (
+    path TEXT PRIMARY KEY,
+    searches INTEGER NOT NULL,
+    last_hit REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS extensions (
+    extension TEXT PRIMARY KEY,
+    files INTEGER NOT NULL
+);
+"""
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+class ScanHistory:
+
+    def __init__(self, store_path: str = HISTORY_STORE_PATH):
+        """Where earlier searches found hits, kept on disk between searches.
+
+        The history is read once, here, and written to whenever `record` is
+        called. If the database can't be opened, e.g. because the disk is
+        read-only, the history is only kept in memory for as long as this
+        instance lives. Safe to use from several threads.
+
+        :param store_path: path of the SQLite database, or None to keep the
+                           history in memory only
+        """
+        self.store_path = store_path
+        self.paths = {}  # path -> (searches with hits in it, time of last)
+        self.extensions = {}  # extension -> files with hits, over searches
+        self.lock = threading.Lock()
+        conn = self.connect()
+        if conn is None:
+            return
+        try:
+            self.paths = {path: (searches, last_hit) for path, searches,
+                          last_hit in conn.execute('SELECT * FROM paths')}
+            self.extensions = dict(conn.execute('SELECT * FROM extensions'))
+        except sqlite3.Error as e:
+            print(e, file=sys.stderr)
+        finally:
+            conn.close()
+
+    def connect(self):
+        """Returns a connection to the database, or None if there is none
+        """
+        if self.store_path is None:
+            return None
+        try:
+            os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+            conn = sqlite3.connect(self.store_path,
+                                   timeout=HISTORY_STORE_TIMEOUT)
+            conn.executescript(SCHEMA)
+            return conn
+        except (OSError, sqlite3.Error) as e:
+            print(e, file=sys.stderr)
+            self.store_path = None
+            return None
+
+    def known_paths(self) -> list:
+        """Returns the files earlier searches found hits in
+        """
+        with self.lock:
+            return list(self.paths)
+
+    def priority(self, path: str, mtime: float, now: float,
+                 total_files: int) -> float:
+        """Returns how likely a file without earlier hits is to have some,
+        see the module docstring
+
+        :param path: path of the file
+        :param mtime: its modification time, in seconds since the epoch
+        :param now: the current time, in the same unit
+        :param total_files: sum of the counts in `self.extensions`
+        """
+        extension = os.path.splitext(path)[1].lower()
+        share = self.extensions.get(extension, 0) / max(total_files, 1)
+        age = max(now - mtime, 0)
+        return (EXTENSION_WEIGHT * share
+                + RECENCY_WEIGHT / (1 + age / RECENCY_SCALE))
+
+    def order(self, paths: list) -> list:
+        """Returns the paths, those likely to have hits first
+
+        Files that had hits before come first, the ones with hits in the
+        most searches first, and the rest by `priority`. Ties keep the
+        order the paths were given in.
+
+        :param paths: list of file paths
+        """
+        with self.lock:
+            earlier_hits = dict(self.paths)
+            total_files = sum(self.extensions.values())
+        now = time.time()
+
+        def likelihood(path: str) -> tuple:
+            """Sort key; smaller is more likely
+            """
+            earlier = earlier_hits.get(path)
+            if earlier is not None:
+                return 0, -earlier[0]
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # Reported when the file is searched
+                mtime = 0
+            return 1, -self.priority(path, mtime, now, total_files)
+
+        return sorted(paths, key=likelihood)
+
+    def record(self, paths: list) -> None:
+        """Remembers the files a finished search found hits in
+
+        Only the HISTORY_MAX_PATHS files with the most recent hits are kept.
+
+        :param paths: paths of the files with hits, each once
+        """
+        now = time.time()
+        with self.lock:
+            for path in paths:
+                searches = self.paths.get(path, (0, now))[0] + 1
+                self.paths[path] = (searches, now)
+                extension = os.path.splitext(path)[1].lower()
+                self.extensions[extension] = \
+                    self.extensions.get(extension, 0) + 1
+            dropped = []
+            if len(self.paths) > HISTORY_MAX_PATHS:
+                by_age = sorted(self.paths, key=lambda p: self.paths[p][1])
+                dropped = by_age[:len(self.paths) - HISTORY_MAX_PATHS]
+                for path in dropped:
+                    del self.paths[path]
+            conn = self.connect()
+            if conn is None:
+                return
+            try:
+                with conn:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO paths (path, searches, '
+                        'last_hit) VALUES (?, ?, ?)',
+                        [(path,) + self.paths[path] for path in paths
+                         if path in self.paths])
+                    conn.executemany('DELETE FROM paths WHERE path = ?',
+                                     [(path,) for path in dropped])
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO extensions (extension, '
+                        'files) VALUES (?, ?)',
+                        list(self.extensions.items()))
+            except sqlite3.Error as e:
+                # e.g. another search holding the database for too long;
+                # the history is still used for the rest of this session
+                print(e, file=sys.stderr)
+            finally:
+                conn.close()
@@ -0,0 +1,592 @@
+"""
+PersonalKnowledgeEngine
+
+On-disk trigram index used by "Backend" to narrow down which files a search
+has to read. The index is a SQLite database holding:
+
+    meta:     the index format version and the include/exclude rules
+              the index was built from
+    files:    the manifest; one row per indexed file with its size, mtime,
+              inode, position in the order of the last walk and whether
+              its trigrams are in the postings
+    postings: for each trigram, the ids of the files containing it. Postings
+              are written in segments of many files at a time and stored as
+              packed arrays of file ids
+
+The manifest lets `refresh_index` bring the index up to date by re-reading
+only the files that were added or changed since the last run. Postings of
+deleted or changed files are left in place and skipped at query time until
+enough segments pile up for `compact_index` to rewrite them.
+
+Trigrams are taken over the raw bytes of each file, the same bytes the search
+matches the encoded key against, so a file is only a candidate for a key if
+it contains every trigram of the key as encoded by one of the encodings the
+search may read the file with. Candidates are then searched
+normally; the index never decides a hit itself. Documents such as Word
+files are searched through their extracted text (see "Extractors"), so that
+is what their trigrams are taken over. Likewise, when the rules say to search
+inside archives (see "Archives"), an archive holds the trigrams of every file
+inside it, so it is a candidate if any of them may contain the key.
+
+Binary files, which every search skips, are read no further than their first
+few bytes and get no trigrams. Files larger than the search's
+`max_file_size` aren't read at all; they stay in the manifest without
+trigrams and are a candidate for every key, since a later search may allow
+larger files.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+from array import array
+import json
+import os
+import sqlite3
+
+from Archives import archive_format, archive_members
+from Backend import ENCODING_RULES, SNIFF_BYTES, foreach_file, \
+    normalize_search_rules, sniff_encoding
+from Extractors import extracted_text, extractor_for
+from Matchers import make_matcher
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+INDEX_FORMAT_VERSION = 6
+# Rules a file counts as binary by, whatever rules a search reads it with:
+# only a byte order mark makes a file with a NUL byte text
+BINARY_SNIFF_RULES = ('bom',)
+# Byte encodings of the key a file with a byte order mark may contain
+BOM_KEY_ENCODINGS = ('utf-8', 'utf-16-le', 'utf-16-be', 'utf-32-le',
+                     'utf-32-be')
+TRIGRAM_LENGTH = 3
+INDEX_READ_BYTES = 1 << 20  # bytes read at a time while indexing
+INDEX_SEGMENT_POSTINGS = 5000000  # postings buffered before a segment flush
+INDEX_MAX_SEGMENTS = 64  # segments allowed before a refresh compacts them
+POSTINGS_TYPECODE = 'I'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    walk_order INTEGER NOT NULL,
+    indexed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    trigram BLOB NOT NULL,
+    segment INTEGER NOT NULL,
+    ids BLOB NOT NULL,
+    PRIMARY KEY (trigram, segment)
+) WITHOUT ROWID;
+"""
+
+
+# DEFINITIONS (define all backend functions)
+
+def byte_trigrams(data: bytes) -> set:
+    """Returns the set of distinct byte trigrams in `data`
+    """
+    return {data[i:i + TRIGRAM_LENGTH]
+            for i in range(len(data) - TRIGRAM_LENGTH + 1)}
+
+
+def key_trigrams(key: str, encodings: tuple = ENCODING_RULES) -> list:
+    """Returns the sets of trigrams a file containing `key` must contain
+
+    A file containing `key` contains every trigram of at least one of the
+    returned sets, one per distinct way the key can be encoded. Trigrams
+    spanning a line break are left out since the line-level search sees
+    normalized line endings that may not match the bytes on disk.
+
+    :param key: the string being searched for
+    :param encodings: rules files are decoded by, see
+                      `Backend.ENCODING_RULES`
+    :return: list of sets of byte trigrams. Empty if no file can contain
+             `key`
+    """
+    names = []
+    for rule in encodings:
+        names.extend(BOM_KEY_ENCODINGS if rule == 'bom' else [rule])
+    trigram_sets = []
+    for name in names:
+        try:
+            key_bytes = key.encode(name)
+        except UnicodeEncodeError:
+            continue
+        trigrams = {trigram for trigram in byte_trigrams(key_bytes)
+                    if b'\n' not in trigram and b'\r' not in trigram}
+        if trigrams not in trigram_sets:
+            trigram_sets.append(trigrams)
+    return trigram_sets
+
+
+def stream_trigrams(stream, max_file_size: int = None):
+    """Reads a binary file object to the end and returns the trigrams of
+    its bytes
+
+    :param stream: binary file object, read from its current position
+    :param max_file_size: size in bytes above which the stream isn't
+                          indexed. None for no limit
+    :return: set of byte trigrams, empty for a binary file, or None if the
+             stream is larger than `max_file_size`
+    """
+    trigrams = set()
+    tail = b''
+    size = 0
+    while True:
+        chunk = stream.read(INDEX_READ_BYTES)
+        if not chunk:
+            break
+        if not size and sniff_encoding(chunk[:SNIFF_BYTES],
+                                       BINARY_SNIFF_RULES) is None:
+            return trigrams
+        size += len(chunk)
+        if max_file_size is not None and size > max_file_size:
+            return None
+        # Keep the last few bytes so trigrams spanning two reads are
+        # not lost
+        chunk = tail + chunk
+        trigrams |= byte_trigrams(chunk)
+        tail = chunk[-(TRIGRAM_LENGTH - 1):]
+    return trigrams
+
+
+def file_trigrams(path: str, archives: bool = False,
+                  extract_cache_dir: str = None,
+                  max_file_size: int = None):
+    """Reads a file and returns the trigrams of its bytes, or of its
+    extracted text for a document
+
+    :param path: path of the file to index
+    :param archives: whether an archive gets the trigrams of the files
+                     inside it instead of its own
+    :param extract_cache_dir: directory the text of documents is cached in
+                              (see "Extractors"), or None to index
+                              documents as they are, like a search that
+                              doesn't extract them reads them
+    :param max_file_size: size in bytes above which a file, or a file
+                          inside an archive, isn't indexed, like the search
+                          skips it. None for no limit
+    :return: set of byte trigrams, or None if the file isn't indexed and
+             so is a candidate for every key
+    """
+    if archives and archive_format(path) is not None:
+        trigrams = set()
+        for _, size, stream in archive_members(path, lambda name: True):
+            if stream is None:
+                continue
+            if max_file_size is not None and size is not None \
+                    and size > max_file_size:
+                return None
+            member_trigrams = stream_trigrams(stream, max_file_size)
+            if member_trigrams is None:
+                return None
+            trigrams |= member_trigrams
+        return trigrams
+    if max_file_size is not None and os.path.getsize(path) > max_file_size:
+        return None
+    if extract_cache_dir is not None and extractor_for(path) is not None:
+        path = extracted_text(path, extract_cache_dir).text_path
+    with open(path, 'rb') as f:
+        return stream_trigrams(f)
+
+
+def connect(index_path: str) -> sqlite3.Connection:
+    """Opens (creating if needed) the index database at `index_path`
+    """
+    conn = sqlite3.connect(index_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def read_meta(conn: sqlite3.Connection) -> dict:
+    """Returns the index's meta table as a dict
+    """
+    return {key: json.loads(value)
+            for key, value in conn.execute('SELECT key, value FROM meta')}
+
+
+def write_meta(conn: sqlite3.Connection, **values) -> None:
+    """Stores the given values in the index's meta table
+    """
+    conn.executemany(
+        'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+        [(key, json.dumps(value)) for key, value in values.items()])
+
+
+def index_matches_rules(index_path: str,
+                        include_paths: list,
+                        include_exts: list = None,
+                        exclude_paths: list = None,
+                        follow_symlinks: bool = False,
+                        archives: bool = False,
+                        extract_cache_dir: str = None) -> bool:
+    """Returns whether an index exists at `index_path` for the given rules,
+    with documents indexed by their extracted text or not as
+    `extract_cache_dir` says, see `file_trigrams`
+    """
+    if not os.path.isfile(index_path):
+        return False
+    rules = normalize_search_rules(include_paths, include_exts, exclude_paths,
+                                   follow_symlinks, archives)
+    conn = connect(index_path)
+    try:
+        meta = read_meta(conn)
+    finally:
+        conn.close()
+    return (meta.get('version') == INDEX_FORMAT_VERSION
+            and meta.get('rules') == list(rules)
+            and meta.get('extracted') == (extract_cache_dir is not None))
+
+
+class SegmentWriter:
+
+    def __init__(self, conn: sqlite3.Connection):
+        """Buffers postings in memory and writes them out as index segments
+
+        :param conn: open index database connection
+        """
+        self.conn = conn
+        row = conn.execute('SELECT MAX(segment) FROM postings').fetchone()
+        self.segment = (row[0] or 0) + 1
+        self.postings = {}
+        self.num_postings = 0
+
+    def add(self, file_id: int, trigrams: set) -> None:
+        """Adds a file's trigrams, flushing a segment when the buffer is full
+        """
+        for trigram in trigrams:
+            ids = self.postings.get(trigram)
+            if ids is None:
+                ids = self.postings[trigram] = array(POSTINGS_TYPECODE)
+            ids.append(file_id)
+        self.num_postings += len(trigrams)
+        if self.num_postings >= INDEX_SEGMENT_POSTINGS:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered postings to the database as a new segment
+        """
+        if not self.postings:
+            return
+        self.conn.executemany(
+            'INSERT INTO postings (trigram, segment, ids) VALUES (?, ?, ?)',
+            ((trigram, self.segment, ids.tobytes())
+             for trigram, ids in self.postings.items()))
+        self.segment += 1
+        self.postings = {}
+        self.num_postings = 0
+
+
+def add_file(conn: sqlite3.Connection,
+             writer: SegmentWriter,
+             path: str,
+             stat: os.stat_result,
+             walk_order: int,
+             archives: bool = False,
+             extract_cache_dir: str = None,
+             max_file_size: int = None) -> None:
+    """Reads a file and adds it to the manifest and the postings
+
+    :param walk_order: position of the file in the walk that found it
+    :param archives: see `file_trigrams`
+    :param extract_cache_dir: see `file_trigrams`
+    :param max_file_size: see `file_trigrams`
+    """
+    trigrams = file_trigrams(path, archives, extract_cache_dir, max_file_size)
+    cursor = conn.execute(
+        'INSERT INTO files (path, size, mtime_ns, inode, walk_order, indexed) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, walk_order,
+         trigrams is not None))
+    if trigrams is not None:
+        writer.add(cursor.lastrowid, trigrams)
+
+
+def build_index(index_path: str,
+                terminate_early: list,
+                include_paths: list,
+                include_exts: list = None,
+                exclude_paths: list = None,
+                follow_symlinks: bool = False,
+                archives: bool = False,
+                extract_cache_dir: str = None,
+                max_file_size: int = None) -> int:
+    """Builds a trigram index of every file matching the given rules
+
+    Any existing index at `index_path` is replaced. The rules follow
+    `Backend.foreach_file`.
+
+    :param index_path: path of the index database file
+    :param terminate_early: single-element list containing a bool that says
+                            whether to stop building early. An index that
+                            was stopped early is left without rules, so it
+                            is never used for a search
+    :param include_paths: list of directories/files to include
+    :param include_exts: list of file extensions to include
+    :param exclude_paths: list of directories/files to exclude
+    :param follow_symlinks: whether to descend into symlinked directories
+    :param archives: whether archives are indexed whatever their extension,
+                     with the trigrams of the files inside them
+    :param extract_cache_dir: see `file_trigrams`
+    :param max_file_size: see `file_trigrams`
+    :return: number of files indexed
+    """
+    rules = normalize_search_rules(include_paths, include_exts, exclude_paths,
+                                   follow_symlinks, archives)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    conn = connect(index_path)
+    try:
+        writer = SegmentWriter(conn)
+        walked = [0]
+
+        def index_file_func(path: str):
+            """This is called in foreach_file with every matching file path.
+            """
+            add_file(conn, writer, path, os.stat(path), walked[0], archives,
+                     extract_cache_dir, max_file_size)
+            walked[0] += 1
+
+        foreach_file(index_file_func, terminate_early, *rules)
+        writer.flush()
+
+        if not terminate_early[0]:
+            write_meta(conn, version=INDEX_FORMAT_VERSION, rules=list(rules),
+                       extracted=extract_cache_dir is not None)
+        conn.commit()
+        return conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def refresh_index(index_path: str, terminate_early: list,
+                  extract_cache_dir: str = None,
+                  max_file_size: int = None) -> dict:
+    """Brings an index up to date with the files currently on disk
+
+    Walks the tree with the rules the index was built from and compares the
+    size, mtime and inode of every file against the manifest. Only files
+    that were added or changed are read. A file that disappeared and
+    reappeared under a new path with the same inode, size and mtime is
+    treated as a rename and is not read again. Every file's position in the
+    walk is updated, so `candidate_paths` returns files in the order a
+    search without the index would visit them.
+
+    :param index_path: path of an existing index database file
+    :param terminate_early: single-element list containing a bool that says
+                            whether to stop refreshing early. Work done so
+                            far is kept, but deletions and renames are only
+                            applied once the whole tree has been walked
+    :param extract_cache_dir: see `file_trigrams`. Should say the same as
+                              when the index was built, see
+                              `index_matches_rules`
+    :param max_file_size: see `file_trigrams`. Files that were added or
+                          changed are indexed with this limit; the others
+                          keep the one they were indexed with
+    :return: dict with the number of files 'added', 'changed', 'deleted',
+             'renamed' and 'unchanged'
+    """
+    counts = dict(added=0, changed=0, deleted=0, renamed=0, unchanged=0)
+    conn = connect(index_path)
+    try:
+        rules = read_meta(conn)['rules']
+        archives = rules[4]
+        manifest = {
+            path: (file_id, walk_order, size, mtime_ns, inode)
+            for file_id, path, size, mtime_ns, inode, walk_order
+            in conn.execute('SELECT id, path, size, mtime_ns, inode, '
+                            'walk_order FROM files')
+        }
+        seen = set()
+        new_files = []
+        writer = SegmentWriter(conn)
+
+        def refresh_file_func(path: str):
+            """This is called in foreach_file with every matching file path.
+            """
+            stat = os.stat(path)
+            walk_order = len(seen)
+            seen.add(path)
+            entry = manifest.get(path)
+            if entry is None:
+                # Might be a rename; decided once the whole walk is done
+                new_files.append((path, stat, walk_order))
+            elif entry[2:] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                if entry[1] != walk_order:
+                    conn.execute('UPDATE files SET walk_order = ? '
+                                 'WHERE id = ?', (walk_order, entry[0]))
+                counts['unchanged'] += 1
+            else:
+                # A changed file gets a new id so its old postings go stale
+                conn.execute('DELETE FROM files WHERE id = ?', (entry[0],))
+                add_file(conn, writer, path, stat, walk_order, archives,
+                         extract_cache_dir, max_file_size)
+                counts['changed'] += 1
+
+        foreach_file(refresh_file_func, terminate_early, *rules)
+
+        if not terminate_early[0]:
+            # Files in the manifest that the walk didn't see are either
+            # deleted or renamed to one of the new paths
+            missing = {}
+            for path, entry in manifest.items():
+                if path not in seen:
+                    missing[entry[2:]] = entry[0]
+            for path, stat, walk_order in new_files:
+                file_id = missing.pop(
+                    (stat.st_size, stat.st_mtime_ns, stat.st_ino), None)
+                if file_id is None:
+                    add_file(conn, writer, path, stat, walk_order, archives,
+                             extract_cache_dir, max_file_size)
+                    counts['added'] += 1
+                else:
+                    conn.execute('UPDATE files SET path = ?, walk_order = ? '
+                                 'WHERE id = ?', (path, walk_order, file_id))
+                    counts['renamed'] += 1
+            conn.executemany('DELETE FROM files WHERE id = ?',
+                             [(file_id,) for file_id in missing.values()])
+            counts['deleted'] = len(missing)
+
+        writer.flush()
+        if writer.segment > INDEX_MAX_SEGMENTS:
+            compact_index(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return counts
+
+
+def compact_index(conn: sqlite3.Connection) -> None:
+    """Merges all postings segments into one, dropping deleted file ids
+    """
+    live_ids = {file_id for (file_id,) in conn.execute('SELECT id FROM files')}
+    merged = []
+    trigrams = [trigram for (trigram,) in conn.execute(
+        'SELECT DISTINCT trigram FROM postings')]
+    for trigram in trigrams:
+        ids = array(POSTINGS_TYPECODE)
+        for (blob,) in conn.execute(
+                'SELECT ids FROM postings WHERE trigram = ? ORDER BY segment',
+                (trigram,)):
+            postings = array(POSTINGS_TYPECODE)
+            postings.frombytes(blob)
+            ids.extend(file_id for file_id in postings if file_id in live_ids)
+        if ids:
+            merged.append((trigram, 1, ids.tobytes()))
+    conn.execute('DELETE FROM postings')
+    conn.executemany(
+        'INSERT INTO postings (trigram, segment, ids) VALUES (?, ?, ?)',
+        merged)
+
+
+def corpus_stats(index_path: str) -> tuple:
+    """Returns the number of indexed files and their total size in bytes
+    """
+    conn = connect(index_path)
+    try:
+        num_files, total_size = conn.execute(
+            'SELECT COUNT(*), TOTAL(size) FROM files').fetchone()
+    finally:
+        conn.close()
+    return num_files, int(total_size)
+
+
+def trigram_file_ids(conn: sqlite3.Connection, trigrams: set,
+                     postings_memo: dict = None):
+    """Returns the ids of the indexed files containing every given trigram
+
+    :param conn: connection to the index database
+    :param trigrams: set of byte trigrams
+    :param postings_memo: optional dict of trigram -> set of file ids, to
+                          read the postings of each trigram only once when
+                          several keys share it
+    :return: set of file ids, or None if `trigrams` is empty
+    """
+    candidate_ids = None
+    for trigram in trigrams:
+        ids = postings_memo.get(trigram) if postings_memo is not None \
+            else None
+        if ids is None:
+            ids = set()
+            for (blob,) in conn.execute(
+                    'SELECT ids FROM postings WHERE trigram = ?',
+                    (trigram,)):
+                postings = array(POSTINGS_TYPECODE)
+                postings.frombytes(blob)
+                ids.update(postings)
+            if postings_memo is not None:
+                postings_memo[trigram] = ids
+        if candidate_ids is None:
+            candidate_ids = set(ids)
+        else:
+            candidate_ids &= ids
+        if not candidate_ids:
+            break
+    return candidate_ids
+
+
+def string_file_ids(conn: sqlite3.Connection, string: str, encodings: tuple,
+                    postings_memo: dict = None):
+    """Returns the ids of the indexed files that may contain `string`
+
+    :return: set of file ids, or None if `string` is too short to narrow
+             anything down
+    """
+    candidate_ids = set()
+    for trigrams in key_trigrams(string, encodings):
+        ids = trigram_file_ids(conn, trigrams, postings_memo)
+        if ids is None:
+            return None
+        candidate_ids |= ids
+    return candidate_ids
+
+
+def candidate_paths(index_path: str, key,
+                    encodings: tuple = ENCODING_RULES) -> list:
+    """Returns the indexed files that may contain `key`, in walk order
+
+    :param index_path: path of the index database file
+    :param key: the string being searched for, a list of strings searched
+                for at once, or a matcher (see "Matchers")
+    :param encodings: rules files are decoded by, see
+                      `Backend.ENCODING_RULES`
+    :return: list of file paths that, for at least one of the matcher's
+             literal alternatives, contain every trigram of each of its
+             strings in at least one of their encodings, and of the files
+             that weren't indexed
+    """
+    alternatives = make_matcher(key).literal_alternatives()
+    conn = connect(index_path)
+    try:
+        postings_memo = {}
+        candidate_ids = set()
+        for strings in alternatives:
+            alternative_ids = None  # None: not narrowed down at all
+            for string in strings:
+                ids = string_file_ids(conn, string, encodings, postings_memo)
+                if ids is None:
+                    continue
+                if alternative_ids is None:
+                    alternative_ids = ids
+                else:
+                    alternative_ids &= ids
+            if alternative_ids is None:
+                # Too short to narrow anything down
+                candidate_ids = None
+                break
+            candidate_ids |= alternative_ids
+
+        rows = conn.execute('SELECT id, path, indexed FROM files '
+                            'ORDER BY walk_order')
+        if candidate_ids is None:
+            return [path for _, path, _ in rows]
+        return [path for file_id, path, indexed in rows
+                if file_id in candidate_ids or not indexed]
+    finally:
+        conn.close()
@@ -0,0 +1,899 @@
+"""
+PersonalKnowledgeEngine
+
+What a search looks for; serves "Backend"
+
+A matcher holds the key(s) of one search and compiles them once per search
+(and once per file encoding) into the patterns the backend scans with:
+
+    byte pattern: finds the next possible match in the raw bytes of a file,
+                  or, for case-insensitive and regular expression searches,
+                  the next line that may contain one
+    text methods: find the matches in decoded text and say which key each
+                  one is for, so the snippet can bold it
+
+Several keys are combined into a single regular expression shaped like a
+trie of the keys, so each file is read once however many keys there are,
+and the work done at each byte depends on how the keys branch rather than
+on how many there are.
+
+Case-insensitive keys and regular expressions can't be found in raw bytes
+directly. Instead, literal fragments every match must contain are taken
+from them and looked for in the bytes, and only the lines containing one
+are decoded and matched for real.
+
+Fuzzy searches find the places where a key occurs with at most a few edits
+(characters inserted, deleted or replaced, or two neighbours swapped).
+Split into one more piece than the number of edits allowed, a key keeps at
+least one piece intact in any such place, so only the lines containing one
+of the pieces are decoded and scanned, with Myers' bit-parallel algorithm
+(as extended by Hyyrö to count swaps): a few integer operations per
+character, however long the key.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import re
+
+try:
+    # Python 3.11 deprecated the public name of the regex parser
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+TRIE_END = None  # marks the end of a key in a trie node
+# ASCII letters that also match a non-ASCII letter when ignoring case
+# ('İ', 'ı', 'ſ' and the Kelvin sign), so they can't be looked for in bytes
+# with ASCII case folding
+CASE_FOLD_UNSAFE = 'iks'
+# Most alternatives the literal fragments of a regular expression are
+# split into; beyond this, the fragments of later parts are ignored
+MAX_LITERAL_ALTERNATIVES = 16
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+def trie_pattern(keys, as_bytes: bool = False):
+    """Builds a regular expression matching any of `keys`, shaped like a trie
+
+    Keys sharing a prefix share the part of the expression matching it, so
+    the regex engine never retries the same prefix for each key. Where one
+    key is a prefix of another, the longer one is preferred.
+
+    :param keys: iterable of non-empty str, or of bytes with `as_bytes`
+    :param as_bytes: whether the keys, and so the expression, are bytes
+    :return: regular expression source, str or bytes
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for unit in key:
+            node = node.setdefault(unit, {})
+        node[TRIE_END] = True
+
+    def literal(unit):
+        """Returns the expression matching one character or byte
+        """
+        return re.escape(bytes((unit,)) if as_bytes else unit)
+
+    def syntax(text: str):
+        """Returns regular expression syntax as the right type
+        """
+        return text.encode('ascii') if as_bytes else text
+
+    def build(node):
+        """Returns the expression for the keys below a node
+        """
+        branches = [literal(unit) + build(node[unit])
+                    for unit in sorted(unit for unit in node
+                                       if unit is not TRIE_END)]
+        if not branches:
+            return syntax('')
+        if len(branches) == 1 and TRIE_END not in node:
+            return branches[0]
+        group = syntax('(?:') + syntax('|').join(branches) + syntax(')')
+        # Optional only when a key ends here; greedy, so longer keys win
+        return group + syntax('?') if TRIE_END in node else group
+
+    return build(trie)
+
+
+def folds_safely(char: str) -> bool:
+    """Returns whether every character matching `char` when ignoring case
+    is found by ASCII case folding of bytes
+    """
+    return char < '\x80' and char.lower() not in CASE_FOLD_UNSAFE
+
+
+def combine_alternatives(first: list, second: list) -> list:
+    """Returns the alternatives of a sequence of two parts, see
+    `required_literals`
+    """
+    if len(first) * len(second) > MAX_LITERAL_ALTERNATIVES:
+        # Requiring less than is known is still correct
+        return first if len(first) <= len(second) else second
+    return [a + b for a in first for b in second]
+
+
+def sequence_literals(items, folded: bool) -> list:
+    """Returns the alternatives of a parsed sequence, see `required_literals`
+
+    :param items: parsed regular expression sequence
+    :param folded: whether the sequence ignores case
+    """
+    alternatives = [[]]
+    run = []
+    for op, av in items:
+        if op is sre_parse.LITERAL and (not folded or folds_safely(chr(av))):
+            run.append(chr(av))
+            continue
+        if run:
+            alternatives = combine_alternatives(alternatives,
+                                                [[(''.join(run), folded)]])
+            run = []
+        alternatives = combine_alternatives(alternatives,
+                                            item_literals(op, av, folded))
+    if run:
+        alternatives = combine_alternatives(alternatives,
+                                            [[(''.join(run), folded)]])
+    return alternatives
+
+
+def item_literals(op, av, folded: bool) -> list:
+    """Returns the alternatives of a single parsed item other than a
+    literal, see `required_literals`
+    """
+    if op is sre_parse.SUBPATTERN:
+        _, add_flags, del_flags, items = av
+        if add_flags & sre_parse.SRE_FLAG_IGNORECASE:
+            folded = True
+        if del_flags & sre_parse.SRE_FLAG_IGNORECASE:
+            folded = False
+        return sequence_literals(items, folded)
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+              getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+        minimum, _, items = av
+        return sequence_literals(items, folded) if minimum >= 1 else [[]]
+    if op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+        return sequence_literals(av, folded)
+    if op is sre_parse.BRANCH:
+        alternatives = []
+        for items in av[1]:
+            branch = sequence_literals(items, folded)
+            if [] in branch or (len(alternatives) + len(branch)
+                                > MAX_LITERAL_ALTERNATIVES):
+                return [[]]
+            alternatives.extend(branch)
+        return alternatives
+    # Character sets, anchors, backreferences, lookarounds, ...
+    return [[]]
+
+
+def required_literals(pattern: str, flags: int = 0) -> list:
+    """Returns the literal fragments a regular expression's matches contain
+
+    :param pattern: regular expression source
+    :param flags: `re` flags the expression is compiled with
+    :return: list of alternatives; every match contains all the fragments
+             of at least one of them. Each alternative is a list of
+             (fragment, folded) pairs, `folded` saying whether the fragment
+             is matched regardless of case; those fragments only contain
+             characters for which `folds_safely` holds. An empty
+             alternative means nothing is known about the matches
+    """
+    parsed = sre_parse.parse(pattern, flags)
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    return sequence_literals(
+        parsed, bool(state.flags & sre_parse.SRE_FLAG_IGNORECASE))
+
+
+def prefilter_fragments(alternatives: list):
+    """Picks the fragment to look for in bytes from each alternative
+
+    :param alternatives: as returned by `required_literals`
+    :return: list of (fragment, folded) pairs, the longest fragment of each
+             alternative, or None if some alternative has none
+    """
+    fragments = []
+    for alternative in alternatives:
+        if not alternative:
+            return None
+        fragments.append(max(alternative, key=lambda pair: len(pair[0])))
+    return fragments
+
+
+def prefilter_pattern(fragments, encoding: str):
+    """Returns the pattern finding the lines of a file that may match
+
+    :param fragments: as returned by `prefilter_fragments`
+    :param encoding: the encoding of the bytes the pattern will search
+    :return: LiteralPattern or RegexPattern finding any of the fragments,
+             UNFILTERED if they can't be looked for in this encoding, or
+             None if no line can match
+    """
+    if fragments is None:
+        return UNFILTERED
+    encoded = set()
+    fold = False
+    for fragment, folded in fragments:
+        try:
+            fragment_bytes = fragment.encode(encoding)
+        except UnicodeEncodeError:
+            # Text in this encoding can't contain this alternative
+            continue
+        if folded:
+            if fragment_bytes != fragment.encode('ascii'):
+                # ASCII case folding of bytes would miss matches
+                return UNFILTERED
+            fold = True
+        encoded.add(fragment_bytes)
+    if not encoded:
+        return None
+    if len(encoded) == 1 and not fold:
+        return LiteralPattern(encoded.pop())
+    return RegexPattern(
+        re.compile(trie_pattern(encoded, as_bytes=True),
+                   re.IGNORECASE if fold else 0),
+        max(map(len, encoded)))
+
+
+class LiteralPattern:
+
+    def __init__(self, key_bytes: bytes):
+        """Finds one encoded key in a buffer with `find`
+        """
+        self.key_bytes = key_bytes
+        self.max_length = len(key_bytes)
+
+    def find(self, buffer, start: int, end: int) -> tuple:
+        """Returns (offset, length) of the next match in buffer[start:end],
+        or (-1, 0) if there is none
+        """
+        pos = buffer.find(self.key_bytes, start, end)
+        return pos, self.max_length if pos != -1 else 0
+
+    def next_start(self, pos: int, length: int) -> int:
+        """Returns where to look for the next match after one at `pos`
+        """
+        return pos + max(length, 1)
+
+
+class RegexPattern:
+
+    def __init__(self, regex, max_length: int):
+        """Finds the matches of a compiled bytes regular expression
+        """
+        self.regex = regex
+        self.max_length = max_length
+
+    def find(self, buffer, start: int, end: int) -> tuple:
+        """Returns (offset, length) of the next match in buffer[start:end],
+        or (-1, 0) if there is none
+        """
+        match = self.regex.search(buffer, start, end)
+        if match is None:
+            return -1, 0
+        return match.start(), match.end() - match.start()
+
+    def next_start(self, pos: int, length: int) -> int:
+        """Returns where to look for the next match after one at `pos`;
+        one byte on, since another key may start inside this match
+        """
+        return pos + 1
+
+
+# Stands for "any line may match", for when a search can't be narrowed down
+# in bytes; files are then read as text
+UNFILTERED = RegexPattern(re.compile(b''), 0)
+
+
+class LiteralMatcher:
+
+    def __init__(self, key: str):
+        """Matches a single key exactly, the way searches always have
+
+        :param key: the string to search for
+        """
+        self.key = key
+        self.keys = (key,)
+        self.cache_key = key
+        self.spans_lines = '\n' in key or '\r' in key
+        self.max_distance = None  # exact; see FuzzyMatcher
+        # Whether the byte pattern finds the matches themselves, rather
+        # than the lines that may contain one
+        self.matches_in_bytes = True
+        self.bold_regex = None  # the snippet bolds instances of the key
+        self.patterns = {}  # encoding -> LiteralPattern or None
+
+    def byte_pattern(self, encoding: str):
+        """Returns the pattern finding the key in bytes of an encoding
+
+        :return: LiteralPattern, or None if the key can't be encoded
+        """
+        if encoding not in self.patterns:
+            try:
+                self.patterns[encoding] = LiteralPattern(
+                    self.key.encode(encoding))
+            except UnicodeEncodeError:
+                self.patterns[encoding] = None
+        return self.patterns[encoding]
+
+    def match_at(self, text: str, offset: int) -> tuple:
+        """Returns the matches at `offset` in `text`: ((key, matched text),)
+        or ()
+        """
+        return ((self.key, self.key),) if text.startswith(self.key, offset) \
+            else ()
+
+    def search_text(self, text: str, start: int = 0) -> tuple:
+        """Returns (offset, matches) of the next match in text[start:], see
+        `match_at`, or (-1, ()) if there is none
+        """
+        offset = text.find(self.key, start)
+        return offset, ((self.key, self.key),) if offset != -1 else ()
+
+    def next_start(self, offset: int, matches: tuple) -> int:
+        """Returns where to look for the next match after one at `offset`
+        """
+        return offset + max(len(self.key), 1)
+
+    def literal_alternatives(self) -> list:
+        """Returns the strings a file must contain to have a match
+
+        :return: list of alternatives, each a list of strings that all
+                 occur in a matching file
+        """
+        return [[self.key]]
+
+    def __getstate__(self):
+        # Compiled patterns are rebuilt where they are needed
+        state = dict(self.__dict__)
+        state['patterns'] = {}
+        return state
+
+
+class MultiKeyMatcher:
+
+    def __init__(self, keys: list, ignore_case: bool = False):
+        """Matches any of several keys in a single pass
+
+        Overlapping matches of different keys are all found, including
+        keys that match at the same place as a longer one.
+
+        :param keys: the strings to search for
+        :param ignore_case: whether to match the keys regardless of case
+        """
+        # Empty keys would match everywhere; duplicates add nothing
+        unique = {}
+        for key in keys:
+            if key:
+                unique.setdefault(key.lower() if ignore_case else key, key)
+        self.keys = tuple(sorted(unique.values()))
+        self.ignore_case = ignore_case
+        self.cache_key = ('keys', ignore_case) + self.keys
+        self.spans_lines = any('\n' in key or '\r' in key
+                               for key in self.keys)
+        self.max_distance = None
+        # Lowercasing changes the length of some keys, e.g. 'İ' becomes 'i'
+        # and a combining dot, and then their lowercase doesn't match them
+        # even ignoring case
+        same_length = all(len(folded) == len(key)
+                          for folded, key in unique.items())
+        if same_length:
+            source = trie_pattern(unique)
+        else:
+            # The keys themselves, longest first so the longest key at a
+            # place still wins
+            source = '|'.join(re.escape(key) for key in sorted(
+                self.keys, key=len, reverse=True))
+        self.text_regex = re.compile(source,
+                                     re.IGNORECASE if ignore_case else 0)
+        # The regex finds the longest key at a place; any shorter key
+        # matching there is a prefix of it. Keyed on the lowercase of the
+        # keys when ignoring case; left empty when that can't be trusted,
+        # so `keys_matching` checks each key instead
+        self.matching_keys = {
+            folded: tuple(unique[other]
+                          for other in sorted(unique, key=len, reverse=True)
+                          if folded.startswith(other))
+            for folded in unique} if same_length else {}
+        self.matches_in_bytes = not ignore_case
+        self.bold_regex = self.text_regex if ignore_case else None
+        self.fragments = None
+        if ignore_case:
+            alternatives = []
+            for key in self.keys:
+                alternatives.extend(
+                    required_literals(re.escape(key), re.IGNORECASE))
+            self.fragments = prefilter_fragments(alternatives)
+        self.patterns = {}  # encoding -> pattern or None
+
+    def byte_pattern(self, encoding: str):
+        """Returns the pattern finding the keys in bytes of an encoding
+
+        Keys that can't be encoded are left out. When ignoring case, the
+        pattern only finds lines that may contain a key, see
+        `prefilter_pattern`.
+
+        :return: the pattern, or None if no key can occur
+        """
+        if encoding not in self.patterns:
+            if self.ignore_case:
+                self.patterns[encoding] = prefilter_pattern(self.fragments,
+                                                            encoding)
+                return self.patterns[encoding]
+            encoded = []
+            for key in self.keys:
+                try:
+                    encoded.append(key.encode(encoding))
+                except UnicodeEncodeError:
+                    pass
+            self.patterns[encoding] = RegexPattern(
+                re.compile(trie_pattern(encoded, as_bytes=True)),
+                max(map(len, encoded))) if encoded else None
+        return self.patterns[encoding]
+
+    def keys_matching(self, matched: str) -> tuple:
+        """Returns the matches for the longest key found at a place, see
+        `match_at`
+        """
+        if not self.ignore_case:
+            return tuple((key, key) for key in self.matching_keys[matched])
+        keys = self.matching_keys.get(matched.lower())
+        if keys is None:
+            # Lowercasing doesn't always agree with how the regex ignores
+            # case; rare enough to check each key
+            keys = tuple(key for key in sorted(self.keys, key=len,
+                                               reverse=True)
+                         if re.match(re.escape(key), matched, re.IGNORECASE))
+        return tuple((key, re.match(re.escape(key), matched,
+                                    re.IGNORECASE).group())
+                     if len(keys) > 1 else (key, matched)
+                     for key in keys)
+
+    def match_at(self, text: str, offset: int) -> tuple:
+        """Returns the matches at `offset` in `text`, longest first, as
+        ((key, matched text), ...)
+        """
+        match = self.text_regex.match(text, offset)
+        return self.keys_matching(match.group()) if match else ()
+
+    def search_text(self, text: str, start: int = 0) -> tuple:
+        """Returns (offset, matches) of the next match in text[start:], see
+        `match_at`, or (-1, ()) if there is none
+        """
+        match = self.text_regex.search(text, start)
+        if match is None:
+            return -1, ()
+        return match.start(), self.keys_matching(match.group())
+
+    def next_start(self, offset: int, matches: tuple) -> int:
+        """Returns where to look for the next match after one at `offset`
+
+        Only one character on, since another key may start inside these
+        """
+        return offset + 1
+
+    def literal_alternatives(self) -> list:
+        """Returns the strings a file must contain to have a match
+
+        :return: list of alternatives, each a list of strings that all
+                 occur in a matching file
+        """
+        if self.ignore_case:
+            # Any case of the keys may occur
+            return [[]]
+        return [[key] for key in self.keys]
+
+    def __getstate__(self):
+        # Compiled patterns are rebuilt where they are needed
+        state = dict(self.__dict__)
+        state['patterns'] = {}
+        return state
+
+
+class RegexMatcher:
+
+    def __init__(self, patterns: list, ignore_case: bool = False):
+        """Matches regular expressions against each line
+
+        Each line is searched for every expression, and the matches of each
+        expression are found the way `re.finditer` would find them. Empty
+        matches are ignored. The expressions only see one line at a time.
+
+        :param patterns: regular expression sources; each is a key
+        :param ignore_case: whether to match regardless of case
+        :raises re.error: if an expression is invalid
+        """
+        self.keys = tuple(dict.fromkeys(pattern for pattern in patterns
+                                        if pattern))
+        self.ignore_case = ignore_case
+        self.cache_key = ('regex', ignore_case) + self.keys
+        self.spans_lines = False
+        self.max_distance = None
+        self.matches_in_bytes = False
+        flags = re.IGNORECASE if ignore_case else 0
+        self.regexes = [re.compile(pattern, flags) for pattern in self.keys]
+        self.bold_regex = self.regexes[0] if len(self.regexes) == 1 \
+            else re.compile('|'.join('(?:%s)' % pattern
+                                     for pattern in self.keys), flags)
+        self.alternatives = []
+        for pattern in self.keys:
+            self.alternatives.extend(required_literals(pattern, flags))
+        self.fragments = prefilter_fragments(self.alternatives)
+        # Skips lines without any fragment before running the expressions
+        self.line_filter = None
+        if self.fragments is not None:
+            self.line_filter = re.compile(
+                trie_pattern({fragment for fragment, _ in self.fragments}),
+                re.IGNORECASE if any(folded for _, folded in self.fragments)
+                else 0)
+        self.patterns = {}  # encoding -> pattern or None
+
+    def byte_pattern(self, encoding: str):
+        """Returns the pattern finding the lines that may match in bytes of
+        an encoding, see `prefilter_pattern`
+        """
+        if encoding not in self.patterns:
+            self.patterns[encoding] = prefilter_pattern(self.fragments,
+                                                        encoding)
+        return self.patterns[encoding]
+
+    def match_at(self, text: str, offset: int) -> tuple:
+        """Returns the non-empty matches at `offset` in `text`, as
+        ((pattern, matched text), ...)
+        """
+        matches = []
+        for pattern, regex in zip(self.keys, self.regexes):
+            match = regex.match(text, offset)
+            if match and match.end() > offset:
+                matches.append((pattern, match.group()))
+        return tuple(matches)
+
+    def search_text(self, text: str, start: int = 0) -> tuple:
+        """Returns (offset, matches) of the next match in text[start:], see
+        `match_at`, or (-1, ()) if there is none
+        """
+        if (start == 0 and self.line_filter is not None
+                and not self.line_filter.search(text)):
+            return -1, ()
+        best = -1
+        matches = []
+        for pattern, regex in zip(self.keys, self.regexes):
+            position = start
+            match = regex.search(text, position)
+            while match is not None and match.end() == match.start():
+                position = match.start() + 1
+                match = regex.search(text, position) \
+                    if position <= len(text) else None
+            if match is None or (best != -1 and match.start() > best):
+                continue
+            if match.start() != best:
+                best = match.start()
+                matches = []
+            matches.append((pattern, match.group()))
+        return best, tuple(matches)
+
+    def next_start(self, offset: int, matches: tuple) -> int:
+        """Returns where to look for the next match after one at `offset`
+
+        Past the match with a single expression, as `re.finditer` would;
+        one character on with several, since another may match inside it
+        """
+        if len(self.regexes) == 1:
+            return offset + max(len(matches[0][1]), 1)
+        return offset + 1
+
+    def literal_alternatives(self) -> list:
+        """Returns the strings a file must contain to have a match
+
+        :return: list of alternatives, each a list of strings that all
+                 occur in a matching file
+        """
+        return [[fragment for fragment, folded in alternative if not folded]
+                for alternative in self.alternatives]
+
+    def __getstate__(self):
+        # Compiled patterns are rebuilt where they are needed
+        state = dict(self.__dict__)
+        state['patterns'] = {}
+        return state
+
+
+def key_pieces(key: str, count: int) -> list:
+    """Splits a key into `count` pieces of nearly equal length
+    """
+    bounds = [len(key) * index // count for index in range(count + 1)]
+    return [key[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def fuzzy_pieces(key: str, max_distance: int) -> list:
+    """Returns parts of a key at least one of which is intact wherever the
+    key occurs with at most `max_distance` edits
+
+    These are `max_distance` + 1 pieces with a character left out between
+    each two, so no edit, not even a swap of neighbouring characters, can
+    break two of them. Pieces may be empty for short keys.
+    """
+    pieces = key_pieces(key[:len(key) - max_distance], max_distance + 1)
+    # Each piece but the first shifts right by one left out character
+    return [key[offset:offset + len(piece)] for offset, piece in zip(
+        [sum(len(piece) + 1 for piece in pieces[:index])
+         for index in range(len(pieces))], pieces)]
+
+
+class FuzzyMatcher:
+
+    def __init__(self, keys: list, max_distance: int,
+                 ignore_case: bool = False):
+        """Matches keys with up to `max_distance` edits, see the module
+        docstring
+
+        Each key's matches in a line are the places where it needs the
+        fewest edits, at most `max_distance`, and don't overlap each
+        other. Matches only see one line at a time.
+
+        :param keys: the strings to search for
+        :param max_distance: most characters inserted, deleted or replaced
+        :param ignore_case: whether to match regardless of case
+        :raises ValueError: if a key isn't longer than `max_distance`, so
+                            it would match anywhere
+        """
+        self.keys = tuple(dict.fromkeys(key for key in keys if key))
+        for key in self.keys:
+            if len(key) <= max_distance:
+                raise ValueError('%r is too short for %d edits'
+                                 % (key, max_distance))
+        self.max_distance = max_distance
+        self.ignore_case = ignore_case
+        self.cache_key = ('fuzzy', max_distance, ignore_case) + self.keys
+        self.spans_lines = False
+        self.matches_in_bytes = False
+        self.bold_regex = None  # the snippet bolds the matched text itself
+        flags = re.IGNORECASE if ignore_case else 0
+        self.pieces = []  # at least one of these is in every match
+        self.alternatives = []
+        for key in self.keys:
+            for piece in fuzzy_pieces(key, max_distance):
+                self.pieces.append(piece)
+                self.alternatives.extend(
+                    required_literals(re.escape(piece), flags))
+        self.fragments = prefilter_fragments(self.alternatives)
+        # key -> {character: bit mask of the positions in the key it
+        # matches}, for Myers' algorithm
+        self.masks = {}
+        # key -> expression finding where in a line a piece of the key
+        # starts; a match is never further away than the key is long, plus
+        # `max_distance`
+        self.piece_regexes = {}
+        for key in self.keys:
+            masks = {}
+            for position, char in enumerate(key):
+                for variant in self.variants(char):
+                    masks[variant] = masks.get(variant, 0) | 1 << position
+            self.masks[key] = masks
+            self.piece_regexes[key] = re.compile('(?=%s)' % '|'.join(
+                ''.join('[%s]' % ''.join(map(re.escape,
+                                             sorted(self.variants(char))))
+                        for char in piece)
+                for piece in fuzzy_pieces(key, max_distance)))
+        self.line_matches = (None, [])  # (line, matches) of the last line
+        self.patterns = {}  # encoding -> pattern or None
+
+    def variants(self, char: str) -> set:
+        """Returns the characters that match `char`
+        """
+        if not self.ignore_case:
+            return {char}
+        return {char, char.lower(), char.upper()}
+
+    def byte_pattern(self, encoding: str):
+        """Returns the pattern finding the lines that may match in bytes of
+        an encoding, see `prefilter_pattern`
+        """
+        if encoding not in self.patterns:
+            self.patterns[encoding] = prefilter_pattern(self.fragments,
+                                                        encoding)
+        return self.patterns[encoding]
+
+    def match_ends(self, key: str, text: str):
+        """Yields (index, edits) for every index of `text` at which a
+        substring ending there matches `key` with at most `max_distance`
+        edits, using Myers' bit-vector algorithm with Hyyrö's extension
+        for swaps
+        """
+        masks = self.masks[key]
+        full = (1 << len(key)) - 1
+        last_bit = 1 << (len(key) - 1)
+        positive = full  # vertical differences of +1, as bits
+        negative = 0  # vertical differences of -1
+        diagonal = 0  # diagonal differences of 0 at the previous character
+        previous_equal = 0
+        edits = len(key)
+        for index, char in enumerate(text):
+            equal = masks.get(char, 0)
+            swapped = ((~diagonal & equal) << 1) & previous_equal
+            diagonal = ((((equal & positive) + positive) ^ positive) | equal
+                        | negative | swapped)
+            up = negative | ~(diagonal | positive)
+            down = positive & diagonal
+            if up & last_bit:
+                edits += 1
+            elif down & last_bit:
+                edits -= 1
+            # A match may start anywhere, so no difference enters at the top
+            up <<= 1
+            down <<= 1
+            positive = (down | ~(diagonal | up)) & full
+            negative = up & diagonal & full
+            previous_equal = equal
+            if edits <= self.max_distance:
+                yield index, edits
+
+    def alignment_costs(self, key: str, text: str) -> list:
+        """Returns the edits needed to turn `key` into each prefix of
+        `text`, by dynamic programming
+        """
+        costs = list(range(len(text) + 1))
+        previous = None
+        previous_variants = set()
+        for i, char in enumerate(key, 1):
+            variants = self.variants(char)
+            before, previous = previous, costs
+            costs = [i]
+            for j, text_char in enumerate(text, 1):
+                cost = min(previous[j] + 1, costs[j - 1] + 1,
+                           previous[j - 1] + (text_char not in variants))
+                if (j > 1 and text_char in previous_variants
+                        and text[j - 2] in variants):
+                    # The two characters swapped
+                    cost = min(cost, before[j - 2] + 1)
+                costs.append(cost)
+            previous_variants = variants
+        return costs
+
+    def best_start(self, key: str, text: str, end: int) -> int:
+        """Returns where the match of `key` ending at index `end` of `text`
+        starts, by aligning the key backwards from there
+
+        Of the starts needing the fewest edits, the one making the match
+        closest in length to the key is taken.
+        """
+        earliest = max(0, end + 1 - len(key) - self.max_distance)
+        # costs[j]: edits to match the key with the j characters before
+        # the end
+        costs = self.alignment_costs(key[::-1],
+                                     text[earliest:end + 1][::-1])
+        best = min(costs)
+        length = min((j for j, cost in enumerate(costs) if cost == best),
+                     key=lambda j: abs(j - len(key)))
+        return end + 1 - length
+
+    def distance(self, key: str, matched: str) -> int:
+        """Returns the number of edits that turn `key` into `matched`
+        """
+        return self.alignment_costs(key, matched)[-1]
+
+    def key_matches(self, key: str, text: str) -> list:
+        """Returns [(offset, key, matched text), ...] for the matches of a
+        key in a line
+        """
+        matches = []
+        windows = []  # [start, end) of the parts of the line to scan
+        reach = len(key) + self.max_distance
+        for piece in self.piece_regexes[key].finditer(text):
+            start = max(0, piece.start() - reach)
+            if windows and start <= windows[-1][1]:
+                windows[-1][1] = piece.start() + reach
+            else:
+                windows.append([start, piece.start() + reach])
+        # Windows don't touch, so their ends are never consecutive
+        ends = [(start + index, edits) for start, end in windows
+                for index, edits in self.match_ends(key, text[start:end])]
+        ends.append((float('inf'), None))
+        # Consecutive ends belong to one match. It ends where the fewest
+        # edits are needed, and is then as close to the key in length as
+        # possible
+        run = []
+        for index, edits in ends:
+            if run and index > run[-1][0] + 1:
+                fewest = min(edits for _, edits in run)
+                spans = [(self.best_start(key, text, end), end)
+                         for end, edits in run if edits == fewest]
+                start, end = min(spans, key=lambda span: abs(
+                    span[1] + 1 - span[0] - len(key)))
+                if not matches or start >= matches[-1][0] \
+                        + len(matches[-1][2]):
+                    matches.append((start, key, text[start:end + 1]))
+                run = []
+            run.append((index, edits))
+        return matches
+
+    def search_line(self, text: str) -> list:
+        """Returns [(offset, key, matched text), ...] for every match in a
+        line, in order, remembering them for the next calls with the line
+        """
+        if self.line_matches[0] is not text:
+            matches = []
+            for key in self.keys:
+                matches.extend(self.key_matches(key, text))
+            matches.sort(key=lambda match: match[0])
+            self.line_matches = (text, matches)
+        return self.line_matches[1]
+
+    def search_text(self, text: str, start: int = 0) -> tuple:
+        """Returns (offset, matches) of the next match in text[start:], as
+        ((key, matched text), ...), or (-1, ()) if there is none
+        """
+        found = -1
+        matches = []
+        for offset, key, matched in self.search_line(text):
+            if offset < start or (found != -1 and offset > found):
+                continue
+            found = offset
+            matches.append((key, matched))
+        return found, tuple(matches)
+
+    def match_at(self, text: str, offset: int) -> tuple:
+        """Returns the matches starting at `offset` in `text`, as
+        ((key, matched text), ...)
+        """
+        found, matches = self.search_text(text, offset)
+        return matches if found == offset else ()
+
+    def next_start(self, offset: int, matches: tuple) -> int:
+        """Returns where to look for the next match after one at `offset`
+        """
+        return offset + 1
+
+    def literal_alternatives(self) -> list:
+        """Returns the strings a file must contain to have a match
+
+        :return: list of alternatives, each a list of strings that all
+                 occur in a matching file
+        """
+        if self.ignore_case:
+            return [[]]
+        return [[piece] for piece in self.pieces]
+
+    def __getstate__(self):
+        # Compiled patterns are rebuilt where they are needed
+        state = dict(self.__dict__)
+        state['patterns'] = {}
+        state['line_matches'] = (None, [])
+        return state
+
+
+def make_matcher(key, ignore_case: bool = False, regex: bool = False,
+                 max_distance: int = None):
+    """Returns the matcher for the key(s) of a search
+
+    :param key: a string, a list of strings to find all of in one pass, or
+                a matcher, which is returned as is
+    :param ignore_case: whether to match regardless of case
+    :param regex: whether the keys are regular expressions
+    :param max_distance: if set, the keys also match with up to this many
+                         edits, see FuzzyMatcher
+    :raises re.error: if `regex` and a key isn't a valid expression
+    :raises ValueError: if both `regex` and `max_distance` are given, or a
+                        key is too short for `max_distance`
+    """
+    if not isinstance(key, (str, list, tuple)):
+        return key
+    keys = [key] if isinstance(key, str) else list(key)
+    if max_distance is not None:
+        if regex:
+            raise ValueError('regular expressions cannot be fuzzy')
+        return FuzzyMatcher(keys, max_distance, ignore_case)
+    if regex:
+        return RegexMatcher(keys, ignore_case)
+    if ignore_case:
+        return MultiKeyMatcher(keys, ignore_case=True)
+    if isinstance(key, str):
+        return LiteralMatcher(key)
+    distinct = set(keys) - {''}
+    if len(distinct) <= 1:
+        return LiteralMatcher(distinct.pop() if distinct else '')
+    return MultiKeyMatcher(keys)
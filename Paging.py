@@ -0,0 +1,305 @@
+"""
+PersonalKnowledgeEngine
+
+Searches that return their hits a page at a time; serves "cli" and "GUI"
+
+`search_page` returns the first hits of a search, up to a limit, and a
+cursor saying where it stopped. Passing the cursor back returns the next
+page, and so on until no cursor is returned. Pages walk the files sorted by
+name (see `Backend.walk_files`), so every page sees them in the same order
+and starts where the previous one stopped, skipping the directories before
+it without listing them. A cursor holds
+
+    - the include path and the file the previous page stopped in
+    - where in that file: the line of the last hit returned and how many
+      hits on that line were, and for memory-mapped files the byte offset
+      of the line, which the search of the file carries on from
+
+Each page searches only until it is full, so memory and time per page don't
+grow with the number of hits. Fuzzy matches, boolean queries and archives
+don't have their hits in line order; the file a page stopped in is then
+searched again whole, skipping the hits already returned.
+
+Cursors are short strings, to keep or pass on a command line as they are.
+They only work for the search they came from. Hits in files that change
+between pages may be returned twice or missed.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import base64
+from collections import namedtuple
+import hashlib
+import json
+
+from Archives import archive_format
+from Backend import ENCODING_RULES, SearchCancelled, call_on_file, \
+    normalize_search_rules, search_path_for_string, walk_files
+from Matchers import make_matcher
+from Query import Query, QueryMatcher
+from Ranking import HitSample, SampleComplete
+from Stats import SearchStats
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+PAGE_HITS = 100  # hits per page unless asked otherwise
+CURSOR_VERSION = 1  # changes whenever the contents of cursors do
+SEARCH_DIGEST_BYTES = 8  # size of the hash telling searches apart
+
+# Where a page stopped, see the module docstring. `search` is a hash of the
+# search's key and rules, `root` the index of the include path in the
+# sorted rules and `path` the file. `line` is None if the next page starts
+# at the top of the file and skips its first `skip` hits; otherwise `skip`
+# hits on `line` were returned, and `offset` is the byte offset of `line`
+# if the file was memory-mapped
+SearchCursor = namedtuple('SearchCursor',
+                          ['search', 'root', 'path', 'line', 'offset',
+                           'skip'])
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+def encode_cursor(cursor: SearchCursor) -> str:
+    """Returns a cursor as a string of URL-safe characters
+    """
+    data = json.dumps([CURSOR_VERSION] + list(cursor)).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(text: str) -> SearchCursor:
+    """Returns the cursor a string from `encode_cursor` stands for
+
+    :raises ValueError: if the string isn't such a cursor
+    """
+    try:
+        data = base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+        fields = json.loads(data.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('invalid cursor')
+    if (not isinstance(fields, list)
+            or len(fields) != len(SearchCursor._fields) + 1
+            or fields[0] != CURSOR_VERSION):
+        raise ValueError('invalid cursor')
+    return SearchCursor(*fields[1:])
+
+
+def search_digest(matcher, rules: tuple, options: dict) -> str:
+    """Returns a hash of everything that decides which hits a search has
+    and in what order, for a cursor to tell whether it belongs to it
+
+    :param matcher: the search's matcher, see "Matchers"
+    :param rules: the search's rules, see `Backend.normalize_search_rules`
+    :param options: the search's other options
+    """
+    described = repr((matcher.cache_key, rules, sorted(options.items())))
+    return hashlib.blake2b(described.encode('utf-8'),
+                           digest_size=SEARCH_DIGEST_BYTES).hexdigest()
+
+
+class HitWindow(HitSample):
+
+    def __init__(self, max_hits: int, line: int = None, offset: int = None,
+                 skip: int = 0):
+        """Keeps the hits of a file that come after a position, up to
+        `max_hits` of them, and stops the search once there are more
+
+        Hits must be offered in line order.
+
+        :param max_hits: most hits to keep
+        :param line: line the position is on, or None for the top of the
+                     file
+        :param offset: byte offset of `line`, if known. A memory-mapped file
+                       is then only searched from there, see
+                       `Backend.search_file_for_string`
+        :param skip: number of hits on `line` that come before the position
+        """
+        super(HitWindow, self).__init__(max_hits)
+        self.line = line
+        self.offset = offset
+        self.skip = skip
+        self.current_line = None  # line of the last hit offered
+        self.on_line = 0  # hits offered on it
+        # (line, offset, hits on the line up to it) of the last hit kept
+        self.last = None
+        self.more = False  # whether hits came after the kept ones
+
+    def offer(self, key, line: int = None, offset: int = None) -> bool:
+        """Returns whether a hit is after the position and fits in the
+        window. Raises Ranking.SampleComplete at the first hit that doesn't
+        fit
+        """
+        if line != self.current_line:
+            self.current_line = line
+            self.on_line = 0
+        self.on_line += 1
+        if self.line is not None and (line < self.line or line == self.line
+                                      and self.on_line <= self.skip):
+            return False
+        if len(self.hits) >= self.max_hits:
+            self.more = True
+            raise SampleComplete()
+        self.last = (line, offset, self.on_line)
+        return True
+
+    def add(self, hit) -> None:
+        """Keeps a hit that `offer` accepted
+        """
+        self.hits.append(hit)
+
+    def __len__(self) -> int:
+        """Returns the number of hits kept
+        """
+        return len(self.hits)
+
+
+def search_page(key,
+                include_paths: list,
+                include_exts: list = None,
+                exclude_paths: list = None,
+                cursor: str = None,
+                max_hits: int = PAGE_HITS,
+                terminate_search: list = None,
+                follow_symlinks: bool = False,
+                all_matches: bool = False,
+                encodings: tuple = ENCODING_RULES,
+                max_file_size: int = None,
+                ignore_case: bool = False,
+                regex: bool = False,
+                extract_cache_dir: str = None,
+                archives: bool = False,
+                query: bool = False,
+                max_distance: int = None,
+                snippets: bool = True,
+                stats: SearchStats = None) -> tuple:
+    """Returns one page of the hits of a search, see the module docstring
+
+    Files are searched in this process, one at a time. See
+    `Backend.search_for_string` for the parameters not listed here.
+
+    :param cursor: the cursor the previous page came with, or None for the
+                   first page
+    :param max_hits: most hits to return
+    :param terminate_search: optional single-element list containing a bool
+                             that says whether to stop early. A page that is
+                             stopped returns the hits found so far, and a
+                             cursor to carry on from the file it was in
+    :return: ([(path, SearchHit), ...], cursor of the next page, or None if
+             this is the last one). The page after a full one may be empty
+    :raises ValueError: if `cursor` is invalid, or from another search
+    """
+    if max_hits < 1:
+        raise ValueError('max_hits must be at least 1')
+    if query:
+        matcher = QueryMatcher(Query(key), ignore_case, regex, max_distance)
+    else:
+        matcher = make_matcher(key, ignore_case, regex, max_distance)
+    rules = normalize_search_rules(include_paths,
+                                   include_exts,
+                                   exclude_paths,
+                                   follow_symlinks,
+                                   archives)
+    roots, include_exts, exclude_paths = rules[:3]
+    file_options = dict(all_matches=all_matches,
+                        encodings=tuple(encodings),
+                        max_file_size=max_file_size,
+                        extract_cache_dir=extract_cache_dir,
+                        snippets=snippets)
+    if archives:
+        file_options['archive_rules'] = (include_exts, exclude_paths)
+    digest = search_digest(matcher, rules, file_options)
+    start = None
+    if cursor is not None:
+        start = decode_cursor(cursor)
+        if start.search != digest:
+            raise ValueError('the cursor is from another search')
+    if terminate_search is None:
+        terminate_search = [False]
+    if stats is None:
+        stats = SearchStats()
+
+    page = []
+    next_cursor = []  # the cursor, once the page is over
+    # Where to carry on if the search is stopped between files: after the
+    # hits of the last file searched. An empty path comes before any other
+    searched_to = [start or SearchCursor(digest, 0, '', None, None, 0)]
+
+    def search_file_func(root: int, path: str):
+        """Adds the hits of a file to the page, or ends the page
+        """
+        if start is not None and (root, path) == start[1:3]:
+            position = start
+        else:
+            position = SearchCursor(digest, root, path, None, None, 0)
+        room = max_hits - len(page)
+        if not room:
+            next_cursor.append(position)
+            return
+        in_order = (max_distance is None and not query
+                    and not (archives and archive_format(path) is not None))
+        options = dict(file_options)
+        if in_order:
+            window = HitWindow(room, *position[3:])
+            options['window'] = window
+        found = [(hit_path, hit) for hit_path, hits in search_path_for_string(
+                 path, matcher, stats=stats, terminate_early=terminate_search,
+                 **options) for hit in hits]
+        if in_order:
+            page.extend(found)
+            if window.last is not None:
+                position = SearchCursor(digest, root, path, *window.last)
+            if window.more:
+                next_cursor.append(position)
+            searched_to[0] = position
+            return
+        page.extend(found[position.skip:position.skip + room])
+        skip = min(position.skip + room, len(found))
+        searched_to[0] = SearchCursor(digest, root, path, None, None, skip)
+        if skip < len(found):
+            next_cursor.append(searched_to[0])
+
+    def visit_file(root: int, path: str):
+        """Searches a file, or starts the next page at it if the search is
+        stopped in the middle of it
+        """
+        stats.count('files_found')
+        hits_before = len(page)
+        try:
+            search_file_func(root, path)
+        except SearchCancelled:
+            del page[hits_before:]
+            next_cursor.append(start if start is not None
+                               and (root, path) == start[1:3]
+                               else SearchCursor(digest, root, path, None,
+                                                 None, 0))
+            return
+        if len(page) > hits_before:
+            stats.count('files_with_hits')
+            stats.count('hits', len(page) - hits_before)
+
+    try:
+        for root in range(start.root if start is not None else 0,
+                          len(roots)):
+            start_at = start.path if start is not None \
+                and root == start.root else None
+            for path in walk_files(terminate_search,
+                                   [roots[root]],
+                                   include_exts,
+                                   exclude_paths,
+                                   follow_symlinks,
+                                   archives,
+                                   stats,
+                                   sort=True,
+                                   start_at=start_at):
+                call_on_file(lambda path: visit_file(root, path), path,
+                             stats)
+                if next_cursor:
+                    break
+            if next_cursor:
+                break
+    finally:
+        stats.finish()
+    if not next_cursor and terminate_search[0]:
+        next_cursor.append(searched_to[0])
+    if not next_cursor:
+        return page, None
+    return page, encode_cursor(next_cursor[0])
@@ -0,0 +1,451 @@
+"""
+PersonalKnowledgeEngine
+
+Boolean queries over the lines of a file; serves "Backend"
+
+A query combines terms with operators, from loosest to tightest binding:
+
+    a OR b          files containing a, b or both
+    a AND b, a b    files containing both a and b
+    a NEAR/3 b      files where a and b occur within 3 lines of each other
+    NOT a           files not containing a
+    "two words"     a phrase, matched as a single term
+    ( ... )         grouping
+
+Operators must be written in capitals; anything else is a term. All terms
+are looked for in a single pass over each file, with one matcher for all of
+them (see "Matchers"), and the query is evaluated as hits come in. Until a
+file has been read to the end, a term that hasn't been seen yet may still
+turn up, so the outcome of the query can be unknown. As soon as it is known
+(e.g. a NOT term turned up, or every required term has been seen) the rest
+of the file isn't read. A file matching the query is reported with its hits
+for the terms that aren't negated, so queries need at least one such term.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import re
+
+from Matchers import make_matcher
+from Ranking import HitSample, SampleComplete
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+# Tokens: a quoted phrase, a parenthesis, or a run of other characters
+TOKEN_REGEX = re.compile(r'"([^"]*)"|([()])|([^\s()"]+)')
+NEAR_REGEX = re.compile(r'NEAR/(\d+)$')
+# Most literal alternatives an AND may have for the index before only its
+# most selective operand is used, see `Query.literal_alternatives`
+MAX_LITERAL_ALTERNATIVES = 64
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+class QueryError(ValueError):
+    """Raised for a query that can't be parsed
+    """
+
+
+class QueryState:
+
+    def __init__(self):
+        """What has been seen of a file so far while a query is evaluated
+        """
+        self.last_line = {}  # term -> line number it was last seen on
+        self.near_found = set()  # ids of the NEAR nodes already satisfied
+
+
+class Term:
+
+    def __init__(self, text: str):
+        """A word or phrase of a query
+        """
+        self.text = text
+
+    def evaluate(self, state: QueryState, final: bool):
+        """Returns True or False, or None while that isn't known yet
+
+        :param state: what has been seen of the file so far
+        :param final: whether the whole file has been seen
+        """
+        if self.text in state.last_line:
+            return True
+        return False if final else None
+
+    def children(self) -> list:
+        return []
+
+    def __repr__(self):
+        return 'Term(%r)' % self.text
+
+
+class Not:
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, state: QueryState, final: bool):
+        value = self.operand.evaluate(state, final)
+        return None if value is None else not value
+
+    def children(self) -> list:
+        return [self.operand]
+
+    def __repr__(self):
+        return 'Not(%r)' % self.operand
+
+
+class And:
+
+    def __init__(self, operands: list):
+        self.operands = operands
+
+    def evaluate(self, state: QueryState, final: bool):
+        values = [operand.evaluate(state, final) for operand in self.operands]
+        if False in values:
+            return False
+        return True if None not in values else None
+
+    def children(self) -> list:
+        return self.operands
+
+    def __repr__(self):
+        return 'And(%r)' % self.operands
+
+
+class Or:
+
+    def __init__(self, operands: list):
+        self.operands = operands
+
+    def evaluate(self, state: QueryState, final: bool):
+        values = [operand.evaluate(state, final) for operand in self.operands]
+        if True in values:
+            return True
+        return False if None not in values else None
+
+    def children(self) -> list:
+        return self.operands
+
+    def __repr__(self):
+        return 'Or(%r)' % self.operands
+
+
+class Near:
+
+    def __init__(self, left: Term, right: Term, distance: int):
+        """Two terms that occur within `distance` lines of each other
+        """
+        self.left = left
+        self.right = right
+        self.distance = distance
+
+    def observe(self, state: QueryState, term: str, line: int) -> None:
+        """Checks a new occurrence of one of the terms against the last one
+        of the other
+
+        Lines come in order, so the closest earlier occurrence of the other
+        term is always its last one.
+        """
+        for this, other in ((self.left, self.right),
+                            (self.right, self.left)):
+            if this.text == term and other.text in state.last_line:
+                if line - state.last_line[other.text] <= self.distance:
+                    state.near_found.add(id(self))
+
+    def evaluate(self, state: QueryState, final: bool):
+        if id(self) in state.near_found:
+            return True
+        return False if final else None
+
+    def children(self) -> list:
+        return [self.left, self.right]
+
+    def __repr__(self):
+        return 'Near(%r, %r, %d)' % (self.left, self.right, self.distance)
+
+
+class QueryParser:
+
+    def __init__(self, text: str):
+        """Recursive descent parser for the grammar in the module docstring
+        """
+        self.tokens = []  # (kind, value); kind is 'term', 'op' or a paren
+        for match in TOKEN_REGEX.finditer(text):
+            phrase, paren, word = match.groups()
+            if phrase is not None:
+                self.tokens.append(('term', phrase))
+            elif paren is not None:
+                self.tokens.append((paren, paren))
+            elif word in ('AND', 'OR', 'NOT') or NEAR_REGEX.match(word):
+                self.tokens.append(('op', word))
+            else:
+                self.tokens.append(('term', word))
+        if text.count('"') % 2:
+            raise QueryError('unbalanced quotes')
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError('empty query')
+        node = self.parse_or()
+        if self.peek()[0] is not None:
+            raise QueryError('unexpected %r' % self.peek()[1])
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == ('op', 'OR'):
+            self.take()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def parse_and(self):
+        operands = [self.parse_near()]
+        while True:
+            kind, value = self.peek()
+            if (kind, value) == ('op', 'AND'):
+                self.take()
+            elif not (kind in ('term', '(') or (kind, value) == ('op', 'NOT')):
+                break
+            # Anything that can start an operand is implicitly ANDed
+            operands.append(self.parse_near())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def parse_near(self):
+        node = self.parse_unary()
+        while True:
+            kind, value = self.peek()
+            match = NEAR_REGEX.match(value) if kind == 'op' else None
+            if match is None:
+                return node
+            self.take()
+            right = self.parse_unary()
+            if not (isinstance(node, Term) and isinstance(right, Term)):
+                raise QueryError('NEAR can only join two terms')
+            node = Near(node, right, int(match.group(1)))
+
+    def parse_unary(self):
+        kind, value = self.take()
+        if (kind, value) == ('op', 'NOT'):
+            return Not(self.parse_unary())
+        if kind == 'term':
+            if not value:
+                raise QueryError('empty phrase')
+            return Term(value)
+        if kind == '(':
+            node = self.parse_or()
+            if self.take()[0] != ')':
+                raise QueryError("missing ')'")
+            return node
+        raise QueryError('expected a term, got %r'
+                         % ('end of query' if kind is None else value))
+
+
+def walk_nodes(node, negated: bool = False):
+    """Yields (node, whether it is under an odd number of NOTs) for every
+    node of a query tree
+    """
+    yield node, negated
+    for child in node.children():
+        for item in walk_nodes(child, negated != isinstance(node, Not)):
+            yield item
+
+
+class Query:
+
+    def __init__(self, text: str):
+        """A parsed query, see the module docstring
+
+        :param text: the query
+        :raises QueryError: if the query can't be parsed, or only has
+                            negated terms
+        """
+        self.text = text
+        self.root = QueryParser(text).parse()
+        self.terms = []  # distinct terms, in the order they are written
+        self.positive = set()  # terms that aren't negated somewhere
+        self.near_nodes = {}  # term -> NEAR nodes it is an operand of
+        for node, negated in walk_nodes(self.root):
+            if isinstance(node, Term):
+                if node.text not in self.terms:
+                    self.terms.append(node.text)
+                if not negated:
+                    self.positive.add(node.text)
+            elif isinstance(node, Near):
+                for term in {node.left.text, node.right.text}:
+                    self.near_nodes.setdefault(term, []).append(node)
+        if not self.positive:
+            raise QueryError('a query needs a term that is not negated')
+
+    def observe(self, state: QueryState, term: str, line: int) -> None:
+        """Records that `term` occurs on line number `line`
+        """
+        for node in self.near_nodes.get(term, ()):
+            node.observe(state, term, line)
+        state.last_line[term] = line
+
+    def evaluate(self, state: QueryState, final: bool = False):
+        """Returns whether a file matches the query, or None while that isn't
+        known yet
+
+        :param state: what has been seen of the file so far
+        :param final: whether the whole file has been seen
+        """
+        return self.root.evaluate(state, final)
+
+    def literal_alternatives(self, term_alternatives) -> list:
+        """Returns the strings a file must contain to match the query
+
+        :param term_alternatives: function that returns the literal
+                                  alternatives of a term, as matchers'
+                                  `literal_alternatives` do
+        :return: list of alternatives, each a list of strings that all
+                 occur in a matching file
+        """
+        def alternatives(node) -> list:
+            if isinstance(node, Term):
+                return term_alternatives(node.text)
+            if isinstance(node, Not):
+                # Nothing in particular has to occur
+                return [[]]
+            if isinstance(node, Or):
+                return [alternative for operand in node.operands
+                        for alternative in alternatives(operand)]
+            # AND and NEAR: every operand has to match
+            combined = [[]]
+            operand_alternatives = [alternatives(child)
+                                    for child in node.children()]
+            for operand in operand_alternatives:
+                combined = [alternative + other for alternative in combined
+                            for other in operand]
+                if len(combined) > MAX_LITERAL_ALTERNATIVES:
+                    # Any one operand still has to match
+                    return min(operand_alternatives, key=len)
+            return combined
+
+        return alternatives(self.root)
+
+
+class QueryMatcher:
+
+    def __init__(self, query: Query, ignore_case: bool = False,
+                 regex: bool = False, max_distance: int = None):
+        """Matches the terms of a query in a single pass; everything but the
+        query itself is left to the matcher for its terms (see "Matchers")
+
+        :param query: the parsed query
+        :param ignore_case: whether to match the terms regardless of case
+        :param regex: whether the terms are regular expressions
+        :param max_distance: if set, the terms also match with up to this
+                             many edits, see `Matchers.FuzzyMatcher`
+        :raises re.error: if `regex` and a term isn't a valid expression
+        :raises ValueError: see `Matchers.make_matcher`
+        """
+        self.query = query
+        self.ignore_case = ignore_case
+        self.regex = regex
+        self.matcher = make_matcher(list(query.terms), ignore_case, regex,
+                                    max_distance)
+        self.cache_key = ('query', ignore_case, regex, max_distance,
+                          query.text)
+        # Key a hit is reported for -> the terms it is an occurrence of
+        self.key_terms = {}
+        for term in query.terms:
+            key = term.lower() if ignore_case and not regex else term
+            self.key_terms.setdefault(key, []).append(term)
+
+    def terms_of(self, key: str) -> list:
+        """Returns the terms of the query a hit for `key` is an occurrence of
+        """
+        if self.ignore_case and not self.regex:
+            key = key.lower()
+        return self.key_terms.get(key, [])
+
+    def literal_alternatives(self) -> list:
+        """Returns the strings a file must contain to match the query
+        """
+        return self.query.literal_alternatives(
+            lambda term: make_matcher(
+                term, self.ignore_case, self.regex,
+                self.matcher.max_distance).literal_alternatives())
+
+    def __getstate__(self):
+        # Without this, the term matcher's state would be pickled instead
+        return dict(self.__dict__)
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+
+    def __getattr__(self, name: str):
+        # Everything else is the term matcher's. The guard keeps unpickling,
+        # which looks attributes up before `matcher` is set, from recursing
+        if name == 'matcher':
+            raise AttributeError(name)
+        return getattr(self.matcher, name)
+
+
+class QueryMatch(HitSample):
+
+    def __init__(self, matcher: QueryMatcher, max_hits: int = None,
+                 stop_when_matched: bool = True):
+        """Collects the hits of a file while evaluating a query on it
+
+        Raises Ranking.SampleComplete to stop the search of the file as soon
+        as the file is known not to match, and, with `stop_when_matched`,
+        as soon as it is known to match. Only hits for terms that aren't
+        negated are kept and counted.
+
+        :param matcher: the matcher of the query
+        :param max_hits: most hits to keep, see HitSample
+        :param stop_when_matched: whether to stop once the file is known to
+                                  match. Off when every hit is to be counted,
+                                  e.g. to rank the file
+        """
+        super(QueryMatch, self).__init__(max_hits)
+        self.matcher = matcher
+        self.query = matcher.query
+        self.stop_when_matched = stop_when_matched
+        self.state = QueryState()
+        self.outcome = None
+
+    def offer(self, key, line: int = None, offset: int = None) -> bool:
+        terms = self.matcher.terms_of(key)
+        for term in terms:
+            self.query.observe(self.state, term, line)
+        self.outcome = self.query.evaluate(self.state)
+        if self.outcome is False:
+            raise SampleComplete()
+        if not any(term in self.query.positive for term in terms):
+            if self.outcome and self.stop_when_matched:
+                raise SampleComplete()
+            return False
+        return super(QueryMatch, self).offer(key, line, offset)
+
+    def add(self, hit) -> None:
+        super(QueryMatch, self).add(hit)
+        if self.outcome and self.stop_when_matched:
+            raise SampleComplete()
+
+    def matches(self) -> bool:
+        """Returns whether the file matches the query, once it has been
+        searched
+        """
+        return bool(self.query.evaluate(self.state, final=True))
+
+    def __len__(self) -> int:
+        """Returns the number of hits counted if the file matches, else 0
+        """
+        if not self.matches():
+            return 0
+        return super(QueryMatch, self).__len__()
@@ -0,0 +1,197 @@
+"""
+PersonalKnowledgeEngine
+
+Relevance ranking of the files a search found; serves "Backend"
+
+In ranked mode a search keeps only the best few files instead of streaming
+every hit. Files are scored with BM25:
+
+    score = sum over keys of idf(key) * tf * (k1 + 1)
+                                      / (tf + k1 * (1 - b + b * size / avg))
+
+    tf:   number of hits for the key in the file
+    idf:  log(1 + (N - df + 0.5) / (df + 0.5)), with N the number of files
+          searched (or indexed) and df the number of those with a hit
+    size: size of the file in bytes; avg is the average over N files
+
+The term statistics come from the files searched so far, or from the index
+when there is one. Only the best files are kept, in a heap of fixed size.
+While the search runs, files are scored with a snapshot of the statistics,
+so a new file and the kept ones are always compared on equal terms; the
+snapshot, and the scores of the kept files, are renewed whenever the
+statistics have grown by RESCORE_GROWTH. The kept files are scored once
+more with the final statistics when the search is over. Each file keeps
+only a few of its hits as snippets, so memory doesn't grow with the number
+of hits.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import heapq
+import math
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+BM25_K1 = 1.2  # how quickly more hits of a key stop raising the score
+BM25_B = 0.75  # how much longer files are penalized, from 0 to 1
+RANKED_SNIPPETS_PER_FILE = 3  # hits kept per file in ranked mode
+# Factor by which the number of files or of files with hits must grow
+# before the statistics files are scored with are renewed
+RESCORE_GROWTH = 1.1
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+class SampleComplete(Exception):
+    """Raised by a HitSample that needs no more hits from its file, to stop
+    the search of the file
+    """
+
+
+class HitSample:
+
+    def __init__(self, max_hits: int = RANKED_SNIPPETS_PER_FILE):
+        """Counts the hits of a file and keeps only a few of them
+
+        The kept hits show as many different keys as possible, and
+        otherwise the first hits in the file.
+
+        :param max_hits: most hits to keep, or None to keep all of them
+        """
+        self.max_hits = max_hits
+        self.counts = {}  # key -> number of hits
+        self.hits = []
+        self.size = 0  # size of the file in bytes, set when it is searched
+
+    def offer(self, key, line: int = None, offset: int = None) -> bool:
+        """Counts a hit for `key` and returns whether it should be kept, so
+        hits that won't be kept are never made
+
+        :param key: the key of the hit
+        :param line: number of the line the hit is on
+        :param offset: byte offset of the start of that line in the file, if
+                       the file is searched as bytes
+        """
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if self.max_hits is None or len(self.hits) < self.max_hits:
+            return True
+        # A key without a kept hit takes the place of a key with several
+        return count == 0 and len(set(hit.key for hit in self.hits)) \
+            < len(self.hits)
+
+    def add(self, hit) -> None:
+        """Keeps a hit that `offer` accepted
+        """
+        if self.max_hits is not None and len(self.hits) >= self.max_hits:
+            kept = {}
+            for hit_index, kept_hit in enumerate(self.hits):
+                kept.setdefault(kept_hit.key, []).append(hit_index)
+            most = max(kept.values(), key=len)
+            del self.hits[most[-1]]
+        self.hits.append(hit)
+
+    def __len__(self) -> int:
+        """Returns the number of hits counted
+        """
+        return sum(self.counts.values())
+
+
+class TopFiles:
+
+    def __init__(self, k: int, stats):
+        """Keeps the `k` best scoring files of a search, see the module
+        docstring
+
+        :param k: number of files to keep
+        :param stats: the search's Stats.SearchStats. Its counts of files
+                      and bytes searched, or deduplicated, are the corpus
+                      statistics, unless `set_corpus` is called
+        """
+        self.k = k
+        self.stats = stats
+        self.corpus = None  # (number of files, total size) if known
+        self.doc_freq = {}  # key -> number of files with a hit for it
+        self.heap = []  # (score, order, path, sample), worst first
+        self.order = 0
+        self.files_with_hits = 0
+        # (number of files, total size, doc_freq) the heap is scored with
+        self.snapshot = None
+        self.scored_at = (0, 0)  # (files, files with hits) of the snapshot
+
+    def set_corpus(self, num_files: int, total_size: int) -> None:
+        """Uses fixed corpus statistics, e.g. those of an index, instead of
+        those of the files searched so far
+        """
+        self.corpus = (num_files, total_size)
+
+    def statistics(self) -> tuple:
+        """Returns (number of files, total size, doc_freq) as known now
+        """
+        if self.corpus is not None:
+            num_files, total_size = self.corpus
+        else:
+            # Files skipped as copies of others count as searched
+            counters = self.stats.counters
+            num_files = (counters['files_searched']
+                         + counters['files_deduplicated'])
+            total_size = (counters['bytes_searched']
+                          + counters['bytes_deduplicated'])
+        return num_files, total_size, dict(self.doc_freq)
+
+    @staticmethod
+    def score(sample: HitSample, statistics: tuple) -> float:
+        """Returns the BM25 score of a file
+
+        :param sample: the file's hits
+        :param statistics: as returned by `statistics`
+        """
+        num_files, total_size, doc_freq = statistics
+        num_files = max(num_files, 1)
+        avg_size = total_size / num_files or 1
+        length_norm = 1 - BM25_B + BM25_B * sample.size / avg_size
+        score = 0.0
+        for key, tf in sample.counts.items():
+            df = doc_freq.get(key, 0)
+            idf = math.log(1 + (num_files - df + 0.5) / (df + 0.5))
+            score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+        return score
+
+    def add(self, path: str, sample: HitSample) -> None:
+        """Scores a file with hits and keeps it if it is among the best
+        """
+        for key in sample.counts:
+            self.doc_freq[key] = self.doc_freq.get(key, 0) + 1
+        self.files_with_hits += 1
+        statistics = self.statistics()
+        grown = (statistics[0], self.files_with_hits)
+        if any(now > RESCORE_GROWTH * then
+               for now, then in zip(grown, self.scored_at)):
+            self.snapshot = statistics
+            self.scored_at = grown
+            self.heap = self.rescored(statistics)
+            heapq.heapify(self.heap)
+        # Earlier files win ties, so the order is that of the walk
+        self.order -= 1
+        entry = (self.score(sample, self.snapshot), self.order, path, sample)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def rescored(self, statistics: tuple) -> list:
+        """Returns the kept files scored with the given statistics
+        """
+        return [(self.score(sample, statistics), order, path, sample)
+                for _, order, path, sample in self.heap]
+
+    def ranked(self) -> list:
+        """Returns the kept files, best first, scored with the final
+        statistics
+
+        :return: [(score, path, hits), ...]
+        """
+        entries = self.rescored(self.statistics())
+        entries.sort(key=lambda entry: entry[:2], reverse=True)
+        return [(score, path, sample.hits)
+                for score, _, path, sample in entries]
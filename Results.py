@@ -0,0 +1,161 @@
+"""
+PersonalKnowledgeEngine
+
+Compact storage of the hits of a search; serves "GUI"
+
+A search with millions of hits would spend most of its memory on snippet
+strings, hit tuples and copies of the same paths, although only the few
+hits scrolled to are ever shown. A ResultStore keeps each path once and
+every hit as a row of fixed-size numbers in arrays: about 35 bytes per hit.
+Hits found without snippets (see `Backend.search_for_string`) get theirs
+from the file, or from the extracted text of a document, through
+`Backend.load_snippet` when they are shown; the last few built are kept so
+redrawing the view doesn't read the files again. Only hits whose text can't
+be read again, such as those inside archives, keep their snippet strings.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+from array import array
+from collections import OrderedDict
+
+from Backend import ENCODING_RULES, SearchHit, load_snippet
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+LOADED_SNIPPETS = 1024  # snippets built on demand that are kept
+NOT_SET = -1  # stands for None in the arrays
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+class ResultStore:
+
+    def __init__(self, encodings: tuple = ENCODING_RULES,
+                 extract_cache_dir: str = None, bold_regex=None):
+        """The hits of one search, as (path, hit) rows
+
+        :param encodings: the rules the search picked encodings with, to
+                          read the files again with when building snippets
+        :param extract_cache_dir: the directory the search cached the text
+                                  of documents in, see `Backend.load_snippet`
+        :param bold_regex: the `bold_regex` of the search's matcher, see
+                           `Backend.load_snippet`
+        """
+        self.encodings = encodings
+        self.extract_cache_dir = extract_cache_dir
+        self.bold_regex = bold_regex
+        self.paths = []  # distinct paths, in the order they were added
+        self.path_ids = {}  # path -> index in self.paths
+        self.keys = []
+        self.key_ids = {}
+        # One entry per row
+        self.path_column = array('i')
+        self.line_column = array('i')
+        self.column_column = array('i')
+        self.key_column = array('i')
+        self.distance_column = array('i')
+        self.offset_column = array('q')
+        self.length_column = array('i')
+        # Rare values, by row: snippets that came with their hits, messages
+        # (rows that aren't hits, such as 'no file paths included'), and
+        # where in a document a hit is
+        self.snippets = {}
+        self.messages = {}
+        self.locations = {}
+        self.loaded = OrderedDict()  # row -> snippet built on demand
+
+    def intern(self, value: str, values: list, ids: dict) -> int:
+        """Returns the index of a path or key, adding it if it is new
+        """
+        index = ids.get(value)
+        if index is None:
+            index = ids[value] = len(values)
+            values.append(value)
+        return index
+
+    def append(self, path: str, hit) -> None:
+        """Adds a row
+
+        :param path: path of the file the hit is in
+        :param hit: a Backend.SearchHit, or a message string
+        """
+        row = len(self.path_column)
+        self.path_column.append(self.intern(path, self.paths, self.path_ids))
+        if not isinstance(hit, tuple):
+            self.messages[row] = str(hit)
+            hit = SearchHit('', NOT_SET)
+        self.line_column.append(hit.line)
+        self.column_column.append(
+            NOT_SET if hit.column is None else hit.column)
+        self.key_column.append(NOT_SET if hit.key is None else self.intern(
+            hit.key, self.keys, self.key_ids))
+        self.distance_column.append(
+            NOT_SET if hit.distance is None else hit.distance)
+        self.offset_column.append(
+            NOT_SET if hit.offset is None else hit.offset)
+        self.length_column.append(
+            NOT_SET if hit.length is None else hit.length)
+        if hit.snippet is not None:
+            self.snippets[row] = hit.snippet
+        if hit.location is not None:
+            self.locations[row] = hit.location
+
+    def extend(self, rows) -> None:
+        """Adds (path, hit) rows
+        """
+        for path, hit in rows:
+            self.append(path, hit)
+
+    def __len__(self) -> int:
+        return len(self.path_column)
+
+    def path(self, row: int) -> str:
+        """Returns the path of a row
+        """
+        return self.paths[self.path_column[row]]
+
+    def hit(self, row: int):
+        """Returns the hit of a row with its snippet, or its message
+        """
+        if row in self.messages:
+            return self.messages[row]
+
+        def value(column):
+            return None if column[row] == NOT_SET else column[row]
+
+        key = value(self.key_column)
+        hit = SearchHit(self.snippets.get(row), self.line_column[row],
+                        value(self.column_column),
+                        None if key is None else self.keys[key],
+                        self.locations.get(row),
+                        value(self.distance_column),
+                        value(self.offset_column),
+                        value(self.length_column))
+        if hit.snippet is None:
+            hit = hit._replace(snippet=self.loaded_snippet(row, hit))
+        return hit
+
+    def loaded_snippet(self, row: int, hit: SearchHit) -> str:
+        """Returns the snippet of a hit found without one, building it if it
+        isn't among the last LOADED_SNIPPETS built
+        """
+        snippet = self.loaded.get(row)
+        if snippet is not None:
+            self.loaded.move_to_end(row)
+            return snippet
+        snippet = load_snippet(self.path(row), hit, self.encodings,
+                               self.extract_cache_dir, self.bold_regex)
+        self.loaded[row] = snippet
+        if len(self.loaded) > LOADED_SNIPPETS:
+            self.loaded.popitem(last=False)
+        return snippet
+
+    def __getitem__(self, row: int) -> tuple:
+        """Returns the (path, hit) of a row, see `hit`
+        """
+        return self.path(row), self.hit(row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
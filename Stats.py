@@ -0,0 +1,138 @@
+"""
+PersonalKnowledgeEngine
+
+Counters and timings collected while a search runs; serves "Backend"
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import heapq
+import json
+import time
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+# Where a search spends its time. Phases run in worker processes (extract,
+# open, decode, match, snippet) are summed over all workers, so with more
+# than one worker they can add up to more than the wall time
+PHASES = ('index', 'walk', 'hash', 'extract', 'open', 'decode', 'match',
+          'snippet', 'emit', 'wait')
+COUNTERS = ('files_found', 'files_searched', 'bytes_searched',
+            'files_cached', 'files_deduplicated', 'bytes_deduplicated',
+            'bytes_hashed',
+            'files_with_hits', 'hits',
+            # How the index was brought up to date, see "Index"
+            'index_added', 'index_changed', 'index_deleted', 'index_renamed',
+            'index_unchanged')
+# Why a file wasn't searched
+SKIP_REASONS = ('excluded', 'extension', 'binary', 'too_large',
+                'decode_error', 'extract_error', 'archive_error', 'os_error')
+STATS_SLOWEST_FILES = 10  # number of slowest files that are remembered
+STATS_REPORT_INTERVAL = 0.5  # seconds between progress reports
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+class SearchStats:
+
+    def __init__(self, slowest_files: int = STATS_SLOWEST_FILES):
+        """Counters and cumulative timings of a single search.
+
+        A search updates its stats while it runs, so they can be read at
+        any time. Worker processes fill in their own instance, which the
+        search then adds to its own with `merge`.
+
+        :param slowest_files: number of slowest files to remember
+        """
+        self.started = time.perf_counter()
+        self.finished = None
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.skipped = dict.fromkeys(SKIP_REASONS, 0)
+        self.slowest_files = slowest_files
+        self.slowest = []  # heap of (seconds, path), fastest first
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        """Adds to the time spent in a phase, see PHASES
+        """
+        self.times[phase] += seconds
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        """Adds to a counter, see COUNTERS
+        """
+        self.counters[counter] += amount
+
+    def skip(self, reason: str) -> None:
+        """Counts a file that wasn't searched, see SKIP_REASONS
+        """
+        self.skipped[reason] += 1
+
+    def file_searched(self, path: str, size: int, seconds: float) -> None:
+        """Records a file that was searched
+
+        :param path: path of the file
+        :param size: size of the file in bytes
+        :param seconds: time it took to search the file
+        """
+        self.counters['files_searched'] += 1
+        self.counters['bytes_searched'] += size
+        self.note_slow_file(path, seconds)
+
+    def note_slow_file(self, path: str, seconds: float) -> None:
+        """Remembers a file if it is one of the slowest seen so far
+        """
+        if len(self.slowest) < self.slowest_files:
+            heapq.heappush(self.slowest, (seconds, path))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, path))
+
+    def merge(self, other: 'SearchStats') -> None:
+        """Adds the counts and timings of another instance to this one
+        """
+        for phase, seconds in other.times.items():
+            self.times[phase] += seconds
+        for counter, amount in other.counters.items():
+            self.counters[counter] += amount
+        for reason, amount in other.skipped.items():
+            self.skipped[reason] += amount
+        for seconds, path in other.slowest:
+            self.note_slow_file(path, seconds)
+
+    def finish(self) -> None:
+        """Stops the clock; called when the search is over
+        """
+        self.finished = time.perf_counter()
+
+    def elapsed(self) -> float:
+        """Returns the seconds since the search started, or its duration
+        once it is over
+        """
+        end = self.finished if self.finished is not None \
+            else time.perf_counter()
+        return end - self.started
+
+    def to_dict(self) -> dict:
+        """Returns a snapshot of the stats as a JSON-serializable dict
+        """
+        elapsed = self.elapsed()
+        return dict(
+            elapsed=elapsed,
+            finished=self.finished is not None,
+            files_per_sec=(self.counters['files_searched'] / elapsed
+                           if elapsed else 0.0),
+            bytes_per_sec=(self.counters['bytes_searched'] / elapsed
+                           if elapsed else 0.0),
+            counters=dict(self.counters),
+            times=dict(self.times),
+            skipped=dict(self.skipped),
+            slowest=[dict(path=path, seconds=seconds)
+                     for seconds, path in sorted(self.slowest,
+                                                 reverse=True)],
+        )
+
+    def to_json(self, **kwargs) -> str:
+        """Returns `to_dict` as a JSON string
+
+        :param kwargs: keyword arguments for `json.dumps`
+        """
+        return json.dumps(self.to_dict(), **kwargs)
@@ -0,0 +1,371 @@
+"""
+PersonalKnowledgeEngine
+
+Benchmark script for the search backend. Generates deterministic synthetic
+file trees, runs `Backend.search_for_string` over them and reports:
+
+    files_per_sec, mb_per_sec, time_to_first_hit, wall_time, peak_rss_kb
+
+plus median_time_to_first_hit over all runs of a scenario. Each scenario
+runs in its own process so peak RSS is measured per scenario.
+Results are written as JSON so the numbers of two commits can be compared:
+
+    python benchmark.py --output before.json
+    (change something)
+    python benchmark.py --output after.json
+    python benchmark.py --compare before.json after.json
+
+Runs fully offline and never imports "GUI" or PyQt5.
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import statistics
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is reported as None there
+    resource = None
+
+from Backend import search_for_string
+from History import ScanHistory
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+CORPUS_SEED = 20211022  # same seed, same tree, on every machine
+CORPUS_DIR = 'bench_corpus'
+SEARCH_KEY = 'needle'
+KEY_PROBABILITY = 0.002  # chance that a generated word is SEARCH_KEY
+EXTENSIONS = ['.txt', '.md', '.py', '.log']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua enim '
+         'ad minim veniam quis nostrud exercitation ullamco laboris nisi '
+         'aliquip ex ea commodo consequat duis aute irure in reprehenderit '
+         'voluptate velit esse cillum fugiat nulla pariatur').split()
+BYTES_PER_MB = 1 << 20
+
+# Each scenario describes a tree. Sizes are scaled by --scale.
+#   files: number of files, spread over `dirs` directories `depth` deep
+#   words_per_line / lines_per_file: shape of every text file
+#   binary_files: number of random binary files mixed in
+#   exclude_dirs: number of directories passed as exclude paths
+SCENARIOS = {
+    'many_small_files': dict(files=5000, dirs=100, depth=2,
+                             lines_per_file=20, words_per_line=10,
+                             binary_files=0, exclude_dirs=0),
+    'few_huge_files': dict(files=4, dirs=1, depth=1,
+                           lines_per_file=200000, words_per_line=12,
+                           binary_files=0, exclude_dirs=0),
+    'deep_nesting': dict(files=2000, dirs=400, depth=40,
+                         lines_per_file=10, words_per_line=10,
+                         binary_files=0, exclude_dirs=0),
+    'long_lines': dict(files=10, dirs=2, depth=1,
+                       lines_per_file=5, words_per_line=200000,
+                       binary_files=0, exclude_dirs=0),
+    'binary_mixed': dict(files=2000, dirs=50, depth=2,
+                         lines_per_file=20, words_per_line=10,
+                         binary_files=500, exclude_dirs=0),
+    'large_exclude_list': dict(files=5000, dirs=200, depth=3,
+                               lines_per_file=20, words_per_line=10,
+                               binary_files=0, exclude_dirs=100),
+}
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+def scaled(spec: dict, scale: float) -> dict:
+    """Returns a scenario spec with its sizes multiplied by `scale`
+    """
+    spec = dict(spec)
+    for name in ('files', 'lines_per_file', 'binary_files'):
+        if spec[name]:
+            spec[name] = max(1, int(spec[name] * scale))
+    return spec
+
+
+def directory_paths(root: str, rng: random.Random, dirs: int,
+                    depth: int) -> list:
+    """Returns `dirs` directory paths under `root`, nested up to `depth`
+    """
+    paths = []
+    for i in range(dirs):
+        levels = rng.randint(1, depth)
+        parts = ['d%d_%d' % (i % (level + 7), level)
+                 for level in range(levels - 1)]
+        paths.append(os.path.join(root, *(parts + ['dir%d' % i])))
+    return paths
+
+
+def text_line(rng: random.Random, words_per_line: int) -> str:
+    """Returns one line of random words, occasionally including SEARCH_KEY
+    """
+    return ' '.join(SEARCH_KEY if rng.random() < KEY_PROBABILITY
+                    else rng.choice(WORDS)
+                    for _ in range(words_per_line))
+
+
+def generate_corpus(root: str, name: str, spec: dict) -> dict:
+    """Writes the tree for a scenario, unless it already exists
+
+    :param root: directory holding all generated trees
+    :param name: scenario name, also the tree's directory name
+    :param spec: scenario spec, see SCENARIOS
+    :return: dict with the tree's 'path', 'exclude_paths', 'files' and
+             'bytes'
+    """
+    path = os.path.join(root, name)
+    manifest_path = path + '.json'
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['spec'] == spec:
+            return manifest
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+    rng = random.Random('%d:%s' % (CORPUS_SEED, name))
+    dirs = directory_paths(path, rng, spec['dirs'], spec['depth'])
+    for directory in dirs:
+        os.makedirs(directory, exist_ok=True)
+
+    num_bytes = 0
+    for i in range(spec['files']):
+        extension = EXTENSIONS[i % len(EXTENSIONS)]
+        file_path = os.path.join(dirs[i % len(dirs)],
+                                 'f%d%s' % (i, extension))
+        with open(file_path, 'w', encoding='utf-8', newline='\n') as f:
+            for _ in range(spec['lines_per_file']):
+                num_bytes += f.write(
+                    text_line(rng, spec['words_per_line']) + '\n')
+    for i in range(spec['binary_files']):
+        file_path = os.path.join(dirs[i % len(dirs)], 'b%d.txt' % i)
+        size = 4096 + i % 4096
+        data = rng.getrandbits(8 * size).to_bytes(size, 'little')
+        with open(file_path, 'wb') as f:
+            num_bytes += f.write(data)
+
+    manifest = dict(spec=spec,
+                    path=path,
+                    exclude_paths=dirs[:spec['exclude_dirs']],
+                    files=spec['files'] + spec['binary_files'],
+                    bytes=num_bytes)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process in KiB, if known
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KiB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_scenario(manifest: dict, search_options: dict) -> dict:
+    """Searches one generated tree and measures it; runs in a child process
+
+    :param manifest: the tree, as returned by `generate_corpus`
+    :param search_options: extra keyword arguments for search_for_string,
+                           and optionally the 'history_path' of a
+                           History.ScanHistory to search with
+    :return: dict of measurements
+    """
+    search_options = dict(search_options)
+    history_path = search_options.pop('history_path', None)
+    if history_path is not None:
+        search_options['history'] = ScanHistory(history_path)
+    num_hits = [0]
+    first_hit = [None]
+    start = time.perf_counter()
+
+    def result_callback(path, search_hits):
+        """Counts hits and notes when the first one arrived
+        """
+        if first_hit[0] is None:
+            first_hit[0] = time.perf_counter() - start
+        num_hits[0] += len(search_hits)
+
+    stats = search_for_string(result_callback,
+                              lambda: None,
+                              [False],
+                              SEARCH_KEY,
+                              [manifest['path']],
+                              None,
+                              manifest['exclude_paths'],
+                              **search_options)
+    wall_time = time.perf_counter() - start
+
+    return dict(files=manifest['files'],
+                mb=manifest['bytes'] / BYTES_PER_MB,
+                hits=num_hits[0],
+                wall_time=wall_time,
+                time_to_first_hit=first_hit[0],
+                files_per_sec=manifest['files'] / wall_time,
+                mb_per_sec=manifest['bytes'] / BYTES_PER_MB / wall_time,
+                peak_rss_kb=peak_rss_kb(),
+                phase_times=stats.times,
+                skipped=stats.skipped)
+
+
+def scenario_process(connection, manifest: dict, search_options: dict) -> None:
+    """Runs `run_scenario` and sends its measurements back to the parent
+    """
+    connection.send(run_scenario(manifest, search_options))
+    connection.close()
+
+
+def git_commit() -> str:
+    """Returns the current git commit, or None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(corpus_root: str, names: list, scale: float,
+                   repeat: int, search_options: dict) -> dict:
+    """Generates the trees and runs every scenario `repeat` times
+
+    :return: dict with machine info and, per scenario, the best run (the
+             one with the lowest wall time)
+    """
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name in names:
+        manifest = generate_corpus(corpus_root, name,
+                                   scaled(SCENARIOS[name], scale))
+        options = dict(search_options)
+        if options.pop('likely_first', False):
+            # A history of this scenario's runs only, so the first run
+            # starts without one and the others use what it found
+            options['history_path'] = os.path.join(corpus_root,
+                                                   name + '.history.db')
+            if os.path.exists(options['history_path']):
+                os.remove(options['history_path'])
+        runs = []
+        for _ in range(repeat):
+            # A fresh process per run, so peak RSS belongs to this run. Not
+            # a Pool, since the search may start a process pool of its own
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=scenario_process,
+                                      args=(sender, manifest, options))
+            process.start()
+            runs.append(receiver.recv())
+            process.join()
+        best = min(runs, key=lambda run: run['wall_time'])
+        first_hits = [run['time_to_first_hit'] for run in runs
+                      if run['time_to_first_hit'] is not None]
+        best['median_time_to_first_hit'] = (statistics.median(first_hits)
+                                            if first_hits else None)
+        results[name] = best
+        print('%-20s %8.0f files/s %8.2f MB/s  first hit %s (median %s)  '
+              'total %.3fs'
+              % (name, best['files_per_sec'], best['mb_per_sec'],
+                 '-' if best['time_to_first_hit'] is None
+                 else '%.3fs' % best['time_to_first_hit'],
+                 '-' if best['median_time_to_first_hit'] is None
+                 else '%.3fs' % best['median_time_to_first_hit'],
+                 best['wall_time']),
+              file=sys.stderr)
+    return dict(commit=git_commit(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                cpu_count=os.cpu_count(),
+                scale=scale,
+                repeat=repeat,
+                search_options=search_options,
+                scenarios=results)
+
+
+def compare(before_path: str, after_path: str) -> None:
+    """Prints how each scenario's numbers changed between two result files
+    """
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print('%-20s %-24s %12s %12s %8s' % ('scenario', 'metric', 'before',
+                                         'after', 'change'))
+    for name, old in before['scenarios'].items():
+        new = after['scenarios'].get(name)
+        if new is None:
+            continue
+        for metric in ('files_per_sec', 'mb_per_sec', 'time_to_first_hit',
+                       'median_time_to_first_hit', 'wall_time',
+                       'peak_rss_kb'):
+            # Results written before a metric existed don't have it
+            if old.get(metric) is None or new.get(metric) is None:
+                continue
+            change = ('%+7.1f%%' % (100.0 * (new[metric] - old[metric])
+                                    / old[metric])
+                      if old[metric] else '')
+            print('%-20s %-24s %12.3f %12.3f %8s'
+                  % (name, metric, old[metric], new[metric], change))
+
+
+def main(argv: list) -> int:
+    """Parses the command line and runs or compares benchmarks
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark search_for_string on synthetic file trees.')
+    parser.add_argument('--corpus', default=CORPUS_DIR,
+                        help='directory to generate trees in (reused '
+                             'between runs)')
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=sorted(SCENARIOS),
+                        help='scenario to run (repeatable; default: all)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplier for the size of every tree')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per scenario; the fastest is reported')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='search_for_string workers')
+    parser.add_argument('--likely-first', action='store_true',
+                        help='search with a history of where earlier runs '
+                             'found hits, to search likely files first')
+    parser.add_argument('--output', help='file to write JSON results to '
+                                         '(default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    report = run_benchmarks(args.corpus,
+                            args.scenarios or sorted(SCENARIOS),
+                            args.scale,
+                            args.repeat,
+                            dict(workers=args.workers,
+                                 likely_first=args.likely_first))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+# SCRIPT (run the benchmarks from the command line)
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,304 @@
+"""
+PersonalKnowledgeEngine
+
+Command line script that runs a search without the GUI. Every search hit is
+written to stdout as one line of JSON as soon as it is found:
+
+    {"path": "...", "line": 12, "snippet": "...<b>key</b>..."}
+
+Hits found with --all-matches also have a "column", and hits in documents
+(Word, PowerPoint and, with pypdf installed, PDF files) have a "location"
+such as "page 3". With --archives, the files inside zip, tar and gzip files
+are searched too, with paths like "notes.zip!/2019/may.md". Several keys can be
+searched for in a single pass over the files, by giving more than one or
+with --keys-file; hits then also say which "key" they are for. With --query,
+the arguments are joined into a boolean query such as 'budget AND "first
+draft" NOT old' instead, and its hits also say which term they are for.
+With --fuzzy N, keys also match with up to N typos, and each hit has the
+"distance" it needed. With --likely-first, the files earlier searches with
+this option found hits in are searched first, so the first hits come sooner.
+With --max-hits N, the search stops after N hits and, if there may be more,
+writes a last line {"cursor": "..."}; passing it back with --cursor writes
+the next N hits, and so on. With --top,
+only the most relevant files are written once the search is over, best
+first, each with a few of its hits and its "rank". Everything
+else the backend prints goes to stderr. With --stats, the search's counters
+and per-phase timings are written as JSON once it is over. This script
+never imports "GUI" or PyQt5, so it works in cron jobs, CI and remote
+shells.
+
+Exit status is 0 if anything was found (or a page ended with a cursor), 1 if
+nothing was, 2 on errors.
+
+Example:
+    python cli.py "search term" -i notes -i code -e .txt -e .md -x code/build
+    python cli.py TODO FIXME XXX -i code
+    python cli.py --regex "def \w+_test\(" --ignore-case -i code
+    python cli.py receive --fuzzy 1 -i notes
+    python cli.py --query 'parser AND (TODO OR FIXME) NOT "won't fix"' -i code
+    python cli.py TODO -i code --max-hits 50 --cursor eyJ...
+"""
+
+
+# IMPORTS (remember to list installed packages in "requirements.txt")
+import argparse
+import json
+import os
+import sys
+
+from Backend import ENCODING_RULES, search_for_string
+from Extractors import EXTRACT_CACHE_DIR
+from History import HISTORY_STORE_PATH, ScanHistory
+from Paging import PAGE_HITS, search_page
+from Stats import SearchStats
+
+
+# GLOBAL HARDCODED VARS (no magic numbers; all caps for names)
+EXIT_FOUND = 0
+EXIT_NOT_FOUND = 1
+EXIT_ERROR = 2
+EXIT_INTERRUPTED = 130
+
+
+# DEFINITIONS (define all requisite classes/functions)
+
+def parse_args(argv: list) -> argparse.Namespace:
+    """Parses the command line arguments
+
+    :param argv: arguments, not including the program name
+    """
+    parser = argparse.ArgumentParser(
+        description='Search files for a string and print each hit as JSON.')
+    parser.add_argument('keys', nargs='*', metavar='key',
+                        help='string to search for (several are searched '
+                             'for at once)')
+    parser.add_argument('--keys-file', metavar='FILE',
+                        help='file with more strings to search for, one per '
+                             'line')
+    parser.add_argument('--ignore-case', action='store_true',
+                        help='match regardless of case')
+    parser.add_argument('--regex', action='store_true',
+                        help='keys are regular expressions, matched against '
+                             'each line')
+    parser.add_argument('--query', action='store_true',
+                        help='the keys, joined by spaces, are a boolean '
+                             'query with AND, OR, NOT, NEAR/n, parentheses '
+                             'and "quoted phrases"')
+    parser.add_argument('--fuzzy', type=int, metavar='EDITS',
+                        dest='max_distance',
+                        help='also match keys with up to EDITS characters '
+                             'inserted, deleted, replaced or swapped')
+    parser.add_argument('-i', '--include', action='append', required=True,
+                        metavar='PATH', dest='include_paths',
+                        help='directory or file to search (repeatable)')
+    parser.add_argument('-e', '--ext', action='append', metavar='EXT',
+                        dest='include_exts',
+                        help="file extension to include, e.g. '.txt' "
+                             "(repeatable; default: all files)")
+    parser.add_argument('-x', '--exclude', action='append', default=[],
+                        metavar='PATH', dest='exclude_paths',
+                        help='directory or file to skip (repeatable)')
+    parser.add_argument('--index', metavar='FILE', dest='index_path',
+                        help='trigram index file to build or reuse')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to search with')
+    parser.add_argument('--follow-symlinks', action='store_true',
+                        help='descend into symlinked directories')
+    parser.add_argument('--all-matches', action='store_true',
+                        help='report every match in a line, not just the '
+                             'first')
+    parser.add_argument('--encoding', action='append', metavar='RULE',
+                        dest='encodings',
+                        help="how to pick a file's encoding: 'bom' for its "
+                             "byte order mark, or a codec to try, in order "
+                             "(repeatable; default: %s)"
+                             % ' '.join(ENCODING_RULES))
+    parser.add_argument('--max-size', type=int, metavar='BYTES',
+                        dest='max_file_size',
+                        help='skip files larger than this')
+    parser.add_argument('--top', type=int, metavar='K', dest='top_k',
+                        help='only report the K most relevant files, ranked '
+                             'with BM25, once the search is over')
+    parser.add_argument('--archives', action='store_true',
+                        help='search the files inside zip, tar and gzip '
+                             'files, without extracting them')
+    parser.add_argument('--dedup', action='store_true',
+                        help='read only one of the files with the same '
+                             'contents and report its hits for all of them')
+    parser.add_argument('--likely-first', action='store_true',
+                        help='search the files likely to have hits first: '
+                             'those with hits in earlier searches, then '
+                             'those with the extensions found most and '
+                             'recently modified ones (history kept in %s)'
+                             % HISTORY_STORE_PATH.replace('%', '%%'))
+    parser.add_argument('--max-hits', type=int, metavar='N',
+                        help='stop after N hits and write a cursor to get '
+                             'the next ones with')
+    parser.add_argument('--cursor',
+                        help='carry on from where the search that wrote '
+                             'this cursor stopped (default --max-hits: %d)'
+                             % PAGE_HITS)
+    parser.add_argument('--extract-cache', metavar='DIR',
+                        default=EXTRACT_CACHE_DIR, dest='extract_cache_dir',
+                        help='directory the text extracted from documents '
+                             'is cached in (default: %(default)s)')
+    parser.add_argument('--no-extract', action='store_const', const=None,
+                        dest='extract_cache_dir',
+                        help='skip documents as binary files instead of '
+                             'searching their text')
+    parser.add_argument('--stats', metavar='FILE', dest='stats_path',
+                        help="write the search's stats as JSON to FILE when "
+                             "it is over ('-' for stderr)")
+    args = parser.parse_args(argv)
+    if args.query and args.keys_file:
+        parser.error('--keys-file cannot be used with --query')
+    if args.cursor is not None and args.max_hits is None:
+        args.max_hits = PAGE_HITS
+    if args.max_hits is not None:
+        if args.max_hits < 1:
+            parser.error('--max-hits must be at least 1')
+        # Pages are searched in one process, in the order of a sorted walk
+        for used, option in ((args.top_k is not None, '--top'),
+                             (args.dedup, '--dedup'),
+                             (args.index_path is not None, '--index'),
+                             (args.workers != 1, '--workers'),
+                             (args.likely_first, '--likely-first')):
+            if used:
+                parser.error('%s cannot be used with --max-hits or --cursor'
+                             % option)
+    if args.keys_file:
+        with open(args.keys_file, encoding='utf-8') as f:
+            args.keys.extend(line.rstrip('\r\n') for line in f)
+    args.keys = [key for key in args.keys if key]
+    if not args.keys:
+        parser.error('no key to search for')
+    if args.query:
+        args.keys = ' '.join(args.keys)
+    if args.include_exts is not None:
+        # Accept 'txt' as well as '.txt'
+        args.include_exts = ['.' + ext.lstrip('.')
+                             for ext in args.include_exts]
+    return args
+
+
+def hit_to_json(path: str, hit: tuple, with_key: bool = False,
+                rank: int = None) -> str:
+    """Formats a single search hit as a line of JSON
+
+    :param path: path of the file containing the hit
+    :param hit: a Backend.SearchHit
+    :param with_key: whether to say which key the hit is for
+    :param rank: rank of the file in ranked mode, 1 for the best
+    """
+    record = {'path': path, 'line': hit.line, 'snippet': hit.snippet}
+    if hit.column is not None:
+        record['column'] = hit.column
+    if hit.location is not None:
+        record['location'] = hit.location
+    if hit.distance is not None:
+        record['distance'] = hit.distance
+    if with_key:
+        record['key'] = hit.key
+    if rank is not None:
+        record['rank'] = rank
+    return json.dumps(record, ensure_ascii=False)
+
+
+def main(argv: list) -> int:
+    """Runs a search and streams its hits to stdout
+
+    :param argv: arguments, not including the program name
+    :return: the exit status
+    """
+    args = parse_args(argv)
+    with_key = args.query or len(set(args.keys)) > 1
+    out = sys.stdout
+    num_hits = [0]
+    num_files = [0]
+    more = [False]  # whether a page was written and more may come
+
+    def result_callback(path, search_hits):
+        """Writes each hit in a file as soon as the backend reports it
+        """
+        num_files[0] += 1
+        rank = num_files[0] if args.top_k is not None else None
+        for hit in search_hits:
+            out.write(hit_to_json(path, hit, with_key, rank) + '\n')
+        out.flush()
+        num_hits[0] += len(search_hits)
+
+    def search():
+        """Runs the search, or the page of it asked for, and writes the
+        cursor of the next page if there is one
+
+        :return: the search's stats
+        """
+        options = dict(follow_symlinks=args.follow_symlinks,
+                       all_matches=args.all_matches,
+                       encodings=tuple(args.encodings or ENCODING_RULES),
+                       max_file_size=args.max_file_size,
+                       ignore_case=args.ignore_case,
+                       regex=args.regex,
+                       extract_cache_dir=args.extract_cache_dir,
+                       archives=args.archives,
+                       query=args.query,
+                       max_distance=args.max_distance)
+        if args.max_hits is None:
+            return search_for_string(result_callback,
+                                     lambda: None,
+                                     [False],
+                                     args.keys,
+                                     args.include_paths,
+                                     args.include_exts,
+                                     args.exclude_paths,
+                                     index_path=args.index_path,
+                                     workers=args.workers,
+                                     top_k=args.top_k,
+                                     dedup=args.dedup,
+                                     history=(ScanHistory()
+                                              if args.likely_first
+                                              else None),
+                                     **options)
+        stats = SearchStats()
+        page, cursor = search_page(args.keys,
+                                   args.include_paths,
+                                   args.include_exts,
+                                   args.exclude_paths,
+                                   cursor=args.cursor,
+                                   max_hits=args.max_hits,
+                                   stats=stats,
+                                   **options)
+        for path, hit in page:
+            out.write(hit_to_json(path, hit, with_key) + '\n')
+        num_hits[0] += len(page)
+        if cursor is not None:
+            out.write(json.dumps({'cursor': cursor}) + '\n')
+            more[0] = True
+        out.flush()
+        return stats
+
+    try:
+        stats = search()
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    except BrokenPipeError:
+        # Reader went away, e.g. piped into `head`. Point stdout at devnull
+        # so flushing it on exit doesn't raise again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+        return EXIT_FOUND
+    except Exception as e:
+        print('error:', e, file=sys.stderr)
+        return EXIT_ERROR
+
+    if args.stats_path == '-':
+        print(stats.to_json(indent=2), file=sys.stderr)
+    elif args.stats_path:
+        with open(args.stats_path, 'w') as f:
+            f.write(stats.to_json(indent=2) + '\n')
+
+    return EXIT_FOUND if num_hits[0] or more[0] else EXIT_NOT_FOUND
+
+
+# SCRIPT (run a search from the command line)
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))